@@ -0,0 +1,135 @@
+"""
+Compare the three-step and the fused generation pipeline.
+
+Generates tests for the sample targets in ``src/inventory_manager.py`` with
+both pipelines and reports latency, token usage and the share of generated
+test files that pass. The response cache and the AST memo of explanations
+and plans are bypassed, and every run is checked to have sent each of its
+steps to the API.
+
+Usage:
+    python -m benchmarks.pipeline_modes --repeats 3 --model gpt-3.5-turbo
+"""
+
+import argparse
+import statistics
+import time
+
+from src.__main__ import read_class_or_method
+from src.client import get_client
+from src.response_cache import ResponseCache
+from src.unittest_flow import PIPELINES, get_pipeline_stats, run_pytest, unittest_flow
+
+SAMPLE_FILE = "inventory_manager.py"
+SAMPLE_TARGETS = ["InventoryManager", "add_item", "remove_item", "check_inventory"]
+# Requests every run sends at least: explain, plan and execute, or one fused request
+MIN_REQUESTS = {"three_step": 3, "fused": 1}
+
+
+class UsageCountingClient:
+    """Wraps a client and sums the token usage of every non-streamed response."""
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = 0
+        self.tokens = 0
+        self.chat = self
+        self.completions = self
+
+    def create(self, **kwargs):
+        response = self.client.chat.completions.create(**kwargs)
+        self.requests += 1
+        if getattr(response, "usage", None) is not None:
+            self.tokens += response.usage.total_tokens
+        return response
+
+
+def check_requests(pipeline, name, requests, stats_before):
+    """Raise if a run of ``pipeline`` re-used an answer instead of asking the client."""
+    stats = get_pipeline_stats()
+    reused = sum(
+        stats.get(event, 0) - stats_before.get(event, 0)
+        for event in ("memo_hits", "coalesced_requests")
+    )
+    if reused or requests < MIN_REQUESTS[pipeline]:
+        raise RuntimeError(
+            f"{pipeline} {name}: only {requests} requests reached the client "
+            f"({reused} answers re-used), the comparison would be skewed"
+        )
+
+
+def run_mode(pipeline, targets, repeats, model):
+    """Generate and run the tests of every target ``repeats`` times with one pipeline."""
+    client = UsageCountingClient(get_client())
+    cache = ResponseCache(bypass=True)
+    memo = ResponseCache(bypass=True)
+    latencies = []
+    passed = 0
+    runs = 0
+    for _ in range(repeats):
+        for name in targets:
+            function_to_test, function_filename = read_class_or_method(SAMPLE_FILE, name)
+            requests = client.requests
+            stats = get_pipeline_stats()
+            start = time.perf_counter()
+            try:
+                test_file = unittest_flow(
+                    function_to_test,
+                    function_filename,
+                    explain_model=model,
+                    plan_model=model,
+                    execute_model=model,
+                    cache=cache,
+                    client=client,
+                    pipeline=pipeline,
+                    memo=memo,
+                )
+            except ValueError as e:
+                print(f"{pipeline} {name}: {e}")
+                test_file = None
+            latencies.append(time.perf_counter() - start)
+            check_requests(pipeline, name, client.requests - requests, stats)
+            runs += 1
+            if test_file is not None and run_pytest(test_file)["returncode"] == 0:
+                passed += 1
+    return {
+        "pipeline": pipeline,
+        "runs": runs,
+        "requests": client.requests,
+        "tokens": client.tokens,
+        "mean_latency": statistics.mean(latencies),
+        "median_latency": statistics.median(latencies),
+        "pass_rate": passed / runs,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per target and mode")
+    parser.add_argument("--model", type=str, default="gpt-3.5-turbo")
+    parser.add_argument(
+        "--targets",
+        type=str,
+        nargs="+",
+        default=SAMPLE_TARGETS,
+        help=f"Classes or methods of {SAMPLE_FILE} to generate tests for",
+    )
+    args = parser.parse_args(argv)
+
+    results = [
+        run_mode(pipeline, args.targets, args.repeats, args.model)
+        for pipeline in PIPELINES
+    ]
+    print(
+        f"\n{'pipeline':<12} {'runs':>5} {'requests':>9} {'tokens':>9} "
+        f"{'mean s':>8} {'median s':>9} {'passed':>7}"
+    )
+    for r in results:
+        print(
+            f"{r['pipeline']:<12} {r['runs']:>5} {r['requests']:>9} {r['tokens']:>9} "
+            f"{r['mean_latency']:>8.2f} {r['median_latency']:>9.2f} {r['pass_rate']:>7.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+End-to-end throughput of the batch paths against the local stand-in server.
+
+Starts ``src.stub_server`` in-process, generates a module with synthetic
+targets in a scratch copy of ``src`` (corrections rewrite source files, so the
+real tree is never touched) and runs the CLI batch mode (``--jobs``) and the
+asyncio batch path for every worker count. Reports targets per minute, the
+p50/p99 latency per target and the retries caused by injected failures.
+
+Usage:
+    python -m benchmarks.throughput --workers 1 2 4 8 --targets 32 --latency 0.5
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from src.stub_server import StubBehaviour, start_stub_server
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET_MODULE = "bench_targets.py"
+
+ASYNC_RUNNER = """
+import asyncio, sys
+from src.__main__ import agenerate_tests, list_module_symbols
+from src.telemetry import configure_telemetry
+
+module, workers, report_file = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+telemetry = configure_telemetry()
+targets = [(module, name) for name in list_module_symbols(module)]
+asyncio.run(agenerate_tests(targets, max_concurrency=workers))
+telemetry.write_report(report_file)
+"""
+
+
+def make_workspace(num_targets):
+    """Copy ``src`` into a scratch directory and add a module with ``num_targets`` functions."""
+    workspace = tempfile.mkdtemp(prefix="unittest-llm-bench-")
+    shutil.copytree(
+        os.path.join(REPO_ROOT, "src"),
+        os.path.join(workspace, "src"),
+        ignore=shutil.ignore_patterns("__pycache__", "*.ipynb"),
+    )
+    with open(os.path.join(workspace, "src", TARGET_MODULE), "w") as f:
+        for i in range(num_targets):
+            f.write(f"def target_{i}(x):\n    return x + {i}\n\n\n")
+    return workspace
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of ``values`` (0 if empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def run_once(mode, workers, args, base_url):
+    """Run one batch in a fresh workspace and return its measurements."""
+    workspace = make_workspace(args.targets)
+    report_file = os.path.join(workspace, "report.json")
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="stub",
+        OPENAI_BASE_URL=base_url,
+        PYTHONPATH=workspace,
+        UNITTEST_LLM_CACHE_DIR=os.path.join(workspace, ".llm_cache", "responses"),
+    )
+    if mode == "threads":
+        command = [
+            sys.executable, "-m", "src",
+            "--module", TARGET_MODULE,
+            "--jobs", str(workers),
+            "--no_cache",
+            "--report_file", report_file,
+            "--request_timeout", str(args.request_timeout),
+        ]
+    else:
+        command = [sys.executable, "-c", ASYNC_RUNNER, TARGET_MODULE, str(workers), report_file]
+
+    output = None if args.verbose else subprocess.DEVNULL
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=workspace, env=env, stdout=output, stderr=output)
+    wall = time.perf_counter() - start
+
+    try:
+        with open(report_file, "r") as f:
+            report = json.load(f)
+    except OSError:
+        report = {"records": [], "totals": {"retries": 0}}
+    finally:
+        if not args.keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+    latencies = [r["elapsed"] for r in report["records"] if r["stage"] == "target"]
+    return {
+        "mode": mode,
+        "workers": workers,
+        "returncode": process.returncode,
+        "wall": wall,
+        "targets_per_minute": len(latencies) / wall * 60,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "retries": report["totals"]["retries"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--targets", type=int, default=16, help="Synthetic targets per run")
+    parser.add_argument("--modes", nargs="+", choices=("threads", "async"), default=["threads", "async"])
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean seconds per LLM response")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    parser.add_argument("--timeout_rate", type=float, default=0.0)
+    parser.add_argument("--request_timeout", type=float, default=10.0, help="Client timeout in threads mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the runs")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch workspaces")
+    args = parser.parse_args(argv)
+
+    behaviour = StubBehaviour(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        timeout_rate=args.timeout_rate,
+        retry_after=0.5,
+        timeout=args.request_timeout * 2,
+        seed=args.seed,
+    )
+    server = start_stub_server(behaviour)
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    try:
+        results = [
+            run_once(mode, workers, args, base_url)
+            for mode in args.modes
+            for workers in args.workers
+        ]
+    finally:
+        server.shutdown()
+
+    print(
+        f"\n{'mode':<8} {'workers':>7} {'targets/min':>12} {'p50 s':>7} {'p99 s':>7} "
+        f"{'retries':>8} {'wall s':>7} {'exit':>5}"
+    )
+    for r in results:
+        print(
+            f"{r['mode']:<8} {r['workers']:>7} {r['targets_per_minute']:>12.1f} {r['p50']:>7.2f} "
+            f"{r['p99']:>7.2f} {r['retries']:>8} {r['wall']:>7.1f} {r['returncode']:>5}"
+        )
+    print(f"\nStub server: {behaviour.counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,58 @@ from src.unittest_flow import (
     unittest_flow,
     run_pytest,
     correct_function,
+    extend_tests_for_coverage,
     extract_failed_test_cases,
+    get_pipeline_stats,
+    target_test_file,
+    generated_test_path,
+    PIPELINES,
+)
+from src.async_flow import (
+    aunittest_flow,
+    arun_pytest,
+    acorrect_function,
+    aextend_tests_for_coverage,
+)
+from src.ast_hash import configure_ast_memo
+from src.cassette import RecordingClient, ReplayClient
+from src.coverage_guide import coverage_target, describe_coverage
+from src.client import (
+    DEFAULT_POOL_SIZE,
+    configure_client,
+    get_async_client,
+    set_client,
+)
+from src.incremental import record_passed_targets, select_changed_targets
+from src.pytest_results import (
+    describe_results,
+    failure_signature,
+    format_failures,
+    rerun_node_ids,
+)
+from src.pytest_worker import configure_pytest_runner
+from src.rate_limiter import configure_rate_limiter
+from src.resource_limits import configure_resource_limits
+from src.response_cache import configure_response_cache
+from src.telemetry import DEFAULT_REPORT_FILE, configure_telemetry, get_telemetry
+from src.slicer import DEFAULT_CONTEXT_TOKENS, class_skeleton, dependency_slice
+from src.symbol_index import get_symbol_index, symbol_source
+from src.test_merge import (
+    failing_test_names,
+    merge_test_file,
+    merge_test_files,
+    read_test_file,
+    remove_test_files,
+    restore_test_file,
 )
 
 import sys
 import logging
 import os
-import ast
 import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -34,87 +78,394 @@ if openai_api_key is None:
 
 
 import os
-import ast
 
 
-def find_class_or_method(node, name):
+def read_class_or_method(source_file: str, name: str):
     """
-    Recursively search for a class or method in the AST node.
+    Reads a specific class, function or method from a Python source file.
+
+    The definition is looked up in the persistent symbol index, so the file is
+    only parsed again if it changed since it was last indexed.
 
     Args:
-        node (ast.AST): The AST node to search within.
-        name (str): The name of the class or method to find.
+        source_file (str): The file name of the Python source.
+        name (str): The name of the class, function or method to read, either
+            plain (the first definition of that name) or qualified (``Class.method``).
 
     Returns:
-        str: The source code of the class or method if found, otherwise None.
+        str: The source code of the specified class or method.
+        str: The absolute path of the file where the class or method was found.
     """
-    # Enhanced debugging: Print current node type and name (if applicable)
-    if hasattr(node, "name"):
-        print(f"Visiting node: {node.__class__.__name__} with name: {node.name}")
-    else:
-        print(f"Visiting node: {node.__class__.__name__}")
-
-    if isinstance(node, ast.ClassDef) and node.name == name:
-        print(f"Class {name} found")
-        return ast.unparse(node)
-    elif isinstance(node, ast.ClassDef):
-        for subnode in node.body:
-            result = find_class_or_method(subnode, name)
-            if result:
-                return result
-    elif isinstance(node, ast.Module):
-        for subnode in node.body:
-            result = find_class_or_method(subnode, name)
-            if result:
-                return result
-    return None
+    # Construct the absolute path to the Python source file
+    source_path = resolve_source_path(source_file)
+    index = get_symbol_index()
 
+    try:
+        symbol = index.lookup(source_path, name)
+        code = symbol_source(source_path, symbol) if symbol else None
+    except IOError as e:
+        raise IOError(f"Unable to read file {source_file}: {e}")
 
-def read_class_or_method(source_file: str, name: str):
+    if code is None:
+        reason = index.error(source_path) or "No such class, function or method."
+        raise ValueError(f"Class or method '{name}' not found in '{source_file}'. {reason}")
+
+    logging.info(f"Read {symbol['kind']} {symbol['qualname']} from {source_path}")
+
+    return code, source_path
+
+
+def resolve_source_path(source_file: str) -> str:
+    """Resolves a file or directory name relative to the src package (absolute paths are kept)."""
+    current_file_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.normpath(os.path.join(current_file_dir, source_file))
+
+
+def list_module_symbols(source_file: str):
     """
-    Reads a specific class or method from a Python source file.
+    Lists the top-level classes and functions of a Python source file.
 
     Args:
         source_file (str): The file name of the Python source.
-        name (str): The name of the class or method to read.
 
     Returns:
-        str: The source code of the specified class or method.
-        str: The absolute path of the file where the class or method was found.
+        list: The names of all top-level classes and (async) functions, in source order.
     """
-    # Construct the absolute path to the Python source file
-    current_file_dir = os.path.dirname(os.path.abspath(__file__))
-    source_path = os.path.join(current_file_dir, source_file)
+    return [
+        symbol["name"]
+        for symbol in get_symbol_index().symbols(resolve_source_path(source_file))
+        if "." not in symbol["qualname"]
+    ]
 
-    try:
-        # Read the contents of the Python source file
-        with open(source_path, "r") as file:
-            source_code = file.read()
-    except IOError as e:
-        raise IOError(f"Unable to read file {source_file}: {e}")
 
-    print(f"File read successfully from {source_path}")
+def list_directory_modules(directory: str):
+    """
+    Lists the Python modules below a directory that can be targeted.
+
+    Args:
+        directory (str): The directory to scan (relative to the src package or absolute).
+
+    Returns:
+        list: The absolute paths of all modules, skipping tests and entry points.
+    """
+    modules = []
+    for root, dirs, files in os.walk(resolve_source_path(directory)):
+        dirs[:] = sorted(d for d in dirs if not d.startswith((".", "__")))
+        for name in sorted(files):
+            if not name.endswith(".py") or name.startswith("test_"):
+                continue
+            if name in ("__init__.py", "__main__.py"):
+                continue
+            modules.append(os.path.join(root, name))
+    return modules
 
-    # Parse the source code into an AST
-    tree = ast.parse(source_code)
 
-    print("AST parsed successfully")
+def collect_targets(args):
+    """
+    Collects the (file_name, class_or_method) pairs requested on the command line.
 
-    # Recursively find the class or method
-    code = find_class_or_method(tree, name)
+    Args:
+        args (argparse.Namespace): The parsed command line arguments.
 
-    if code is None:
-        raise ValueError(
-            f"Class or method '{name}' not found in '{source_file}'. Code not found after AST parsing."
+    Returns:
+        list: The targets without duplicates, in the order they were requested.
+    """
+    targets = []
+    if args.file_name and args.class_or_method:
+        targets.append((args.file_name, args.class_or_method))
+    for target in args.targets or []:
+        file_name, _, class_or_method = target.rpartition(":")
+        if not file_name or not class_or_method:
+            raise ValueError(f"Target '{target}' is not of the form file.py:Name")
+        targets.append((file_name, class_or_method))
+    for module in args.module or []:
+        targets += [(module, name) for name in list_module_symbols(module)]
+    for directory in args.directory or []:
+        modules = list_directory_modules(directory)
+        # Parse the modules that changed since the last run on all cores at once
+        get_symbol_index().update(modules, workers=args.index_jobs)
+        for module in modules:
+            targets += [(module, name) for name in list_module_symbols(module)]
+    return list(dict.fromkeys(targets))
+
+
+def list_class_methods(source_file: str, class_name: str):
+    """
+    Lists the methods defined directly in a class.
+
+    Args:
+        source_file (str): The file name of the Python source.
+        class_name (str): The plain or qualified name of the class.
+
+    Returns:
+        list: The qualified names of the methods, in source order; empty if
+            ``class_name`` is not a class.
+    """
+    index = get_symbol_index()
+    source_path = resolve_source_path(source_file)
+    symbol = index.lookup(source_path, class_name)
+    if symbol is None or symbol["kind"] != "class":
+        return []
+    prefix = symbol["qualname"] + "."
+    return [
+        method["qualname"]
+        for method in index.symbols(source_path)
+        if method["kind"] in ("method", "async method")
+        and method["qualname"].startswith(prefix)
+        and "." not in method["qualname"][len(prefix) :]
+    ]
+
+
+def merge_method_tests(function_filename, class_code, method_results):
+    """
+    Merges the test files of the methods of a class into one module and runs it.
+
+    If the merged module fails although the tests of every method passed on
+    their own, the merge broke them: the class's test module is restored and
+    the per-method test files are kept instead.
+
+    Args:
+        function_filename (str): The absolute path of the file defining the class.
+        class_code (str): The source code of the class.
+        method_results (list): The results of ``repair_loop`` for its methods.
+
+    Returns:
+        dict: The path of the class's test module (or the kept per-method
+            files), whether all its tests passed and the coverage of the
+            class in percent.
+    """
+    test_file = generated_test_path(target_test_file(function_filename, class_code))
+    method_test_files = [result["test_file"] for result in method_results]
+    previous_tests = read_test_file(test_file)
+    merge_test_files(test_file, method_test_files, remove_sources=False)
+    test_output = run_pytest(test_file, coverage=coverage_target(function_filename, class_code))
+    coverage = test_output.get("coverage")
+    logging.info(
+        f"Tests of {len(method_test_files)} methods merged into {test_file}: "
+        f"{describe_results(test_output)}" + (f", {describe_coverage(coverage)}" if coverage else "")
+    )
+    if test_output["returncode"] != 0 and all(result["passed"] for result in method_results):
+        logging.warning(
+            f"The merged tests fail although the tests of every method pass, "
+            f"keeping the per-method test files instead of {test_file}"
         )
+        restore_test_file(test_file, previous_tests)
+        return {
+            "test_file": ", ".join(method_test_files),
+            "passed": True,
+            "coverage": None,
+        }
+    remove_test_files(test_file, method_test_files)
+    return {
+        "test_file": test_file,
+        "passed": test_output["returncode"] == 0,
+        "coverage": coverage["percent"] if coverage else None,
+    }
 
-    print(f"Code for {name} found successfully")
 
-    return code, source_path
+def split_class(file_name, class_name):
+    """
+    Reads a class to be tested method by method.
 
+    Returns:
+        tuple: The source code of the class, the absolute path of its file,
+            its skeleton (see ``class_skeleton``) and the qualified names of
+            its methods.
+    """
+    class_code, function_filename = read_class_or_method(file_name, class_name)
+    skeleton = class_skeleton(function_filename, class_name)
+    methods = list_class_methods(function_filename, class_name)
+    logging.info(f"Splitting {class_name} into {len(methods)} method jobs")
+    return class_code, function_filename, skeleton, methods
+
+
+def read_method(function_filename, qualname, context_tokens):
+    """
+    Reads one method of a split class.
+
+    Returns:
+        tuple: The source code of the method and its module context (see ``dependency_slice``).
+    """
+    method_code, _ = read_class_or_method(function_filename, qualname)
+    return method_code, dependency_slice(function_filename, qualname, context_tokens)
+
+
+def repair_class_methods(
+    file_name,
+    class_name,
+    client=None,
+    pipeline="three_step",
+    coverage_threshold=None,
+    context_tokens=DEFAULT_CONTEXT_TOKENS,
+    jobs=1,
+):
+    """
+    Runs the repair loop for every method of a class on its own and merges the tests.
+
+    The methods share one explanation of the class skeleton and run on up to
+    ``jobs`` worker threads; a method whose loop fails is logged and skipped.
+
+    Returns:
+        dict: See ``merge_method_tests``.
+    """
+    class_code, function_filename, skeleton, methods = split_class(file_name, class_name)
+
+    def run_method(qualname):
+        try:
+            method_code, context = read_method(function_filename, qualname, context_tokens)
+            return repair_loop(
+                method_code,
+                function_filename,
+                client=client,
+                pipeline=pipeline,
+                coverage_threshold=coverage_threshold,
+                context=context,
+                class_skeleton=skeleton,
+                qualname=qualname,
+            )
+        except Exception:
+            logging.exception(f"Test generation failed for {qualname}")
+            return None
 
-def print_test_file():
-    output_file = os.path.join(os.getcwd(), "tests/unit/test_functions.py")
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(methods)))) as pool:
+        method_results = [result for result in pool.map(run_method, methods) if result]
+    return merge_method_tests(function_filename, class_code, method_results)
+
+
+def run_target(
+    file_name,
+    class_or_method,
+    client=None,
+    pipeline="three_step",
+    coverage_threshold=None,
+    context_tokens=DEFAULT_CONTEXT_TOKENS,
+    split_methods=False,
+    method_jobs=1,
+):
+    """
+    Runs the repair loop for one target and never raises.
+
+    The prompts show the target with the module definitions it depends on,
+    limited to ``context_tokens`` (0 shows the target alone). With
+    ``split_methods``, a class is tested method by method on ``method_jobs``
+    threads, see ``repair_class_methods``.
+
+    Returns:
+        dict: The target, whether its tests passed, the test file, the elapsed time and any error.
+    """
+    start = time.perf_counter()
+    result = {"file_name": file_name, "class_or_method": class_or_method}
+    try:
+        with get_telemetry().stage("target", target=f"{file_name}:{class_or_method}"):
+            if split_methods and list_class_methods(file_name, class_or_method):
+                result.update(
+                    repair_class_methods(
+                        file_name,
+                        class_or_method,
+                        client=client,
+                        pipeline=pipeline,
+                        coverage_threshold=coverage_threshold,
+                        context_tokens=context_tokens,
+                        jobs=method_jobs,
+                    )
+                )
+            else:
+                function_to_test, function_filename = read_class_or_method(
+                    file_name, class_or_method
+                )
+                context = dependency_slice(function_filename, class_or_method, context_tokens)
+                result.update(
+                    repair_loop(
+                        function_to_test,
+                        function_filename,
+                        client=client,
+                        pipeline=pipeline,
+                        coverage_threshold=coverage_threshold,
+                        context=context,
+                        qualname=class_or_method,
+                    )
+                )
+        result["error"] = None
+    except Exception as e:
+        logging.exception(f"Test generation failed for {file_name}:{class_or_method}")
+        result.update(
+            {"test_file": None, "passed": False, "coverage": None, "error": repr(e)}
+        )
+    result["elapsed"] = time.perf_counter() - start
+    return result
+
+
+def run_batch(
+    targets,
+    jobs=1,
+    client=None,
+    pipeline="three_step",
+    coverage_threshold=None,
+    context_tokens=DEFAULT_CONTEXT_TOKENS,
+    split_methods=False,
+    method_jobs=1,
+):
+    """
+    Runs the repair loop for many targets on a bounded pool of worker threads.
+
+    The workers spend most of their time waiting for the LLM or pytest, so
+    threads let these waits overlap within a single interpreter.
+
+    Args:
+        targets (list): (file_name, class_or_method) pairs.
+        jobs (int): Number of targets processed concurrently.
+        client (OpenAI, optional): The client shared by all workers.
+        pipeline (str): "three_step" or "fused", see ``unittest_flow``.
+        coverage_threshold (float, optional): Coverage in percent to reach, see ``repair_loop``.
+        context_tokens (int): Token budget of the module context, see ``run_target``.
+        split_methods (bool): Test classes method by method, see ``run_target``.
+        method_jobs (int): Number of methods of a split class processed
+            concurrently; up to ``jobs * method_jobs`` repair loops run at once.
+
+    Returns:
+        list: One result dict per target, in the order of ``targets``.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [
+            pool.submit(
+                run_target,
+                file_name,
+                class_or_method,
+                client,
+                pipeline,
+                coverage_threshold,
+                context_tokens,
+                split_methods,
+                method_jobs,
+            )
+            for file_name, class_or_method in targets
+        ]
+        return [future.result() for future in futures]
+
+
+def print_batch_summary(results):
+    """Prints one line per target and the overall pass count."""
+    print(
+        f"\n{'target':<60} {'status':<8} {'coverage':>8} {'time':>8}  test file / error"
+    )
+    for result in results:
+        target = f"{os.path.basename(result['file_name'])}:{result['class_or_method']}"
+        if result["error"]:
+            status, detail = "ERROR", result["error"]
+        else:
+            status = "PASSED" if result["passed"] else "FAILED"
+            detail = result["test_file"]
+        coverage = "-" if result["coverage"] is None else f"{result['coverage']:.1f}%"
+        print(
+            f"{target:<60} {status:<8} {coverage:>8} {result['elapsed']:>7.1f}s  {detail}"
+        )
+    passed = sum(1 for result in results if result["passed"])
+    print(f"\n{passed}/{len(results)} targets passed")
+
+
+def print_test_file(output_file=None):
+    if output_file is None:
+        output_file = os.path.join(os.getcwd(), "tests/unit/test_functions.py")
 
     if not os.path.exists(output_file):
         print(f"The file {output_file} does not exist.")
@@ -127,106 +478,799 @@ def print_test_file():
     print(content)
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Description of your script")
-    parser.add_argument("--file_name", type=str, required=True, help="User input")
-    parser.add_argument(
-        "--class_or_method", type=str, required=True, help="Underlying repository"
+def log_repair_iteration(iteration, rerun_ids, confirmed, elapsed, test_output):
+    """
+    Log which tests one repair iteration ran, how long it took and how they did.
+
+    Args:
+        iteration (int): The number of the iteration, starting at 1.
+        rerun_ids (list): The previously failing node IDs rerun first, or None.
+        confirmed (bool): Whether the full suite was run after they passed.
+        elapsed (float): The wall time of the test runs in seconds.
+        test_output (dict): The result of the last test run.
+    """
+    if rerun_ids is None:
+        scope = "full suite"
+    elif confirmed:
+        scope = f"{len(rerun_ids)} previously failing tests, then the full suite"
+    else:
+        scope = f"{len(rerun_ids)} previously failing tests"
+    coverage = test_output.get("coverage")
+    logging.info(
+        f"Repair iteration {iteration}: ran {scope} in {elapsed:.2f}s - "
+        f"{describe_results(test_output)}"
+        + (f", {describe_coverage(coverage)}" if coverage else "")
     )
 
-    args = parser.parse_args()
-    file_name = args.file_name
-    class_or_method = args.class_or_method
 
-    print(f"file_name: {file_name}")
-    print(f"class_or_method: {class_or_method}")
+def repair_steps(function_to_test, function_filename, coverage_threshold=None, qualname=None):
+    """
+    The decisions of the repair loop, shared by ``repair_loop`` and ``arepair_loop``.
 
-    # function_to_test, function_filename = read_class_or_method(
-    #     "inventory_manager.py", "InventoryManager"
-    # )
-    function_to_test, function_filename = read_class_or_method(
-        file_name, class_or_method
-    )
+    A generator yielding the I/O steps of the loop as (step, kwargs) pairs
+    and receiving their results, so the sync and the async loop only differ
+    in how they perform the steps:
+
+    - ``generate``: generate the tests (``unittest_flow``), returns the test file;
+    - ``run``: run them (``run_pytest``), returns the test output;
+    - ``extend``: add tests of the uncovered code (``extend_tests_for_coverage``);
+    - ``read_tests`` and ``merge_tests``: keep the passing tests of a
+      regenerated module (``read_test_file`` and ``merge_test_file``);
+    - ``correct``: correct the target (``correct_function``).
+
+    Args:
+        function_to_test (str): The source code of the class or method.
+        function_filename (str): The absolute path of the file defining it.
+        coverage_threshold (float, optional): See ``repair_loop``.
+        qualname (str, optional): See ``repair_loop``.
+
+    Returns:
+        dict: The result of the loop, see ``repair_loop``.
+    """
     logging.info("Starting test generation and correction loop...")
+    telemetry = get_telemetry()
     # Generate the tests with 100% code coverage
-    test_file = unittest_flow(
-        function_to_test,
-        function_filename,
-        approx_min_cases_to_cover=10,
-        reruns_if_fail=5,
-        print_text=False,
-        explain_model=explain_model,
-        plan_model=plan_model,
-        execute_model=execute_model,
-    )
+    test_file = yield "generate", {"function_to_test": function_to_test, "reruns_if_fail": 5}
 
+    passed = False
     previous_failed_cases = None
     failed_cases_changed = 0
     failed_cases_changed_max = 3
 
+    # After a correction only the tests that failed are rerun, until they pass
+    rerun_ids = None
+    iteration = 0
+    loop_start = time.perf_counter()
+    # Once the tests pass, tests of the uncovered code are added until the threshold is met
+    coverage = None
+    previous_percent = None
+    coverage_rounds = 0
+    coverage_rounds_max = 3
+
     idx = 3
     ref_idx = idx
     while idx > 0:
-        # Run the tests
-        test_output = run_pytest(test_file)
-
-        # logging.info(50 * "#")
-        # logging.info(50 * "\n")
-        # print(test_output)
-        # logging.info(50 * "\n")
-        # logging.info(50 * "#")
-
-        if test_output["returncode"] == 0:
-            logging.info("All tests passed successfully!")
-            break
-
-        failed_test_cases = extract_failed_test_cases(test_output)
-
-        logging.info(50 * "#")
-        logging.info("failed_test_cases:")
-        print(failed_test_cases)
-        logging.info(50 * "#")
-
-        if previous_failed_cases == failed_test_cases:
-            failed_cases_changed += 1
-            logging.warning(
-                f"Try {failed_cases_changed} - No change in failed test cases after correction. Reviewing test feasibility..."
+        with telemetry.stage("repair_iteration"):
+            iteration += 1
+            # Run the tests
+            start = time.perf_counter()
+            # Coverage is only measured on runs of the whole suite
+            target = coverage_target(function_filename, function_to_test)
+            test_output = yield "run", {
+                "test_file": test_file,
+                "node_ids": rerun_ids,
+                "coverage": None if rerun_ids is not None else target,
+            }
+            confirmed = False
+            if rerun_ids is not None and test_output["returncode"] in (0, 4, 5):
+                # The previous failures pass (or could not be selected): run everything
+                test_output = yield "run", {"test_file": test_file, "coverage": target}
+                confirmed = True
+            log_repair_iteration(
+                iteration, rerun_ids, confirmed, time.perf_counter() - start, test_output
             )
-            # Additional logic to handle unchanged tests or regenerate tests
-
-        if failed_cases_changed == failed_cases_changed_max:
-            logging.info("Regenerating or analyzing tests due to repeated failures.")
-            # Generate the tests again and hope for new better tests
-            test_file = unittest_flow(
-                function_to_test,
-                function_filename,  # Ensure the filename is passed
-                approx_min_cases_to_cover=10,
-                print_text=False,
-                explain_model=explain_model,
-                plan_model=plan_model,
-                execute_model=execute_model,
-                temperature=0.4 + 0.6 * failed_cases_changed / failed_cases_changed_max,
+            coverage = test_output.get("coverage") or coverage
+
+            if test_output["returncode"] == 0:
+                if (
+                    coverage_threshold is None
+                    or coverage is None
+                    or (coverage["percent"] is not None and coverage["percent"] >= coverage_threshold)
+                ):
+                    logging.info("All tests passed successfully!")
+                    passed = True
+                    break
+                if (
+                    coverage_rounds == coverage_rounds_max
+                    # Nothing of the target was measured, there are no gaps to ask about
+                    or coverage["percent"] is None
+                    or (previous_percent is not None and coverage["percent"] <= previous_percent)
+                ):
+                    logging.warning(
+                        f"All tests passed, but {describe_coverage(coverage)} stays below "
+                        f"the threshold of {coverage_threshold}%."
+                    )
+                    passed = True
+                    break
+                logging.info(
+                    f"All tests passed with {describe_coverage(coverage)} - "
+                    "asking for tests of the uncovered code."
+                )
+                coverage_rounds += 1
+                previous_percent = coverage["percent"]
+                extended = yield "extend", {
+                    "function_to_test": function_to_test,
+                    "test_file": test_file,
+                    "coverage": coverage,
+                }
+                if not extended:
+                    # Nothing new to run, the coverage cannot change
+                    passed = True
+                    break
+                rerun_ids = None
+                continue
+
+            failed_test_cases = extract_failed_test_cases(test_output)
+
+            logging.info(50 * "#")
+            logging.info("failed_test_cases:")
+            print(format_failures(failed_test_cases))
+            logging.info(50 * "#")
+
+            if failure_signature(previous_failed_cases) == failure_signature(
+                failed_test_cases
+            ):
+                failed_cases_changed += 1
+                logging.warning(
+                    f"Try {failed_cases_changed} - No change in failed test cases after correction. Reviewing test feasibility..."
+                )
+                # Additional logic to handle unchanged tests or regenerate tests
+
+            if failed_cases_changed == failed_cases_changed_max:
+                logging.info("Regenerating or analyzing tests due to repeated failures.")
+                # Generate the tests again and hope for new better tests; the ones
+                # that passed are kept and the new ones merged into them
+                previous_tests = yield "read_tests", {"test_file": test_file}
+                test_file = yield "generate", {
+                    "function_to_test": function_to_test,
+                    "temperature": 0.4 + 0.6 * failed_cases_changed / failed_cases_changed_max,
+                }
+                yield "merge_tests", {
+                    "test_file": test_file,
+                    "previous_code": previous_tests,
+                    "drop": failing_test_names(failed_test_cases),
+                }
+                idx = ref_idx
+                failed_cases_changed = 0
+                rerun_ids = None
+                continue
+
+            logging.info("Different failed cases after correction - try to correct again.")
+            # Correct the function based on the test results
+            corrected_function, _ = yield "correct", {
+                "function_to_test": function_to_test,
+                "function_filename": function_filename,
+                "test_results": test_output,
+                "failed_test_cases": failed_test_cases,
+                "temperature": 0.4 + 0.1 * failed_cases_changed,
+                "qualname": qualname,
+            }
+            logging.debug(f"Corrected function:\n{corrected_function}")
+
+            function_to_test = corrected_function  # Update the function to test with the corrected function
+            previous_failed_cases = failed_test_cases  # Update the record of failed cases
+            rerun_ids = rerun_node_ids(failed_test_cases)
+            idx -= 1
+
+    logging.info(
+        f"Test generation and correction loop completed after {iteration} iterations "
+        f"in {time.perf_counter() - loop_start:.1f}s."
+    )
+    return {
+        "test_file": test_file,
+        "passed": passed,
+        "coverage": coverage["percent"] if coverage else None,
+    }
+
+
+def repair_loop(
+    function_to_test,
+    function_filename,
+    client=None,
+    pipeline="three_step",
+    coverage_threshold=None,
+    context=None,
+    class_skeleton=None,
+    qualname=None,
+):
+    """
+    Generates unit tests for a class or method and corrects it until they pass.
+
+    Args:
+        function_to_test (str): The source code of the class or method.
+        function_filename (str): The absolute path of the file defining it.
+        client (OpenAI, optional): The client shared by all stages.
+        pipeline (str): "three_step" or "fused", see ``unittest_flow``.
+        coverage_threshold (float, optional): Line and branch coverage of the
+            target in percent; once the tests pass, tests of the uncovered code
+            are requested until it is reached. Coverage is only reported if unset.
+        context (str, optional): The module definitions the target depends on,
+            shown with it in the generation prompts (see ``dependency_slice``).
+        class_skeleton (str, optional): For a method tested on its own, the
+            skeleton of its class, whose explanation all its methods share.
+        qualname (str, optional): The plain or qualified name of the target
+            in ``function_filename``; corrections only replace its definition.
+
+    Returns:
+        dict: The path of the generated test file, whether all tests passed and
+            the coverage of the target in percent.
+    """
+    steps = repair_steps(function_to_test, function_filename, coverage_threshold, qualname)
+    actions = {
+        "generate": lambda **kwargs: unittest_flow(
+            function_filename=function_filename,
+            approx_min_cases_to_cover=10,
+            print_text=False,
+            explain_model=explain_model,
+            plan_model=plan_model,
+            execute_model=execute_model,
+            stream=True,
+            client=client,
+            pipeline=pipeline,
+            context=context,
+            class_skeleton=class_skeleton,
+            **kwargs,
+        ),
+        "run": run_pytest,
+        "extend": lambda **kwargs: extend_tests_for_coverage(
+            execute_model=execute_model, client=client, **kwargs
+        ),
+        "read_tests": read_test_file,
+        "merge_tests": merge_test_file,
+        "correct": lambda **kwargs: correct_function(
+            correct_model=correct_model, client=client, **kwargs
+        ),
+    }
+    result = None
+    while True:
+        try:
+            step, kwargs = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result = actions[step](**kwargs)
+
+
+async def arepair_loop(
+    function_to_test,
+    function_filename,
+    client,
+    semaphore=None,
+    pipeline="three_step",
+    coverage_threshold=None,
+    context=None,
+    class_skeleton=None,
+    qualname=None,
+):
+    """
+    Async counterpart of ``repair_loop``.
+
+    Args:
+        function_to_test (str): The source code of the class or method.
+        function_filename (str): The absolute path of the file defining it.
+        client (AsyncOpenAI): The async client shared by all targets.
+        semaphore (asyncio.Semaphore, optional): Bounds the concurrent LLM requests.
+        pipeline (str): "three_step" or "fused", see ``unittest_flow``.
+        coverage_threshold (float, optional): Coverage to reach, see ``repair_loop``.
+        context (str, optional): Module context of the target, see ``repair_loop``.
+        class_skeleton (str, optional): See ``repair_loop``.
+        qualname (str, optional): See ``repair_loop``.
+
+    Returns:
+        dict: The path of the generated test file, whether all tests passed and
+            the coverage of the target in percent.
+    """
+    steps = repair_steps(function_to_test, function_filename, coverage_threshold, qualname)
+    actions = {
+        "generate": lambda **kwargs: aunittest_flow(
+            function_filename=function_filename,
+            client=client,
+            approx_min_cases_to_cover=10,
+            explain_model=explain_model,
+            plan_model=plan_model,
+            execute_model=execute_model,
+            stream=True,
+            semaphore=semaphore,
+            pipeline=pipeline,
+            context=context,
+            class_skeleton=class_skeleton,
+            **kwargs,
+        ),
+        "run": arun_pytest,
+        "extend": lambda **kwargs: aextend_tests_for_coverage(
+            client=client, execute_model=execute_model, semaphore=semaphore, **kwargs
+        ),
+        # File I/O and parsing stay off the event loop
+        "read_tests": lambda **kwargs: asyncio.to_thread(read_test_file, **kwargs),
+        "merge_tests": lambda **kwargs: asyncio.to_thread(merge_test_file, **kwargs),
+        "correct": lambda **kwargs: acorrect_function(
+            client=client, correct_model=correct_model, semaphore=semaphore, **kwargs
+        ),
+    }
+    result = None
+    while True:
+        try:
+            step, kwargs = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result = await actions[step](**kwargs)
+
+
+async def arepair_class_methods(
+    file_name,
+    class_name,
+    client,
+    semaphore=None,
+    pipeline="three_step",
+    coverage_threshold=None,
+    context_tokens=DEFAULT_CONTEXT_TOKENS,
+    jobs=1,
+):
+    """
+    Async counterpart of ``repair_class_methods``; up to ``jobs`` methods run concurrently.
+
+    Returns:
+        dict: See ``merge_method_tests``.
+    """
+    class_code, function_filename, skeleton, methods = await asyncio.to_thread(
+        split_class, file_name, class_name
+    )
+    method_semaphore = asyncio.Semaphore(max(1, jobs))
+
+    async def run_method(qualname):
+        async with method_semaphore:
+            try:
+                method_code, context = await asyncio.to_thread(
+                    read_method, function_filename, qualname, context_tokens
+                )
+                return await arepair_loop(
+                    method_code,
+                    function_filename,
+                    client,
+                    semaphore=semaphore,
+                    pipeline=pipeline,
+                    coverage_threshold=coverage_threshold,
+                    context=context,
+                    class_skeleton=skeleton,
+                    qualname=qualname,
+                )
+            except Exception:
+                logging.exception(f"Test generation failed for {qualname}")
+                return None
+
+    method_results = await asyncio.gather(*(run_method(qualname) for qualname in methods))
+    return await asyncio.to_thread(
+        merge_method_tests,
+        function_filename,
+        class_code,
+        [result for result in method_results if result],
+    )
+
+
+async def agenerate_tests(
+    targets,
+    max_concurrency=16,
+    pool_size=None,
+    pipeline="three_step",
+    coverage_threshold=None,
+    context_tokens=DEFAULT_CONTEXT_TOKENS,
+    split_methods=False,
+    method_jobs=1,
+    client=None,
+):
+    """
+    Runs the async repair loop for many targets on one event loop.
+
+    Args:
+        targets (list): (file_name, class_or_method) pairs.
+        max_concurrency (int): Maximum number of LLM requests in flight.
+        pool_size (int, optional): Connections of the async client (defaults to max_concurrency).
+        pipeline (str): "three_step" or "fused", see ``unittest_flow``.
+        coverage_threshold (float, optional): Coverage to reach, see ``repair_loop``.
+        context_tokens (int): Token budget of the module context, see ``run_target``.
+        split_methods (bool): Test classes method by method, see ``arepair_class_methods``.
+        method_jobs (int): Number of methods of a split class processed concurrently.
+        client (AsyncOpenAI, optional): The async client of all targets, left
+            open. Defaults to one configured like the sync client (see
+            ``get_async_client``), e.g. the recording or replaying client of
+            ``--record``/``--replay`` and the ``--request_timeout``.
+
+    Returns:
+        list: One result dict per target, in the order of ``targets``, see ``run_target``.
+    """
+    owns_client = client is None
+    if owns_client:
+        client = get_async_client(pool_size=pool_size or max_concurrency)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_target(file_name, class_or_method):
+        # Same result as the sync run_target, it never raises either
+        start = time.perf_counter()
+        result = {"file_name": file_name, "class_or_method": class_or_method}
+        try:
+            with get_telemetry().stage("target", target=f"{file_name}:{class_or_method}"):
+                if split_methods and await asyncio.to_thread(
+                    list_class_methods, file_name, class_or_method
+                ):
+                    result.update(
+                        await arepair_class_methods(
+                            file_name,
+                            class_or_method,
+                            client,
+                            semaphore=semaphore,
+                            pipeline=pipeline,
+                            coverage_threshold=coverage_threshold,
+                            context_tokens=context_tokens,
+                            jobs=method_jobs,
+                        )
+                    )
+                else:
+                    # Reading and parsing the source is CPU-bound, keep it off the event loop
+                    function_to_test, function_filename = await asyncio.to_thread(
+                        read_class_or_method, file_name, class_or_method
+                    )
+                    context = await asyncio.to_thread(
+                        dependency_slice, function_filename, class_or_method, context_tokens
+                    )
+                    result.update(
+                        await arepair_loop(
+                            function_to_test,
+                            function_filename,
+                            client,
+                            semaphore=semaphore,
+                            pipeline=pipeline,
+                            coverage_threshold=coverage_threshold,
+                            context=context,
+                            qualname=class_or_method,
+                        )
+                    )
+            result["error"] = None
+        except Exception as e:
+            logging.exception(f"Test generation failed for {file_name}:{class_or_method}")
+            result.update(
+                {"test_file": None, "passed": False, "coverage": None, "error": repr(e)}
             )
-            idx = ref_idx
-            failed_cases_changed = 0
-            continue
+        result["elapsed"] = time.perf_counter() - start
+        return result
+
+    try:
+        return await asyncio.gather(
+            *(run_target(file_name, name) for file_name, name in targets)
+        )
+    finally:
+        if owns_client:
+            await client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Description of your script")
+    parser.add_argument("--file_name", type=str, help="User input")
+    parser.add_argument("--class_or_method", type=str, help="Underlying repository")
+    parser.add_argument(
+        "--targets",
+        type=str,
+        nargs="+",
+        help="Batch mode: targets of the form file.py:ClassOrFunction",
+    )
+    parser.add_argument(
+        "--module",
+        type=str,
+        action="append",
+        help="Batch mode: every class and function of this file (repeatable)",
+    )
+    parser.add_argument(
+        "--directory",
+        type=str,
+        action="append",
+        help="Batch mode: every class and function of every module below this directory (repeatable)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of targets processed in parallel",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Bypass the persistent LLM response cache",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the persistent LLM response cache",
+    )
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        default=None,
+        help="Number of keep-alive connections of the shared OpenAI client",
+    )
+    parser.add_argument(
+        "--request_timeout",
+        type=float,
+        default=None,
+        help="Seconds before an LLM request is abandoned and retried (client default if unset)",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=float,
+        default=None,
+        help="Requests per minute allowed by the account (unlimited if unset)",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=float,
+        default=None,
+        help="Tokens per minute allowed by the account (unlimited if unset)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        type=str,
+        choices=PIPELINES,
+        default="three_step",
+        help="Separate explain/plan/execute requests or one fused request per target",
+    )
+    parser.add_argument(
+        "--coverage_threshold",
+        type=float,
+        default=None,
+        help="Line and branch coverage of each target in percent; once the tests pass, "
+        "tests of the uncovered code are requested until it is reached",
+    )
+    parser.add_argument(
+        "--cold_pytest",
+        action="store_true",
+        help="Start a fresh pytest process per test run instead of reusing warm workers",
+    )
+    parser.add_argument(
+        "--test_timeout",
+        type=float,
+        default=None,
+        help="Seconds a single generated test may run (default 10, 0 disables)",
+    )
+    parser.add_argument(
+        "--run_timeout",
+        type=float,
+        default=None,
+        help="Seconds a whole pytest run may take before it is killed (default 300, 0 disables)",
+    )
+    parser.add_argument(
+        "--cpu_seconds",
+        type=int,
+        default=None,
+        help="CPU seconds of a pytest run (default 120, 0 disables)",
+    )
+    parser.add_argument(
+        "--memory_mb",
+        type=int,
+        default=None,
+        help="Memory in MiB a pytest run may allocate (default 2048, 0 disables)",
+    )
+    parser.add_argument(
+        "--split_methods",
+        action="store_true",
+        help="Generate the tests of a class per method, in parallel, and merge them into one module",
+    )
+    parser.add_argument(
+        "--async",
+        dest="async_mode",
+        action="store_true",
+        help="Run all targets on one event loop with the async client instead of worker threads; "
+        "--jobs (times --method_jobs) bounds the LLM requests in flight",
+    )
+    parser.add_argument(
+        "--method_jobs",
+        type=int,
+        default=1,
+        help="Number of methods of a class processed in parallel with --split_methods, per target",
+    )
+    parser.add_argument(
+        "--changed",
+        action="store_true",
+        help="Only run the targets whose code changed since their tests last passed, and their direct dependents",
+    )
+    parser.add_argument(
+        "--changed_since",
+        type=str,
+        default=None,
+        help="Only run the targets whose code changed since this git revision, and their direct dependents",
+    )
+    parser.add_argument(
+        "--run_state",
+        type=str,
+        default=None,
+        help="File recording the code of the targets whose tests passed (default .llm_cache/last_run.json)",
+    )
+    parser.add_argument(
+        "--context_tokens",
+        type=int,
+        default=DEFAULT_CONTEXT_TOKENS,
+        help="Token budget for the module definitions the target uses, shown with it in the prompts (0 disables)",
+    )
+    parser.add_argument(
+        "--index_jobs",
+        type=int,
+        default=None,
+        help="Processes parsing changed modules into the symbol index (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--report_file",
+        type=str,
+        default=DEFAULT_REPORT_FILE,
+        help="Where to write the JSON report with per-stage timings, tokens and cost",
+    )
+    parser.add_argument(
+        "--prometheus_file",
+        type=str,
+        default=None,
+        help="Also write the per-stage metrics in the Prometheus text format to this file",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="Record every LLM request/response pair of the run into this cassette file",
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="Serve the LLM responses from this cassette file instead of the API",
+    )
+    parser.add_argument(
+        "--replay_latency",
+        type=str,
+        default="0",
+        help="Seconds to wait per replayed response, or 'recorded' to reproduce the recorded latency",
+    )
 
-        logging.info("Different failed cases after correction - try to correct again.")
-        # Correct the function based on the test results
-        corrected_function, _ = correct_function(
-            function_to_test,
-            function_filename,
-            test_output,
-            failed_test_cases,
-            correct_model=correct_model,
-            temperature=0.4 + 0.1 * failed_cases_changed,
+    args = parser.parse_args(argv)
+    if bool(args.file_name) != bool(args.class_or_method):
+        parser.error("--file_name and --class_or_method must be given together")
+    if args.changed and args.changed_since:
+        parser.error("--changed and --changed_since are mutually exclusive")
+    targets = collect_targets(args)
+    if not targets:
+        # Incremental runs too, the default package would be this tool itself
+        parser.error(
+            "no target given, use --file_name/--class_or_method, --targets, --module or --directory"
         )
-        logging.debug(f"Corrected function:\n{corrected_function}")
+    targets = [(resolve_source_path(file_name), name) for file_name, name in targets]
+    if args.changed or args.changed_since:
+        try:
+            targets, _ = select_changed_targets(
+                targets, revision=args.changed_since, state_file=args.run_state
+            )
+        except ValueError as e:
+            parser.error(str(e))
+        if not targets:
+            logging.info("No target changed, nothing to do")
+            get_symbol_index().save()
+            return
+    if args.record and args.replay:
+        parser.error("--record and --replay are mutually exclusive")
+    replay_latency = None
+    if args.replay_latency != "recorded":
+        try:
+            replay_latency = float(args.replay_latency)
+        except ValueError:
+            parser.error("--replay_latency must be a number of seconds or 'recorded'")
 
-        function_to_test = corrected_function  # Update the function to test with the corrected function
-        previous_failed_cases = failed_test_cases  # Update the record of failed cases
+    # A cassette has to see every request, so cached responses are not used
+    bypass_cache = args.no_cache or bool(args.record or args.replay)
+    response_cache = configure_response_cache(
+        directory=args.cache_dir, bypass=True if bypass_cache else None
+    )
+    configure_ast_memo(bypass=True if bypass_cache else None)
+    # Method jobs only run for split classes, each of them on one target worker
+    method_jobs = max(1, args.method_jobs) if args.split_methods else 1
+    client_kwargs = {}
+    if args.request_timeout is not None:
+        client_kwargs["timeout"] = args.request_timeout
+    client = configure_client(
+        pool_size=args.pool_size or max(args.jobs * method_jobs, DEFAULT_POOL_SIZE), **client_kwargs
+    )
+    if args.record:
+        client = RecordingClient(client, args.record)
+        set_client(client)
+    elif args.replay:
+        client = ReplayClient(args.replay, latency=replay_latency)
+        set_client(client)
+    rate_limiter = configure_rate_limiter(
+        requests_per_minute=args.rpm, tokens_per_minute=args.tpm
+    )
+    telemetry = configure_telemetry()
+    configure_pytest_runner(warm=False if args.cold_pytest else None)
+    configure_resource_limits(
+        test_timeout=args.test_timeout,
+        run_timeout=args.run_timeout,
+        cpu_seconds=args.cpu_seconds,
+        memory_mb=args.memory_mb,
+    )
+
+    if len(targets) == 1:
+        file_name, class_or_method = targets[0]
+        print(f"file_name: {file_name}")
+        print(f"class_or_method: {class_or_method}")
+    elif args.async_mode:
+        logging.info(
+            f"Batch mode: {len(targets)} targets on one event loop, "
+            f"up to {args.jobs * method_jobs} LLM requests in flight"
+        )
+    else:
+        logging.info(f"Batch mode: {len(targets)} targets on {args.jobs} workers")
 
-    logging.info("Test generation and correction loop completed.")
+    if args.async_mode:
+        results = asyncio.run(
+            agenerate_tests(
+                targets,
+                max_concurrency=max(1, args.jobs * method_jobs),
+                pool_size=args.pool_size or max(args.jobs * method_jobs, DEFAULT_POOL_SIZE),
+                pipeline=args.pipeline,
+                coverage_threshold=args.coverage_threshold,
+                context_tokens=args.context_tokens,
+                split_methods=args.split_methods,
+                method_jobs=method_jobs,
+            )
+        )
+    else:
+        results = run_batch(
+            targets,
+            jobs=args.jobs,
+            client=client,
+            pipeline=args.pipeline,
+            coverage_threshold=args.coverage_threshold,
+            context_tokens=args.context_tokens,
+            split_methods=args.split_methods,
+            method_jobs=method_jobs,
+        )
+    if len(targets) > 1:
+        print_batch_summary(results)
+    # The code that passed, including the corrections of the repair loop
+    passed = {}
+    for result in results:
+        if not result["passed"]:
+            continue
+        symbol = get_symbol_index().lookup(result["file_name"], result["class_or_method"])
+        if symbol is not None:
+            passed[(result["file_name"], symbol["qualname"])] = symbol["ast_hash"]
+    logging.info(
+        f"Recorded {len(passed)} passing targets in {record_passed_targets(passed, args.run_state)}"
+    )
+
+    cache_stats = response_cache.stats()
+    logging.info(
+        f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses"
+    )
+    pipeline_stats = get_pipeline_stats()
+    logging.info(
+        f"Pipeline: {pipeline_stats['parse_failures']} parse failures, {pipeline_stats['execute_retries']} execute-only retries, "
+        f"{pipeline_stats['coalesced_requests']} coalesced requests, {pipeline_stats['memo_hits']} explain/plan steps re-used"
+    )
+    limiter_stats = rate_limiter.stats()
+    logging.info(
+        f"Rate limiter: {limiter_stats['rate_limited']} rate-limited responses, {limiter_stats['retries']} retries"
+    )
+    if args.record:
+        logging.info(f"Recorded {client.recorded} responses to {args.record}")
+    symbol_index = get_symbol_index()
+    symbol_index.save()
+    logging.info(f"Symbol index: {symbol_index.parsed} files parsed, {len(symbol_index.files)} indexed")
+    telemetry.log_summary()
+    logging.info(f"Run report written to {telemetry.write_report(args.report_file)}")
+    if args.prometheus_file:
+        telemetry.write_prometheus(args.prometheus_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+import ast
+import hashlib
+import json
+import os
+import textwrap
+import threading
+
+from src.response_cache import ResponseCache
+
+DEFAULT_MEMO_DIR = os.path.join(os.getcwd(), ".llm_cache", "ast_memo")
+
+_DEFINITIONS = (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def _strip_docstrings(tree: ast.AST) -> ast.AST:
+    for node in ast.walk(tree):
+        if not isinstance(node, _DEFINITIONS) or not node.body:
+            continue
+        first = node.body[0]
+        if (
+            isinstance(first, ast.Expr)
+            and isinstance(first.value, ast.Constant)
+            and isinstance(first.value.value, str)
+        ):
+            node.body = node.body[1:] or [ast.Pass()]
+    return tree
+
+
+def normalized_ast_hash(source: str):
+    """
+    Hash the behavior-relevant structure of a piece of Python source.
+
+    Comments, formatting, indentation and docstrings do not change the hash;
+    any change to the code itself does.
+
+    Returns
+    -------
+    str or None
+        The SHA-256 of the normalized AST, or None if the source does not parse.
+    """
+    try:
+        tree = ast.parse(textwrap.dedent(source))
+    except SyntaxError:
+        return None
+    return _dump_hash(_strip_docstrings(tree))
+
+
+def source_hash(source: str) -> str:
+    """
+    Hash ``source`` like ``normalized_ast_hash``, or its raw text if it does not parse.
+
+    For keys that must change with the source even when it is not valid
+    Python, e.g. the module context shown in a prompt.
+    """
+    return normalized_ast_hash(source) or hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def definition_ast_hashes(tree: ast.Module) -> dict:
+    """
+    Hash every class and function of a parsed module like ``normalized_ast_hash``.
+
+    Lets a module be hashed per definition without unparsing and parsing
+    every definition again. The docstrings of ``tree`` are stripped in place.
+
+    Returns
+    -------
+    dict
+        The hash of every definition node, keyed by the node.
+    """
+    _strip_docstrings(tree)
+    return {
+        node: _dump_hash(ast.Module(body=[node], type_ignores=[]))
+        for node in ast.walk(tree)
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef))
+    }
+
+
+def _dump_hash(tree: ast.AST) -> str:
+    normalized = ast.dump(tree, include_attributes=False)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def memo_key(step: str, symbol_hash: str, model: str, temperature: float, **params) -> str:
+    """Return the key of a memoized pipeline step for the symbol with ``symbol_hash``."""
+    payload = json.dumps(
+        {
+            "step": step,
+            "symbol": symbol_hash,
+            "model": model,
+            "temperature": temperature,
+            **params,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+_ast_memo = None
+_ast_memo_lock = threading.Lock()
+
+
+def configure_ast_memo(directory: str = None, bypass: bool = None) -> ResponseCache:
+    """
+    Create the process-wide memo of explanations and plans keyed by normalized AST.
+
+    ``directory`` falls back to the ``UNITTEST_LLM_AST_MEMO_DIR`` environment
+    variable and ``bypass`` to ``UNITTEST_LLM_NO_CACHE``.
+    """
+    global _ast_memo
+    if directory is None:
+        directory = os.getenv("UNITTEST_LLM_AST_MEMO_DIR", DEFAULT_MEMO_DIR)
+    if bypass is None:
+        bypass = os.getenv("UNITTEST_LLM_NO_CACHE", "") not in ("", "0", "false")
+    with _ast_memo_lock:
+        _ast_memo = ResponseCache(directory=directory, bypass=bypass)
+    return _ast_memo
+
+
+def get_ast_memo() -> ResponseCache:
+    """Return the process-wide AST memo, creating it on first use."""
+    if _ast_memo is None:
+        return configure_ast_memo()
+    return _ast_memo
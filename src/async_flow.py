@@ -0,0 +1,622 @@
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+
+from openai.types.chat import ChatCompletion
+
+from src.ast_hash import get_ast_memo, memo_key, normalized_ast_hash, source_hash
+from src.coverage_guide import coverage_args
+from src.pytest_results import load_results, collector_command, summarize
+from src.pytest_worker import (
+    PytestRunTimeout,
+    PytestWorkerError,
+    run_pytest_in_worker,
+    subprocess_env,
+    warm_pytest_enabled,
+)
+from src.rate_limiter import RateLimiter, estimate_tokens, get_rate_limiter
+from src.resource_limits import get_resource_limits, limit_args, timed_out_result
+from src.response_cache import ResponseCache, get_response_cache
+from src.telemetry import get_telemetry
+from src.unittest_flow import (
+    FUSED_TESTS_HEADING,
+    PIPELINES,
+    append_coverage_tests,
+    assemble_completion,
+    build_correction_messages,
+    build_coverage_messages,
+    build_elaboration_message,
+    build_execute_messages,
+    build_explain_messages,
+    build_fused_messages,
+    build_plan_message,
+    build_syntax_repair_message,
+    count_pipeline_event,
+    count_plan_bullets,
+    definition_name,
+    estimated_usage,
+    extract_corrected_function,
+    find_code_block_end,
+    parse_fused_response,
+    parse_test_code,
+    target_test_file,
+    write_corrected_definition,
+    write_test_file,
+)
+
+
+async def _astream_completion(
+    client,
+    model: str,
+    messages: list,
+    temperature: float,
+    on_delta=None,
+    stop_at_code_end: bool = False,
+    code_block_after: str = None,
+) -> ChatCompletion:
+    chunks = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    content = ""
+    completion_id = None
+    created = None
+    usage = None
+    # End of the code block if the stream was cancelled at its closing fence
+    code_end = None
+    finish_reason = "stop"
+    try:
+        async for chunk in chunks:
+            completion_id = completion_id or chunk.id
+            created = created or chunk.created
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage.model_dump()
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if on_delta is not None:
+                on_delta(choice.delta)
+            if choice.delta.content:
+                content += choice.delta.content
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            if stop_at_code_end:
+                end = find_code_block_end(content, after=code_block_after)
+                if end != -1:
+                    logging.debug("Closing code fence received, cancelling the stream.")
+                    code_end = end
+                    break
+    finally:
+        await chunks.close()
+
+    if usage is None:
+        # The usage chunk comes last, a cancelled stream never receives it
+        usage = estimated_usage(messages, content)
+    if code_end is not None:
+        content = content[:code_end]
+    return assemble_completion(
+        completion_id, created, model, content, finish_reason, usage
+    )
+
+
+class AsyncSingleFlight:
+    """
+    Async counterpart of ``SingleFlight`` for the tasks of one event loop.
+
+    Waiters are shielded, so a cancelled waiter does not cancel the shared call.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key: str, fn):
+        """Await ``fn()`` unless an identical call is in flight; returns (result, shared)."""
+        task = self._calls.get(key)
+        if task is not None:
+            return await asyncio.shield(task), True
+        task = asyncio.ensure_future(fn())
+        self._calls[key] = task
+        task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task), False
+
+
+_async_single_flight = AsyncSingleFlight()
+
+
+async def achat_completion(
+    client,
+    model: str,
+    messages: list,
+    temperature: float,
+    cache: ResponseCache = None,
+    stream: bool = False,
+    on_delta=None,
+    stop_at_code_end: bool = False,
+    semaphore: asyncio.Semaphore = None,
+    rate_limiter: RateLimiter = None,
+    code_block_after: str = None,
+    single_flight: AsyncSingleFlight = None,
+) -> ChatCompletion:
+    """
+    Async counterpart of ``chat_completion``.
+
+    Cache lookups run in a worker thread and the network call is bounded by
+    ``semaphore`` (if given), so many targets can share one event loop without
+    exceeding the number of requests in flight. The rate limiter is shared
+    with the synchronous pipeline, identical in-flight requests share one call.
+    """
+    if cache is None:
+        cache = get_response_cache()
+    key = cache.key(model, messages, temperature)
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        logging.debug(f"Response cache hit for {model} request {key[:12]}")
+        response = ChatCompletion.model_validate(cached)
+        get_telemetry().record_completion(model, response, cached=True)
+        return response
+
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter()
+    if single_flight is None:
+        single_flight = _async_single_flight
+
+    async def request():
+        if stream:
+            return await _astream_completion(
+                client,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                on_delta=on_delta,
+                stop_at_code_end=stop_at_code_end,
+                code_block_after=code_block_after,
+            )
+        return await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=False,
+        )
+
+    async def fetch():
+        async with semaphore or contextlib.nullcontext():
+            response = await rate_limiter.acall(request, estimate_tokens(messages))
+        await asyncio.to_thread(cache.put, key, response.model_dump(mode="json"))
+        return response
+
+    response, shared = await single_flight.do(key, fetch)
+    if shared:
+        count_pipeline_event("coalesced_requests")
+    get_telemetry().record_completion(model, response, shared=shared)
+    return response
+
+
+async def amemoized_step(
+    memo: ResponseCache,
+    step: str,
+    symbol_hash: str,
+    model: str,
+    temperature: float,
+    complete,
+    **params,
+) -> str:
+    """Async counterpart of ``memoized_step``; ``complete`` returns an awaitable."""
+    if symbol_hash is None:
+        return await complete()
+    key = memo_key(step, symbol_hash, model, temperature, **params)
+    entry = await asyncio.to_thread(memo.get, key)
+    if entry is not None:
+        count_pipeline_event("memo_hits")
+        return entry["content"]
+    content = await complete()
+    await asyncio.to_thread(memo.put, key, {"content": content})
+    return content
+
+
+async def aexecute_test_generation(
+    client,
+    execute_model: str,
+    execute_messages: list,
+    temperature: float,
+    reruns_if_fail: int = 1,
+    cache: ResponseCache = None,
+    stream: bool = False,
+    semaphore: asyncio.Semaphore = None,
+    fused: bool = False,
+) -> str:
+    """Async counterpart of ``execute_test_generation``."""
+    if cache is None:
+        cache = get_response_cache()
+    attempt_messages = execute_messages
+    for attempt in range(reruns_if_fail + 1):
+        response = await achat_completion(
+            client,
+            model=execute_model,
+            messages=attempt_messages,
+            temperature=temperature,
+            cache=cache,
+            stream=stream,
+            stop_at_code_end=True,
+            semaphore=semaphore,
+            code_block_after=FUSED_TESTS_HEADING if fused and attempt == 0 else None,
+        )
+        execution = response.choices[0].message.content
+        if fused and attempt == 0:
+            execution_code = parse_fused_response(execution)["tests"] or execution
+        else:
+            execution_code = execution
+        code, error = await asyncio.to_thread(parse_test_code, execution_code)
+        if error is None:
+            break
+        logging.warning(f"Syntax error in generated code: {error}")
+        count_pipeline_event("parse_failures")
+        if attempt == reruns_if_fail:
+            cache.delete(cache.key(execute_model, execute_messages, temperature))
+            break
+        logging.info("Rerunning the execute step...")
+        count_pipeline_event("execute_retries")
+        get_telemetry().record_retry()
+        attempt_messages = attempt_messages + [
+            {"role": "assistant", "content": execution},
+            build_syntax_repair_message(error),
+        ]
+
+    if code is None:
+        raise ValueError("The execute step did not return a python code block.")
+    return code
+
+
+async def aunittest_flow(
+    function_to_test: str,
+    function_filename: str,
+    client,
+    unit_test_package: str = "pytest",
+    approx_min_cases_to_cover: int = 7,
+    explain_model: str = "gpt-3.5-turbo",
+    plan_model: str = "gpt-3.5-turbo",
+    execute_model: str = "gpt-3.5-turbo",
+    temperature: float = 0.3,
+    reruns_if_fail: int = 1,
+    stream: bool = False,
+    cache: ResponseCache = None,
+    semaphore: asyncio.Semaphore = None,
+    pipeline: str = "three_step",
+    memo: ResponseCache = None,
+    context: str = None,
+    class_skeleton: str = None,
+) -> str:
+    """
+    Async counterpart of ``unittest_flow``.
+
+    Parameters
+    ----------
+    client : AsyncOpenAI
+        The async client used for all requests of this target.
+    semaphore : asyncio.Semaphore, optional
+        Bounds the number of concurrent requests across all targets.
+
+    All other parameters are the same as for ``unittest_flow``.
+
+    Returns
+    -------
+    str
+        The path of the written test file.
+    """
+    if pipeline not in PIPELINES:
+        raise ValueError(f"Unknown pipeline '{pipeline}', expected one of {PIPELINES}")
+    if cache is None:
+        cache = get_response_cache()
+    telemetry = get_telemetry()
+
+    if pipeline == "fused":
+        fused_messages = build_fused_messages(
+            function_to_test,
+            function_filename,
+            unit_test_package,
+            approx_min_cases_to_cover,
+            context=context,
+            import_name=definition_name(class_skeleton) if class_skeleton else None,
+        )
+        logging.info("Running fused unit test generation.")
+        with telemetry.stage("fused"):
+            code = await aexecute_test_generation(
+                client,
+                execute_model,
+                fused_messages,
+                temperature,
+                reruns_if_fail=reruns_if_fail,
+                cache=cache,
+                stream=stream,
+                semaphore=semaphore,
+                fused=True,
+            )
+        return await asyncio.to_thread(
+            write_test_file,
+            code,
+            target_test_file(function_filename, function_to_test, class_skeleton),
+        )
+
+    if memo is None:
+        memo = get_ast_memo()
+    symbol_hash = await asyncio.to_thread(normalized_ast_hash, function_to_test)
+    context_params = {"context": source_hash(context)} if context else {}
+    explain_hash, explain_params = symbol_hash, context_params
+    if class_skeleton:
+        # One explanation of the skeleton is shared by all methods of the class
+        explain_hash, explain_params = source_hash(class_skeleton), {}
+        context_params = {**context_params, "skeleton": explain_hash}
+
+    async def complete(stage, model, messages, **params):
+        async def request():
+            response = await achat_completion(
+                client,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                cache=cache,
+                stream=stream,
+                semaphore=semaphore,
+            )
+            return response.choices[0].message.content
+
+        with telemetry.stage(stage):
+            if stage == "explain":
+                return await amemoized_step(
+                    memo, stage, explain_hash, model, temperature, request, **explain_params
+                )
+            return await amemoized_step(
+                memo, stage, symbol_hash, model, temperature, request, **params, **context_params
+            )
+
+    # Step 1: Generate an explanation of the function
+    explain_system_message, explain_user_message = build_explain_messages(
+        class_skeleton or function_to_test, None if class_skeleton else context
+    )
+    explanation = await complete(
+        "explain",
+        explain_model, [explain_system_message, explain_user_message]
+    )
+    explain_assistant_message = {"role": "assistant", "content": explanation}
+
+    # Step 2: Generate a plan to write a unit test
+    plan_user_message = build_plan_message(
+        unit_test_package,
+        method=function_to_test if class_skeleton else None,
+        context=context if class_skeleton else None,
+    )
+    plan_messages = [
+        explain_system_message,
+        explain_user_message,
+        explain_assistant_message,
+        plan_user_message,
+    ]
+    plan = await complete(
+        "plan",
+        plan_model,
+        plan_messages,
+        explain_model=explain_model,
+        unit_test_package=unit_test_package,
+    )
+    plan_assistant_message = {"role": "assistant", "content": plan}
+
+    num_bullets = count_plan_bullets(plan)
+    elaboration_needed = num_bullets < approx_min_cases_to_cover
+    if elaboration_needed:
+        elaboration_user_message = build_elaboration_message(
+            num_bullets, approx_min_cases_to_cover
+        )
+        elaboration = await complete(
+            "elaborate",
+            plan_model,
+            plan_messages + [plan_assistant_message, elaboration_user_message],
+            explain_model=explain_model,
+            unit_test_package=unit_test_package,
+            approx_min_cases_to_cover=approx_min_cases_to_cover,
+        )
+        elaboration_assistant_message = {"role": "assistant", "content": elaboration}
+
+    # Step 3: Generate the unit test
+    execute_system_message, execute_user_message = build_execute_messages(
+        function_to_test,
+        function_filename,
+        unit_test_package,
+        import_name=definition_name(class_skeleton) if class_skeleton else None,
+    )
+    execute_messages = [
+        execute_system_message,
+        explain_user_message,
+        explain_assistant_message,
+        plan_user_message,
+        plan_assistant_message,
+    ]
+    if elaboration_needed:
+        execute_messages += [elaboration_user_message, elaboration_assistant_message]
+    execute_messages += [execute_user_message]
+
+    logging.info("Running unit test generation.")
+    with telemetry.stage("execute"):
+        code = await aexecute_test_generation(
+            client,
+            execute_model,
+            execute_messages,
+            temperature,
+            reruns_if_fail=reruns_if_fail,
+            cache=cache,
+            stream=stream,
+            semaphore=semaphore,
+        )
+    return await asyncio.to_thread(
+        write_test_file,
+        code,
+        target_test_file(function_filename, function_to_test, class_skeleton),
+    )
+
+
+async def arun_pytest(test_file, node_ids=None, coverage=None):
+    """Async counterpart of ``run_pytest`` that does not block the event loop."""
+    args = list(node_ids) if node_ids else [test_file]
+    limits = get_resource_limits()
+    if warm_pytest_enabled():
+        try:
+            with get_telemetry().stage("pytest"):
+                result = await asyncio.to_thread(
+                    run_pytest_in_worker,
+                    args,
+                    coverage=coverage,
+                    limits=limits.session_limits(),
+                    timeout=limits.run_timeout,
+                )
+            sys.stdout.write(result["stdout"])
+            result["summary"] = summarize(result["tests"])
+            return result
+        except PytestRunTimeout as e:
+            logging.warning(str(e))
+            result = timed_out_result(test_file, limits.run_timeout)
+            result["summary"] = summarize(result["tests"])
+            return result
+        except PytestWorkerError as e:
+            logging.warning(f"{e}, falling back to a pytest subprocess")
+    args = limit_args(limits.session_limits()) + args
+    fd, results_file = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    coverage_file = None
+    if coverage is not None:
+        fd, coverage_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        args = coverage_args(coverage, coverage_file) + args
+    with get_telemetry().stage("pytest"):
+        process = await asyncio.create_subprocess_exec(
+            *collector_command(args, results_file),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=subprocess_env(),
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                process.communicate(), timeout=limits.run_timeout
+            )
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            stdout = None
+    tests = await asyncio.to_thread(load_results, results_file)
+    target_coverage = (
+        await asyncio.to_thread(load_results, coverage_file) if coverage_file else None
+    )
+    if stdout is None:
+        logging.warning(f"pytest run exceeded the time limit of {limits.run_timeout}s")
+        result = timed_out_result(test_file, limits.run_timeout)
+        result["summary"] = summarize(result["tests"])
+        return result
+    stdout = stdout.decode()
+    sys.stdout.write(stdout)
+    return {
+        "returncode": process.returncode,
+        "stdout": stdout,
+        "stderr": stderr.decode(),
+        "tests": tests,
+        "summary": summarize(tests or []),
+        "coverage": target_coverage,
+    }
+
+
+async def acorrect_function(
+    function_to_test,
+    function_filename,
+    test_results,
+    failed_test_cases,
+    client,
+    correct_model="gpt-3.5-turbo",
+    temperature=0.6,
+    cache=None,
+    semaphore=None,
+    qualname=None,
+):
+    """
+    Async counterpart of ``correct_function``.
+
+    Returns
+    -------
+    tuple
+        The corrected function and the path of the file it was written to.
+    """
+    if cache is None:
+        cache = get_response_cache()
+    logging.info("Starting function correction...")
+
+    correction_messages = build_correction_messages(
+        function_to_test, function_filename, test_results, failed_test_cases
+    )
+    with get_telemetry().stage("correct"):
+        correction_response = await achat_completion(
+            client,
+            model=correct_model,
+            messages=correction_messages,
+            temperature=temperature,
+            cache=cache,
+            semaphore=semaphore,
+        )
+    corrected_function = extract_corrected_function(
+        correction_response.choices[0].message.content
+    )
+    if corrected_function is None:
+        cache.delete(cache.key(correct_model, correction_messages, temperature))
+        corrected_function = function_to_test
+
+    output_file = await asyncio.to_thread(
+        write_corrected_definition,
+        corrected_function,
+        function_filename,
+        qualname or definition_name(function_to_test),
+    )
+    return corrected_function, output_file
+
+
+def _read_file(path):
+    with open(path, "r") as f:
+        return f.read()
+
+
+async def aextend_tests_for_coverage(
+    function_to_test,
+    test_file,
+    coverage,
+    client,
+    execute_model="gpt-3.5-turbo",
+    temperature=0.4,
+    cache=None,
+    semaphore=None,
+):
+    """
+    Async counterpart of ``extend_tests_for_coverage``.
+
+    Returns
+    -------
+    bool
+        Whether tests were added to ``test_file``.
+    """
+    if cache is None:
+        cache = get_response_cache()
+    test_code = await asyncio.to_thread(_read_file, test_file)
+    coverage_messages = build_coverage_messages(function_to_test, test_code, coverage)
+    with get_telemetry().stage("coverage"):
+        coverage_response = await achat_completion(
+            client,
+            model=execute_model,
+            messages=coverage_messages,
+            temperature=temperature,
+            cache=cache,
+            semaphore=semaphore,
+        )
+    appended = await asyncio.to_thread(
+        append_coverage_tests, test_file, coverage_response.choices[0].message.content
+    )
+    if not appended:
+        cache.delete(cache.key(execute_model, coverage_messages, temperature))
+    return appended
@@ -0,0 +1,72 @@
+"""
+Locked, atomic file updates.
+
+Generated test files are written while other targets' tests run and other
+workers write their own files. ``atomic_write`` replaces a file in one
+``os.replace``, so readers (pytest) never see a half-written file, and
+``locked`` serializes read-modify-write updates of the same file across
+threads and processes.
+"""
+
+import contextlib
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# flock does not exclude threads of one process on every platform, so threads
+# additionally share an in-process lock per path
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _lock_path(path: str) -> str:
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, f".{name}.lock")
+
+
+@contextlib.contextmanager
+def locked(path: str):
+    """Hold the exclusive lock of ``path`` for the enclosed block."""
+    path = os.path.abspath(path)
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(path, threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(_lock_path(path), "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write(path: str, text: str) -> str:
+    """
+    Replace the content of ``path`` with ``text`` in one step.
+
+    The text is written to a temporary file in the same directory, which is
+    then renamed over ``path``. Callers updating a file based on its previous
+    content hold ``locked(path)`` around the read and the write.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
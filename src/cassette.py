@@ -0,0 +1,194 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+import types
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from src.response_cache import ResponseCache
+
+
+class CassetteMiss(LookupError):
+    """Raised when a replayed run sends a request that was never recorded."""
+
+
+def request_key(kwargs: dict) -> str:
+    """Return the key of a chat-completion request within a cassette."""
+    key = ResponseCache.key(
+        kwargs["model"], kwargs["messages"], kwargs.get("temperature")
+    )
+    return f"{key}:stream" if kwargs.get("stream") else key
+
+
+class _RecordingStream:
+    """Passes the chunks of a streamed response through and records them."""
+
+    def __init__(self, stream, on_done):
+        self.stream = stream
+        self.on_done = on_done
+        self.start = time.perf_counter()
+        self.chunks = []
+        self.offsets = []
+        self.done = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.stream:
+                self.chunks.append(chunk.model_dump(mode="json"))
+                self.offsets.append(time.perf_counter() - self.start)
+                yield chunk
+        finally:
+            self._finish()
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self.on_done(self.chunks, self.offsets)
+
+    def close(self):
+        # Only the chunks consumed before an early close are recorded, which is
+        # exactly what the consumer will ask for again on replay
+        self._finish()
+        self.stream.close()
+
+
+class RecordingClient:
+    """
+    Wraps a client and appends every chat-completion request/response pair to a cassette.
+
+    The cassette is a JSON-lines file; an entry is written as soon as its
+    response is complete, so an interrupted run keeps what it recorded.
+
+    Parameters
+    ----------
+    client : OpenAI
+        The client doing the actual requests.
+    path : str
+        The cassette file (appended to if it exists).
+    """
+
+    def __init__(self, client, path: str):
+        self.client = client
+        self.path = path
+        self.recorded = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.chat = types.SimpleNamespace(
+            completions=types.SimpleNamespace(create=self.create)
+        )
+
+    def _write(self, entry: dict) -> None:
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.recorded += 1
+
+    def create(self, **kwargs):
+        request = {
+            name: kwargs.get(name) for name in ("model", "messages", "temperature", "stream")
+        }
+        entry = {"key": request_key(kwargs), "request": request}
+        start = time.perf_counter()
+        response = self.client.chat.completions.create(**kwargs)
+        if not kwargs.get("stream"):
+            entry["elapsed"] = time.perf_counter() - start
+            entry["response"] = response.model_dump(mode="json")
+            self._write(entry)
+            return response
+
+        def on_done(chunks, offsets):
+            entry["chunks"] = chunks
+            entry["offsets"] = offsets
+            entry["elapsed"] = offsets[-1] if offsets else 0.0
+            self._write(entry)
+
+        return _RecordingStream(response, on_done)
+
+    def close(self):
+        if hasattr(self.client, "close"):
+            self.client.close()
+
+
+class _ReplayStream:
+    """Serves recorded chunks, sleeping to reproduce their timing if asked to."""
+
+    def __init__(self, chunks, offsets):
+        self.chunks = chunks
+        self.offsets = offsets
+
+    def __iter__(self):
+        start = time.perf_counter()
+        for chunk, offset in zip(self.chunks, self.offsets):
+            wait = offset - (time.perf_counter() - start)
+            if wait > 0:
+                time.sleep(wait)
+            yield ChatCompletionChunk.model_validate(chunk)
+
+    def close(self):
+        pass
+
+
+class ReplayClient:
+    """
+    Serves the responses of a cassette instead of calling the API.
+
+    Identical requests are answered in the order they were recorded; once the
+    recordings of a request are used up, the last one is repeated.
+
+    Parameters
+    ----------
+    path : str
+        The cassette file written by ``RecordingClient``.
+    latency : float or None, optional
+        Seconds to wait before every response (default is 0). ``None``
+        reproduces the latency recorded for each response, including the
+        timing of streamed chunks.
+    """
+
+    def __init__(self, path: str, latency: float = 0.0):
+        self.path = path
+        self.latency = latency
+        self.replayed = 0
+        self._entries = collections.defaultdict(list)
+        self._served = collections.Counter()
+        self._lock = threading.Lock()
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[entry["key"]].append(entry)
+        logging.info(
+            f"Replaying {sum(len(e) for e in self._entries.values())} recorded responses from {path}"
+        )
+        self.chat = types.SimpleNamespace(
+            completions=types.SimpleNamespace(create=self.create)
+        )
+
+    def _next_entry(self, key: str) -> dict:
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise CassetteMiss(f"No recorded response for request {key[:12]} in {self.path}")
+            index = min(self._served[key], len(entries) - 1)
+            self._served[key] += 1
+            self.replayed += 1
+            return entries[index]
+
+    def create(self, **kwargs):
+        entry = self._next_entry(request_key(kwargs))
+        if "chunks" in entry:
+            offsets = entry["offsets"]
+            if self.latency is not None:
+                # A fixed latency is spent before the first chunk, the rest arrives at once
+                offsets = [self.latency] * len(entry["chunks"])
+            return _ReplayStream(entry["chunks"], offsets)
+        time.sleep(entry["elapsed"] if self.latency is None else self.latency)
+        return ChatCompletion.model_validate(entry["response"])
+
+    def close(self):
+        pass
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import threading
+import types
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+DEFAULT_POOL_SIZE = 20
+DEFAULT_KEEPALIVE_EXPIRY = 120.0
+
+
+def create_client(
+    pool_size: int = DEFAULT_POOL_SIZE,
+    keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+    **client_kwargs,
+) -> OpenAI:
+    """
+    Create an OpenAI client backed by a keep-alive HTTP connection pool.
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Maximum number of (kept-alive) connections in the pool. Should be at
+        least the number of worker threads sharing the client.
+    keepalive_expiry : float, optional
+        Seconds an idle connection is kept open for reuse.
+    **client_kwargs
+        Passed on to ``OpenAI`` (e.g. ``base_url``, ``timeout``). ``max_retries``
+        defaults to 0 because retries are handled by the rate limiter.
+
+    Returns
+    -------
+    OpenAI
+        A client that is safe to share between threads.
+    """
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry,
+        )
+    )
+    client_kwargs.setdefault("max_retries", 0)
+    return OpenAI(http_client=http_client, **client_kwargs)
+
+
+def create_async_client(
+    pool_size: int = DEFAULT_POOL_SIZE,
+    keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+    **client_kwargs,
+) -> AsyncOpenAI:
+    """
+    Create an AsyncOpenAI client backed by a keep-alive HTTP connection pool.
+
+    The async connection pool belongs to the event loop that first uses it, so
+    create one client per ``asyncio.run``. See ``create_client`` for the
+    parameters.
+    """
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry,
+        )
+    )
+    client_kwargs.setdefault("max_retries", 0)
+    return AsyncOpenAI(http_client=http_client, **client_kwargs)
+
+
+class _AsyncStream:
+    """Iterates a synchronous stream of chunks without blocking the event loop."""
+
+    _done = object()
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = iter(stream)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await asyncio.to_thread(next, self.chunks, self._done)
+        if chunk is self._done:
+            raise StopAsyncIteration
+        return chunk
+
+    async def close(self):
+        await asyncio.to_thread(self.stream.close)
+
+
+class AsyncClientAdapter:
+    """
+    Expose a synchronous client with the interface of ``AsyncOpenAI``.
+
+    Lets the async pipeline use clients injected with ``set_client``, e.g.
+    the recording and replaying clients of ``src.cassette``; every request
+    and streamed chunk is read on a worker thread. Closing the adapter leaves
+    the wrapped client open.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, **kwargs):
+        response = await asyncio.to_thread(self.client.chat.completions.create, **kwargs)
+        return _AsyncStream(response) if kwargs.get("stream") else response
+
+    async def close(self):
+        pass
+
+
+_client = None
+_client_kwargs = {}
+_client_injected = False
+_client_lock = threading.Lock()
+
+
+def configure_client(pool_size: int = None, **client_kwargs) -> OpenAI:
+    """
+    Create the process-wide client shared by all pipeline stages.
+
+    ``pool_size`` falls back to the ``UNITTEST_LLM_POOL_SIZE`` environment
+    variable and then to ``DEFAULT_POOL_SIZE``. A previously configured client
+    is closed.
+    """
+    global _client, _client_kwargs, _client_injected
+    if pool_size is None:
+        pool_size = int(os.getenv("UNITTEST_LLM_POOL_SIZE", DEFAULT_POOL_SIZE))
+    client = create_client(pool_size=pool_size, **client_kwargs)
+    with _client_lock:
+        previous, _client = _client, client
+        _client_kwargs, _client_injected = dict(client_kwargs), False
+    if previous is not None and hasattr(previous, "close"):
+        previous.close()
+    logging.debug(f"Shared OpenAI client configured with a pool of {pool_size}")
+    return client
+
+
+def set_client(client) -> None:
+    """Inject the client returned by ``get_client`` (e.g. a preconfigured one)."""
+    global _client, _client_injected
+    with _client_lock:
+        _client, _client_injected = client, True
+
+
+def get_client():
+    """Return the process-wide client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                pool_size = int(os.getenv("UNITTEST_LLM_POOL_SIZE", DEFAULT_POOL_SIZE))
+                _client = create_client(pool_size=pool_size)
+    return _client
+
+
+def get_async_client(pool_size: int = None):
+    """
+    Return an async client for the current event loop, configured like ``get_client``.
+
+    A client injected with ``set_client`` is wrapped in an
+    ``AsyncClientAdapter``; otherwise a new ``AsyncOpenAI`` client is created
+    with the arguments of ``configure_client`` (e.g. ``timeout``). Close it
+    when the event loop is done with it.
+    """
+    with _client_lock:
+        client, client_kwargs, injected = _client, dict(_client_kwargs), _client_injected
+    if injected:
+        return AsyncClientAdapter(client)
+    if pool_size is None:
+        pool_size = int(os.getenv("UNITTEST_LLM_POOL_SIZE", DEFAULT_POOL_SIZE))
+    return create_async_client(pool_size=pool_size, **client_kwargs)
@@ -0,0 +1,230 @@
+"""
+Line and branch coverage of one target.
+
+``CoverageCollector`` is a pytest plugin measuring, with coverage.py, which
+statements and branches of a target (a class or function, given by its file
+and line span) the session executed. The repair loop uses the result to ask
+for tests of exactly the uncovered code. Register it in-process with
+``pytest.main(args, plugins=[collector])`` or from the command line with
+``coverage_args(target, coverage_file)``.
+"""
+
+import ast
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import textwrap
+
+from src.ast_hash import normalized_ast_hash
+from src.symbol_index import get_symbol_index
+
+_DEFINITIONS = (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def coverage_target(filename: str, source: str = None):
+    """
+    Return the coverage target of the class or function ``source`` in ``filename``.
+
+    Returns
+    -------
+    dict
+        ``file`` (absolute path), ``first_line`` and ``last_line`` of the
+        definition including its decorators, or the whole file (both None)
+        if the definition cannot be found.
+    """
+    target = {"file": os.path.abspath(filename), "first_line": None, "last_line": None}
+    try:
+        symbols = get_symbol_index().symbols(filename)
+        definition = ast.parse(textwrap.dedent(source)).body[0] if source else None
+    except (OSError, SyntaxError, IndexError):
+        return target
+    if not isinstance(definition, _DEFINITIONS):
+        return target
+    # Prefer the definition with the same code over the first one of that name
+    source_hash = normalized_ast_hash(source)
+    candidates = [symbol for symbol in symbols if symbol["name"] == definition.name]
+    symbol = min(candidates, key=lambda symbol: symbol["ast_hash"] != source_hash, default=None)
+    if symbol is not None:
+        target["first_line"] = symbol["first_line"]
+        target["last_line"] = symbol["last_line"]
+    return target
+
+
+def _in_span(line: int, target: dict) -> bool:
+    if target["first_line"] is None:
+        return True
+    return target["first_line"] <= line <= target["last_line"]
+
+
+def restrict_to_target(file_report: dict, target: dict) -> dict:
+    """
+    Reduce the coverage.py JSON report of a file to the lines of ``target``.
+
+    Returns
+    -------
+    dict
+        The target plus ``statements`` and ``branches`` (counts),
+        ``missing_lines``, ``missing_branches`` (``[from, to]`` pairs, a
+        negative ``to`` leaves the code object) and ``percent``, which counts
+        statements and branches like coverage.py's total and is None when
+        nothing of the target was measured.
+    """
+    executed_lines = [
+        line for line in file_report.get("executed_lines", []) if _in_span(line, target)
+    ]
+    missing_lines = [
+        line for line in file_report.get("missing_lines", []) if _in_span(line, target)
+    ]
+    executed_branches = [
+        arc for arc in file_report.get("executed_branches", []) if _in_span(arc[0], target)
+    ]
+    missing_branches = [
+        arc for arc in file_report.get("missing_branches", []) if _in_span(arc[0], target)
+    ]
+    statements = len(executed_lines) + len(missing_lines)
+    branches = len(executed_branches) + len(missing_branches)
+    total = statements + branches
+    covered = len(executed_lines) + len(executed_branches)
+    return {
+        **target,
+        "statements": statements,
+        "branches": branches,
+        "missing_lines": sorted(missing_lines),
+        "missing_branches": sorted(missing_branches),
+        "percent": 100.0 * covered / total if total else None,
+    }
+
+
+class CoverageCollector:
+    """
+    Pytest plugin measuring the coverage of one target during a session.
+
+    Parameters
+    ----------
+    target : dict
+        The target, see ``coverage_target``.
+    """
+
+    def __init__(self, target: dict):
+        self.target = target
+        self.coverage = None
+        self.result = None
+
+    def pytest_sessionstart(self, session):
+        import coverage
+
+        # Statements run at import time only count if the module is imported again
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, "__file__", None)
+            if path and os.path.abspath(path) == self.target["file"]:
+                del sys.modules[name]
+        self.coverage = coverage.Coverage(
+            data_file=None,
+            branch=True,
+            config_file=False,
+            include=[self.target["file"]],
+        )
+        self.coverage.start()
+
+    def pytest_sessionfinish(self, session):
+        if self.coverage is None:
+            return
+        self.coverage.stop()
+        fd, report_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            self.coverage.json_report(outfile=report_file, ignore_errors=True)
+            with open(report_file, "r") as f:
+                files = json.load(f)["files"]
+        except Exception:
+            # Nothing of the target was imported, e.g. the tests failed to collect
+            files = {}
+        finally:
+            # coverage.py deletes the report file itself when it has no data
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(report_file)
+        file_report = next(
+            (
+                report
+                for path, report in files.items()
+                if os.path.abspath(path) == self.target["file"]
+            ),
+            {},
+        )
+        self.result = restrict_to_target(file_report, self.target)
+        self.coverage = None
+
+
+def coverage_args(target: dict, coverage_file: str) -> list:
+    """Return the pytest arguments writing the coverage of ``target`` to ``coverage_file``."""
+    return [
+        "-p",
+        __name__,
+        f"--coverage-target={json.dumps(target)}",
+        f"--coverage-json={coverage_file}",
+    ]
+
+
+def format_uncovered(coverage: dict) -> str:
+    """Render the uncovered statements and branches of a target for prompts and logs."""
+    try:
+        with open(coverage["file"], "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        lines = []
+
+    def source(line):
+        return lines[line - 1].strip() if 0 < line <= len(lines) else ""
+
+    parts = []
+    for line in coverage["missing_lines"]:
+        parts.append(f"- line {line} never runs: `{source(line)}`")
+    for start, end in coverage["missing_branches"]:
+        destination = f"line {end}" if end > 0 else "the exit of the function"
+        parts.append(
+            f"- the branch from line {start} (`{source(start)}`) to {destination} is never taken"
+        )
+    return "\n".join(parts) if parts else "Everything is covered."
+
+
+def describe_coverage(coverage) -> str:
+    """Summarize the coverage of a target in one line."""
+    if not coverage or coverage["percent"] is None:
+        return "coverage unknown"
+    return (
+        f"{coverage['percent']:.1f}% coverage "
+        f"({len(coverage['missing_lines'])}/{coverage['statements']} statements and "
+        f"{len(coverage['missing_branches'])}/{coverage['branches']} branches missed)"
+    )
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--coverage-target",
+        action="store",
+        default=None,
+        help="JSON description of the target whose coverage is measured.",
+    )
+    parser.addoption(
+        "--coverage-json",
+        action="store",
+        default=None,
+        help="Write the coverage of the target to this file.",
+    )
+
+
+def pytest_configure(config):
+    if config.getoption("--coverage-target") and config.getoption("--coverage-json"):
+        collector = CoverageCollector(json.loads(config.getoption("--coverage-target")))
+        config._unittest_llm_coverage = collector
+        config.pluginmanager.register(collector, "unittest_llm_coverage")
+
+
+def pytest_unconfigure(config):
+    collector = getattr(config, "_unittest_llm_coverage", None)
+    if collector is None:
+        return
+    with open(config.getoption("--coverage-json"), "w") as f:
+        json.dump(collector.result, f)
@@ -0,0 +1,265 @@
+"""
+Change-aware selection of targets.
+
+A target is selected if its normalized AST hash (see ``src.ast_hash``)
+differs from the one recorded when its tests last passed, or from its code at
+a git revision, and also if it directly depends on such a target: it uses the
+changed name and is defined in the same module or in one importing the
+changed module by its dotted name (see ``module_name``). Formatting, comment and docstring edits therefore select
+nothing.
+
+The hashes of passing targets are recorded in a JSON state file (default
+``.llm_cache/last_run.json``) after every run.
+"""
+
+import ast
+import json
+import logging
+import os
+import subprocess
+import threading
+
+from src.atomic_file import atomic_write, locked
+from src.symbol_index import extract_symbols, get_symbol_index
+
+DEFAULT_STATE_FILE = os.path.join(os.getcwd(), ".llm_cache", "last_run.json")
+
+
+def _key(path: str, qualname: str) -> str:
+    return f"{os.path.abspath(path)}::{qualname}"
+
+
+def load_run_state(state_file: str = None) -> dict:
+    """
+    Return the hashes of the targets whose tests passed, keyed by ``path::qualname``.
+
+    ``state_file`` falls back to the ``UNITTEST_LLM_RUN_STATE`` environment
+    variable and then to ``.llm_cache/last_run.json``.
+    """
+    state_file = state_file or os.getenv("UNITTEST_LLM_RUN_STATE", DEFAULT_STATE_FILE)
+    try:
+        with open(state_file, "r") as f:
+            return json.load(f).get("symbols", {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def record_passed_targets(passed: dict, state_file: str = None) -> str:
+    """
+    Add the hashes of the targets that passed to the state file.
+
+    Parameters
+    ----------
+    passed : dict
+        ``ast_hash`` of every passed target, keyed by (path, qualname).
+
+    Returns
+    -------
+    str
+        The path of the state file.
+    """
+    state_file = state_file or os.getenv("UNITTEST_LLM_RUN_STATE", DEFAULT_STATE_FILE)
+    with locked(state_file):
+        symbols = load_run_state(state_file)
+        symbols.update((_key(path, qualname), value) for (path, qualname), value in passed.items())
+        atomic_write(state_file, json.dumps({"symbols": symbols}, indent=2, sort_keys=True))
+    return state_file
+
+
+def _git(directory: str, *args) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["git", "-C", directory, *args], capture_output=True, text=True, check=False
+    )
+
+
+class RevisionSymbols:
+    """
+    The definitions of files at a git revision, read with ``git show``.
+
+    Parameters
+    ----------
+    revision : str
+        Any git revision, e.g. ``HEAD~1`` or ``origin/main``.
+    directory : str
+        A directory inside the work tree.
+    """
+
+    def __init__(self, revision: str, directory: str):
+        self.revision = revision
+        toplevel = _git(directory, "rev-parse", "--show-toplevel")
+        if toplevel.returncode != 0:
+            raise ValueError(f"{directory} is not inside a git work tree: {toplevel.stderr.strip()}")
+        self.toplevel = toplevel.stdout.strip()
+        diff = _git(self.toplevel, "diff", "--name-only", revision, "--")
+        if diff.returncode != 0:
+            raise ValueError(f"Cannot compare with revision '{revision}': {diff.stderr.strip()}")
+        untracked = _git(self.toplevel, "ls-files", "--others", "--exclude-standard")
+        # Files not listed here are identical at the revision
+        self.changed_files = {
+            os.path.realpath(os.path.join(self.toplevel, name))
+            for name in diff.stdout.splitlines() + untracked.stdout.splitlines()
+        }
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def changed(self, path: str) -> bool:
+        """Whether ``path`` differs from its version at the revision."""
+        return os.path.realpath(path) in self.changed_files
+
+    def hashes(self, path: str) -> dict:
+        """Return the ``ast_hash`` of every definition of ``path`` at the revision, by qualname and name."""
+        path = os.path.realpath(path)
+        with self._lock:
+            if path not in self._files:
+                relative = os.path.relpath(path, os.path.realpath(self.toplevel))
+                shown = _git(self.toplevel, "show", f"{self.revision}:{relative}")
+                hashes = {}
+                if shown.returncode == 0:
+                    try:
+                        symbols = extract_symbols(ast.parse(shown.stdout))
+                    except (SyntaxError, ValueError):
+                        symbols = []
+                    for symbol in reversed(symbols):
+                        # The first definition of a plain name wins, like in SymbolIndex.lookup
+                        hashes[symbol["name"]] = symbol["ast_hash"]
+                    hashes.update((symbol["qualname"], symbol["ast_hash"]) for symbol in symbols)
+                self._files[path] = hashes
+            return self._files[path]
+
+
+def module_name(path: str, root: str):
+    """
+    Return the dotted name of the module ``path`` relative to ``root``, e.g. ``pkg.utils``.
+
+    A package is named after its directory; None if ``path`` is outside ``root``.
+    """
+    relative = os.path.relpath(os.path.splitext(os.path.abspath(path))[0], os.path.abspath(root))
+    parts = relative.split(os.sep)
+    if parts[0] == os.pardir:
+        return None
+    if parts[-1] == "__init__":
+        parts = parts[:-1]
+    return ".".join(parts) or None
+
+
+def _package_module_name(path: str) -> str:
+    # The name under which the module is imported from outside its packages
+    directory = os.path.dirname(os.path.abspath(path))
+    while os.path.exists(os.path.join(directory, "__init__.py")):
+        directory = os.path.dirname(directory)
+    return module_name(path, directory)
+
+
+def _resolve_import(name: str, path: str, root: str):
+    # Absolute name of an import of the module path; relative imports are
+    # resolved against its name relative to root
+    level = len(name) - len(name.lstrip("."))
+    if not level:
+        return name
+    importer = module_name(path, root)
+    if importer is None:
+        return None
+    package = importer.split(".")
+    if os.path.basename(path) != "__init__.py":
+        package = package[:-1]
+    if level - 1 > len(package):
+        return None
+    package = package[: len(package) - (level - 1)]
+    return ".".join(package + [name[level:]] if name[level:] else package) or None
+
+
+def _imports_module(imports: list, path: str, module_path: str, root: str) -> bool:
+    names = {module_name(module_path, root), _package_module_name(module_path)} - {None}
+    return any(_resolve_import(name, path, root) in names for name in imports)
+
+
+def select_changed_targets(
+    targets: list, revision: str = None, state_file: str = None, root: str = None
+) -> tuple:
+    """
+    Select the targets that changed and their direct dependents.
+
+    Only the given targets are considered as dependents; code outside of
+    them that uses a changed target is not selected.
+
+    Parameters
+    ----------
+    targets : list
+        (path, name) pairs with absolute paths; names as for ``SymbolIndex.lookup``.
+    revision : str, optional
+        Compare with the code at this git revision instead of the recorded
+        hashes of the last passing runs.
+    state_file : str, optional
+        See ``load_run_state``.
+    root : str, optional
+        The directory imports are resolved against (default: the common
+        directory of the targets). A module is also known by its name
+        outside of the packages (directories with an ``__init__.py``) it
+        belongs to.
+
+    Returns
+    -------
+    tuple
+        The selected targets in their original order and the number of
+        ``changed`` targets and of their ``dependents``.
+    """
+    index = get_symbol_index()
+    if root is None:
+        root = (
+            os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path, _ in targets])
+            if targets
+            else os.getcwd()
+        )
+    symbols = {}
+    for target in targets:
+        try:
+            symbols[target] = index.lookup(*target)
+        except IOError:
+            symbols[target] = None
+    if revision is not None:
+        directory = os.path.dirname(targets[0][0]) if targets else os.getcwd()
+        previous = RevisionSymbols(revision, directory)
+    else:
+        recorded = load_run_state(state_file)
+
+    changed = []
+    for (path, name), symbol in symbols.items():
+        if symbol is None:
+            # Not found anymore, the run reports it as an error
+            changed.append((path, name))
+        elif revision is not None:
+            if previous.changed(path) and previous.hashes(path).get(name) != symbol["ast_hash"]:
+                changed.append((path, name))
+        elif recorded.get(_key(path, symbol["qualname"])) != symbol["ast_hash"]:
+            changed.append((path, name))
+
+    # Direct dependents: targets using a changed name of their own or an imported module
+    changed_names = [
+        (path, symbols[(path, name)]["name"])
+        for path, name in changed
+        if symbols[(path, name)] is not None
+    ]
+    dependents = []
+    changed_targets = set(changed)
+    for (path, name), symbol in symbols.items():
+        if symbol is None or (path, name) in changed_targets:
+            continue
+        references = set(symbol["references"])
+        for changed_path, changed_name in changed_names:
+            if changed_name not in references:
+                continue
+            if path == changed_path or _imports_module(
+                index.imports(path), path, changed_path, root
+            ):
+                dependents.append((path, name))
+                break
+
+    selected = changed_targets | set(dependents)
+    logging.info(
+        f"Incremental run: {len(changed)} changed and {len(dependents)} dependent "
+        f"of {len(targets)} targets selected"
+    )
+    return (
+        [target for target in targets if target in selected],
+        {"changed": len(changed), "dependents": len(dependents)},
+    )
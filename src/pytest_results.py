@@ -0,0 +1,213 @@
+"""
+Structured pytest results.
+
+``ResultCollector`` is a pytest plugin recording one entry per test (outcome,
+duration, exception type, message and a trimmed traceback), so callers do not
+have to scrape pytest's terminal output. Register it in-process with
+``pytest.main(args, plugins=[collector])`` or from the command line with
+``-p src.pytest_results --results-json results.json``.
+
+The outcome of a record is "passed", "failed", "error" (setup, teardown or
+collection failed), "resource" (stopped by a limit of ``src.resource_limits``)
+or "skipped".
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+from src.resource_limits import RESOURCE_EXCEPTIONS
+
+MAX_MESSAGE_CHARS = 500
+MAX_TRACEBACK_LINES = 25
+FAILED_OUTCOMES = ("failed", "error", "resource")
+
+
+def _trim_traceback(text: str) -> str:
+    # The end of a traceback (the failing assertion) is the informative part
+    lines = text.rstrip().splitlines()
+    if len(lines) > MAX_TRACEBACK_LINES:
+        lines = ["..."] + lines[-MAX_TRACEBACK_LINES:]
+    return "\n".join(lines)
+
+
+class ResultCollector:
+    """Pytest plugin collecting one result record per test node."""
+
+    def __init__(self):
+        self.tests = {}
+
+    def _record(self, nodeid: str) -> dict:
+        return self.tests.setdefault(
+            nodeid,
+            {
+                "nodeid": nodeid,
+                "outcome": "passed",
+                "duration": 0.0,
+                "exception": None,
+                "message": None,
+                "traceback": None,
+            },
+        )
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        report = outcome.get_result()
+        record = self._record(report.nodeid)
+        record["duration"] += report.duration
+        if report.skipped and record["outcome"] == "passed":
+            record["outcome"] = "skipped"
+        if not report.failed or record["exception"] is not None:
+            return
+        # A failing setup or teardown is an error, a failing call a failure
+        record["outcome"] = "failed" if call.when == "call" else "error"
+        if call.excinfo is not None and call.excinfo.typename in RESOURCE_EXCEPTIONS:
+            # Stopped by a time, CPU or memory limit rather than by an assertion
+            record["outcome"] = "resource"
+        if call.excinfo is not None:
+            record["exception"] = call.excinfo.typename
+            record["message"] = str(call.excinfo.value)[:MAX_MESSAGE_CHARS]
+            record["traceback"] = _trim_traceback(
+                str(call.excinfo.getrepr(style="short", chain=False))
+            )
+
+    def pytest_collectreport(self, report):
+        if not report.failed:
+            return
+        record = self._record(report.nodeid or "<collection>")
+        record["outcome"] = "error"
+        longrepr = str(report.longrepr)
+        record["exception"] = "CollectionError"
+        lines = longrepr.strip().splitlines()
+        record["message"] = lines[-1][:MAX_MESSAGE_CHARS] if lines else ""
+        record["traceback"] = _trim_traceback(longrepr)
+
+    def results(self) -> list:
+        return list(self.tests.values())
+
+
+def collector_command(args: list, results_file: str) -> list:
+    """Return the command running pytest in a subprocess with the collector enabled."""
+    return [
+        sys.executable,
+        "-m",
+        "pytest",
+        # Importing the first plugin of this package imports the others too, so
+        # they cannot be assertion-rewritten anymore, which is harmless
+        "-W",
+        "ignore::pytest.PytestAssertRewriteWarning",
+        "-p",
+        __name__,
+        # One token, or pytest takes the file for a test path when finding the rootdir
+        f"--results-json={results_file}",
+        *args,
+    ]
+
+
+def load_results(results_file: str):
+    """Read the records written by ``--results-json``, or None if pytest wrote none."""
+    try:
+        with open(results_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+    finally:
+        if os.path.exists(results_file):
+            os.remove(results_file)
+
+
+def summarize(tests: list) -> dict:
+    """Count the records per outcome."""
+    summary = {"passed": 0, "failed": 0, "error": 0, "resource": 0, "skipped": 0}
+    for test in tests:
+        summary[test["outcome"]] = summary.get(test["outcome"], 0) + 1
+    return summary
+
+
+def failed_tests(tests: list) -> list:
+    """Return the failed, erroring and limit-exceeding records, without their (varying) durations."""
+    return [
+        {name: value for name, value in test.items() if name != "duration"}
+        for test in tests
+        if test["outcome"] in FAILED_OUTCOMES
+    ]
+
+
+def failure_signature(failures):
+    """Identify a set of failures by test, exception and message, e.g. to detect no progress."""
+    if failures is None or isinstance(failures, str):
+        return failures
+    return frozenset(
+        (failure["nodeid"], failure["exception"], failure["message"])
+        for failure in failures
+    )
+
+
+def rerun_node_ids(failures):
+    """
+    Return the node IDs to rerun after a correction, or None to rerun everything.
+
+    Only test failures can be selected by node ID; collection errors and
+    failures scraped from the output need the whole file to be run again.
+    """
+    if not failures or isinstance(failures, str):
+        return None
+    node_ids = [failure["nodeid"] for failure in failures]
+    if not all("::" in node_id for node_id in node_ids):
+        return None
+    return node_ids
+
+
+def describe_results(pytest_result) -> str:
+    """Summarize a ``run_pytest`` result in one line, falling back to its output."""
+    if not isinstance(pytest_result, dict):
+        return str(pytest_result)
+    if pytest_result.get("tests") is None:
+        return pytest_result.get("stdout") or pytest_result.get("stderr") or ""
+    summary = pytest_result.get("summary") or summarize(pytest_result["tests"])
+    counts = ", ".join(f"{count} {outcome}" for outcome, count in summary.items())
+    return f"{counts} (pytest exit code {pytest_result['returncode']})"
+
+
+def format_failures(failures) -> str:
+    """Render failure records as compact text for prompts and logs."""
+    if isinstance(failures, str):
+        return failures
+    if not failures:
+        return "No failed test cases."
+    parts = []
+    for failure in failures:
+        parts.append(
+            f"- {failure['nodeid']} ({failure['outcome']}): "
+            f"{failure['exception']}: {failure['message']}"
+        )
+        if failure.get("traceback"):
+            parts.append("\n".join("    " + line for line in failure["traceback"].splitlines()))
+    return "\n".join(parts)
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--results-json",
+        action="store",
+        default=None,
+        help="Write one JSON record per test (outcome, duration, exception) to this file.",
+    )
+
+
+def pytest_configure(config):
+    if config.getoption("--results-json"):
+        collector = ResultCollector()
+        config._unittest_llm_results = collector
+        config.pluginmanager.register(collector, "unittest_llm_results")
+
+
+def pytest_unconfigure(config):
+    collector = getattr(config, "_unittest_llm_results", None)
+    if collector is None:
+        return
+    with open(config.getoption("--results-json"), "w") as f:
+        json.dump(collector.results(), f)
@@ -0,0 +1,277 @@
+"""
+Warm pytest runner.
+
+A long-lived child process keeps pytest and its plugins imported and runs one
+pytest session per request, so a repair iteration does not pay interpreter
+startup and plugin discovery again. Before every session the child forgets
+the project modules (everything imported from below its working directory
+outside site-packages), so changed source and test files are re-imported
+while third-party packages stay loaded.
+
+The parent talks to the child over a pipe, one JSON object per line:
+``{"args": [...], "coverage": target, "limits": {...}}`` in, ``{"returncode": int, "stdout":
+str, "stderr": str, "tests": [...], "coverage": {...}}`` out, where ``tests``
+holds the records of ``ResultCollector`` and ``coverage`` the result of
+``CoverageCollector`` (None unless a coverage target was sent). ``limits`` are
+enforced by ``LimitGuard``; a session running longer than the per-run limit
+gets its worker killed.
+"""
+
+import atexit
+import contextlib
+import importlib
+import io
+import json
+import logging
+import os
+import select
+import subprocess
+import sys
+import threading
+import traceback
+
+from src.coverage_guide import CoverageCollector
+from src.pytest_results import ResultCollector
+from src.resource_limits import LimitGuard
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class PytestWorkerError(RuntimeError):
+    """The worker process died or answered with something that is not a result."""
+
+
+class PytestRunTimeout(PytestWorkerError):
+    """A session exceeded the per-run time limit; its worker was killed."""
+
+
+class PytestWorker:
+    """
+    Handle of one warm pytest child process.
+
+    Parameters
+    ----------
+    cwd : str, optional
+        Working directory of the child, i.e. the project whose tests it runs
+        (default is the current working directory).
+    """
+
+    def __init__(self, cwd: str = None):
+        self.cwd = cwd or os.getcwd()
+        self.process = None
+        self.runs = 0
+
+    def start(self) -> None:
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", "from src.pytest_worker import serve; serve()"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.cwd,
+            env=subprocess_env(),
+            text=True,
+        )
+        logging.debug(f"Started pytest worker {self.process.pid} in {self.cwd}")
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def run(
+        self, args: list, coverage: dict = None, limits: dict = None, timeout: float = None
+    ) -> dict:
+        """Run one pytest session with ``args`` and return its result."""
+        if not self.alive():
+            self.start()
+        request = {"args": args, "coverage": coverage, "limits": limits}
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+            ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+            if not ready:
+                self.process.kill()
+                self.process.wait()
+                raise PytestRunTimeout(f"pytest run exceeded the time limit of {timeout}s")
+            line = self.process.stdout.readline()
+        except OSError as e:
+            raise PytestWorkerError(f"pytest worker pipe broken: {e}")
+        if not line:
+            raise PytestWorkerError(
+                f"pytest worker exited with code {self.process.wait()}"
+            )
+        try:
+            result = json.loads(line)
+        except ValueError:
+            raise PytestWorkerError(f"Unexpected answer from pytest worker: {line[:200]!r}")
+        self.runs += 1
+        return result
+
+    def close(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.process = None
+
+
+def subprocess_env() -> dict:
+    """Environment of pytest child processes, which have to import this package."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (PACKAGE_PARENT, env.get("PYTHONPATH")) if path
+    )
+    return env
+
+
+# Idle workers per working directory; a worker serves one session at a time
+_idle_workers = {}
+_workers_lock = threading.Lock()
+_warm_enabled = None
+
+
+def configure_pytest_runner(warm: bool = None) -> bool:
+    """
+    Choose between the warm worker and a fresh ``pytest`` subprocess per run.
+
+    ``warm`` falls back to the ``UNITTEST_LLM_COLD_PYTEST`` environment
+    variable (set it to use cold subprocesses); the warm worker is the default.
+    """
+    global _warm_enabled
+    if warm is None:
+        warm = os.getenv("UNITTEST_LLM_COLD_PYTEST", "") in ("", "0", "false")
+    _warm_enabled = warm
+    return warm
+
+
+def warm_pytest_enabled() -> bool:
+    if _warm_enabled is None:
+        return configure_pytest_runner()
+    return _warm_enabled
+
+
+def run_pytest_in_worker(
+    args: list,
+    cwd: str = None,
+    coverage: dict = None,
+    limits: dict = None,
+    timeout: float = None,
+) -> dict:
+    """
+    Run a pytest session in an idle warm worker, starting one if all are busy.
+
+    ``coverage`` is a target of ``src.coverage_guide.coverage_target`` whose
+    line and branch coverage is measured during the session, ``limits`` the
+    per-test and per-session limits of ``LimitGuard`` and ``timeout`` the
+    wall-clock limit of the whole session in seconds.
+
+    Raises
+    ------
+    PytestRunTimeout
+        If the session exceeded ``timeout``; the worker is killed.
+    PytestWorkerError
+        If the worker died; it is discarded and the next call starts a new one.
+    """
+    cwd = cwd or os.getcwd()
+    with _workers_lock:
+        idle = _idle_workers.setdefault(cwd, [])
+        worker = idle.pop() if idle else PytestWorker(cwd)
+    try:
+        result = worker.run(args, coverage, limits, timeout)
+    except PytestWorkerError:
+        worker.close()
+        raise
+    with _workers_lock:
+        _idle_workers[cwd].append(worker)
+    return result
+
+
+@atexit.register
+def close_pytest_workers() -> None:
+    """Stop all idle warm workers."""
+    with _workers_lock:
+        workers = [worker for idle in _idle_workers.values() for worker in idle]
+        _idle_workers.clear()
+    for worker in workers:
+        worker.close()
+
+
+def _purge_project_modules(root: str) -> None:
+    root = os.path.join(os.path.abspath(root), "")
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if (
+            path
+            and os.path.abspath(path).startswith(root)
+            and "site-packages" not in path
+            and name not in ("__main__", __name__)
+        ):
+            del sys.modules[name]
+    importlib.invalidate_caches()
+
+
+def _run_session(args: list, coverage: dict = None, limits: dict = None) -> dict:
+    import pytest
+
+    _purge_project_modules(os.getcwd())
+    buffer = io.StringIO()
+    collector = ResultCollector()
+    plugins = [collector]
+    if coverage is not None:
+        coverage_collector = CoverageCollector(coverage)
+        plugins.append(coverage_collector)
+    guard = LimitGuard(limits) if limits else None
+    if guard is not None:
+        plugins.append(guard)
+    try:
+        with contextlib.redirect_stdout(buffer):
+            returncode = int(
+                pytest.main(
+                    # Plugins of packages the worker itself imported (e.g. anyio)
+                    # cannot be assertion-rewritten anymore, which is harmless
+                    ["-W", "ignore::pytest.PytestAssertRewriteWarning", *args],
+                    plugins=plugins,
+                )
+            )
+        stderr = ""
+    except BaseException:
+        # Internal error of pytest or a plugin; keep serving
+        returncode = 3
+        stderr = traceback.format_exc()
+    finally:
+        if guard is not None:
+            # Never leave the limits of an aborted session on the warm worker
+            guard.restore()
+    if coverage is not None and coverage_collector.coverage is not None:
+        # The session ended before pytest_sessionfinish, do not trace the next one
+        coverage_collector.coverage.stop()
+    return {
+        "returncode": returncode,
+        "stdout": buffer.getvalue(),
+        "stderr": stderr,
+        "tests": collector.results(),
+        "coverage": coverage_collector.result if coverage is not None else None,
+    }
+
+
+def serve() -> None:
+    """Child side: answer pytest requests read from stdin until it is closed."""
+    # The protocol owns the original stdout; stray writes of tests go to stderr
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w", buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    # Test files are rewritten within seconds, never trust bytecode of an earlier version
+    sys.dont_write_bytecode = True
+    import pytest  # noqa: F401 (imported once for all sessions)
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        result = _run_session(
+            request["args"], request.get("coverage"), request.get("limits")
+        )
+        protocol.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from src.telemetry import get_telemetry
+
+# Errors worth retrying; everything else (bad request, auth, ...) fails at once
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+DEFAULT_COMPLETION_TOKENS = 1000
+
+
+def estimate_tokens(messages: list, completion_tokens: int = DEFAULT_COMPLETION_TOKENS):
+    """
+    Estimate the tokens a chat-completion request will consume.
+
+    Uses the usual ~4 characters per token heuristic for the prompt plus a
+    fixed allowance for the completion. The estimate is corrected from
+    ``response.usage`` once the request has finished.
+    """
+    prompt_chars = sum(len(message.get("content") or "") for message in messages)
+    return prompt_chars // 4 + 4 * len(messages) + completion_tokens
+
+
+def retry_after_seconds(error):
+    """Return the delay requested by the ``Retry-After`` headers of an API error, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After may also be an HTTP date, fall back to our own backoff
+        return None
+    return None
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at ``rate_per_minute``.
+
+    The level may go negative when the actual usage of a request turns out to be
+    higher than its estimate; the debt is then paid back by the refill.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until ``amount`` can be consumed."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount: float) -> None:
+        """Give back (positive) or take away (negative) tokens after the fact."""
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Process-wide limiter for requests/min and tokens/min with 429-aware backoff.
+
+    Parameters
+    ----------
+    requests_per_minute : float, optional
+        Request budget per minute (unlimited if None).
+    tokens_per_minute : float, optional
+        Token budget per minute (unlimited if None).
+    max_retries : int, optional
+        How often a request is retried on rate-limit, connection and server errors.
+    base_delay : float, optional
+        Delay of the first retry in seconds; doubled for every further attempt.
+    max_delay : float, optional
+        Upper bound of a single backoff delay in seconds.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limited = 0
+        self.retries = 0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, estimated_tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            wait = 0.0
+            if self.requests is not None:
+                wait = max(wait, self.requests.wait_time(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.wait_time(estimated_tokens, now))
+            if wait > 0:
+                return wait
+            if self.requests is not None:
+                self.requests.consume(1)
+            if self.tokens is not None:
+                self.tokens.consume(estimated_tokens)
+            return 0.0
+
+    def acquire(self, estimated_tokens: int) -> None:
+        """Block until the request fits into both budgets."""
+        while (wait := self._try_acquire(estimated_tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, estimated_tokens: int) -> None:
+        """Like ``acquire``, but waits without blocking the event loop."""
+        while (wait := self._try_acquire(estimated_tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Correct the token budget once the real usage of a request is known."""
+        if self.tokens is None or actual_tokens is None:
+            return
+        with self._lock:
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+
+    def backoff_delay(self, attempt: int, retry_after: float = None) -> float:
+        """Jittered exponential backoff that never undercuts the server's Retry-After."""
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _on_error(self, error, attempt: int, estimated_tokens: int) -> float:
+        # The failed attempt consumed no tokens upstream
+        self.record_usage(estimated_tokens, 0)
+        delay = self.backoff_delay(attempt, retry_after_seconds(error))
+        get_telemetry().record_retry()
+        with self._lock:
+            self.retries += 1
+            if isinstance(error, RateLimitError):
+                # Everyone else holds off too instead of running into the same 429
+                self.rate_limited += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        logging.warning(
+            f"{type(error).__name__} on attempt {attempt + 1}, retrying in {delay:.1f}s"
+        )
+        return delay
+
+    def call(self, request, estimated_tokens: int):
+        """
+        Run ``request()`` within the budgets, retrying retryable API errors.
+
+        The token budget is corrected from ``response.usage`` if the response has it.
+        """
+        attempt = 0
+        while True:
+            self.acquire(estimated_tokens)
+            try:
+                response = request()
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self._on_error(e, attempt, estimated_tokens))
+                attempt += 1
+                continue
+            self.record_usage(estimated_tokens, usage_tokens(response))
+            return response
+
+    async def acall(self, request, estimated_tokens: int):
+        """Async counterpart of ``call``; ``request`` returns an awaitable."""
+        attempt = 0
+        while True:
+            await self.aacquire(estimated_tokens)
+            try:
+                response = await request()
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._on_error(e, attempt, estimated_tokens))
+                attempt += 1
+                continue
+            self.record_usage(estimated_tokens, usage_tokens(response))
+            return response
+
+    def stats(self) -> dict:
+        """Return the number of rate-limited responses and retries so far."""
+        with self._lock:
+            return {"rate_limited": self.rate_limited, "retries": self.retries}
+
+
+def usage_tokens(response):
+    """Return the total tokens reported by a response, or None if it has no usage."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    return usage.total_tokens
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def configure_rate_limiter(
+    requests_per_minute: float = None, tokens_per_minute: float = None, **kwargs
+) -> RateLimiter:
+    """
+    Create the process-wide rate limiter.
+
+    Unset budgets fall back to the ``UNITTEST_LLM_RPM`` and ``UNITTEST_LLM_TPM``
+    environment variables; without either the budget is unlimited and only the
+    backoff applies.
+    """
+    global _rate_limiter
+    if requests_per_minute is None and os.getenv("UNITTEST_LLM_RPM"):
+        requests_per_minute = float(os.getenv("UNITTEST_LLM_RPM"))
+    if tokens_per_minute is None and os.getenv("UNITTEST_LLM_TPM"):
+        tokens_per_minute = float(os.getenv("UNITTEST_LLM_TPM"))
+    with _rate_limiter_lock:
+        _rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute, **kwargs)
+    return _rate_limiter
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Return the process-wide rate limiter, creating it on first use."""
+    if _rate_limiter is None:
+        return configure_rate_limiter()
+    return _rate_limiter
@@ -0,0 +1,282 @@
+"""
+Time, CPU and memory limits of generated tests.
+
+Generated tests can loop forever or allocate without bound. ``LimitGuard`` is
+a pytest plugin that bounds the wall time of every test (``SIGALRM``) and the
+CPU time and address space of a session (``RLIMIT_CPU``, ``RLIMIT_AS``); the
+caller additionally bounds the wall time of a whole pytest run and kills the
+process when it is exceeded. Tests stopped by a limit are reported with the
+outcome ``"resource"`` instead of ``"failed"``.
+
+The signal and rlimit based limits only work on POSIX systems and in the main
+thread; elsewhere only the per-run wall-clock limit applies.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import signal
+import threading
+
+import pytest
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_TEST_TIMEOUT = 10.0
+DEFAULT_RUN_TIMEOUT = 300.0
+DEFAULT_CPU_SECONDS = 120
+DEFAULT_MEMORY_MB = 2048
+
+
+class ResourceLimitExceeded(BaseException):
+    """
+    A test exceeded a resource limit.
+
+    Derives from BaseException so that ``except Exception`` in the code under
+    test cannot swallow it.
+    """
+
+
+class TimeLimitExceeded(ResourceLimitExceeded):
+    """A test ran longer than the per-test wall-clock limit."""
+
+
+class CpuLimitExceeded(ResourceLimitExceeded):
+    """A pytest session used more CPU time than allowed."""
+
+
+# Exceptions marking a test result as a resource failure instead of a test failure
+RESOURCE_EXCEPTIONS = ("TimeLimitExceeded", "CpuLimitExceeded", "MemoryError")
+
+
+class ResourceLimits:
+    """
+    The limits of the generated tests; None disables a limit.
+
+    Parameters
+    ----------
+    test_timeout : float
+        Wall-clock seconds of one test (setup, call and teardown each).
+    run_timeout : float
+        Wall-clock seconds of a whole pytest run; the process is killed after it.
+    cpu_seconds : int
+        CPU seconds of a pytest session.
+    memory_mb : int
+        Address space a pytest session may add, in MiB.
+    """
+
+    def __init__(
+        self,
+        test_timeout: float = DEFAULT_TEST_TIMEOUT,
+        run_timeout: float = DEFAULT_RUN_TIMEOUT,
+        cpu_seconds: int = DEFAULT_CPU_SECONDS,
+        memory_mb: int = DEFAULT_MEMORY_MB,
+    ):
+        self.test_timeout = test_timeout
+        self.run_timeout = run_timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+
+    def session_limits(self) -> dict:
+        """The limits enforced inside the pytest process, see ``LimitGuard``."""
+        return {
+            "test_timeout": self.test_timeout,
+            "cpu_seconds": self.cpu_seconds,
+            "memory_mb": self.memory_mb,
+        }
+
+
+def _address_space() -> int:
+    # Current virtual memory size in bytes (Linux), 0 if unknown
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class LimitGuard:
+    """
+    Pytest plugin enforcing the per-test and per-session limits.
+
+    The limits are relative to the state at session start and restored at its
+    end (or by ``restore`` if the session is aborted), so a long-lived process
+    (the warm pytest worker) can run many limited sessions; only soft limits
+    are changed.
+
+    Parameters
+    ----------
+    limits : dict
+        ``test_timeout``, ``cpu_seconds`` and ``memory_mb``, see ``ResourceLimits``.
+    """
+
+    def __init__(self, limits: dict):
+        self.limits = limits
+        self._restore = []
+        self._enabled = (
+            resource is not None and threading.current_thread() is threading.main_thread()
+        )
+
+    def _set_rlimit(self, kind: int, soft: int) -> None:
+        previous = resource.getrlimit(kind)
+        hard = previous[1]
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        try:
+            resource.setrlimit(kind, (soft, hard))
+        except (ValueError, OSError) as e:
+            logging.warning(f"Cannot set resource limit {kind}: {e}")
+            return
+        self._restore.append(lambda: resource.setrlimit(kind, previous))
+
+    def _on_cpu_limit(self, signum, frame):
+        raise CpuLimitExceeded(f"CPU time limit of {self.limits['cpu_seconds']}s exceeded")
+
+    def _on_alarm(self, signum, frame):
+        raise TimeLimitExceeded(f"Test exceeded the time limit of {self.limits['test_timeout']}s")
+
+    def pytest_sessionstart(self, session):
+        if not self._enabled:
+            return
+        if self.limits.get("cpu_seconds"):
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = int(usage.ru_utime + usage.ru_stime) + 1
+            previous = signal.signal(signal.SIGXCPU, self._on_cpu_limit)
+            self._restore.append(lambda: signal.signal(signal.SIGXCPU, previous))
+            self._set_rlimit(resource.RLIMIT_CPU, used + int(self.limits["cpu_seconds"]))
+        if self.limits.get("memory_mb"):
+            self._set_rlimit(
+                resource.RLIMIT_AS,
+                _address_space() + int(self.limits["memory_mb"]) * 1024 * 1024,
+            )
+        if self.limits.get("test_timeout"):
+            previous_alarm = signal.signal(signal.SIGALRM, self._on_alarm)
+            self._restore.append(lambda: signal.signal(signal.SIGALRM, previous_alarm))
+
+    def restore(self) -> None:
+        """Restore the limits and signal handlers changed at session start; idempotent."""
+        while self._restore:
+            self._restore.pop()()
+
+    def pytest_sessionfinish(self, session):
+        self.restore()
+
+    def pytest_unconfigure(self, config):
+        # The session may have been aborted before pytest_sessionfinish
+        self.restore()
+
+    @contextlib.contextmanager
+    def _timed(self):
+        timeout = self.limits.get("test_timeout") if self._enabled else None
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            yield
+        finally:
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_setup(self, item):
+        with self._timed():
+            yield
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_call(self, item):
+        with self._timed():
+            yield
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_teardown(self, item):
+        with self._timed():
+            yield
+
+
+def limit_args(limits: dict) -> list:
+    """Return the pytest arguments enforcing ``limits`` (see ``LimitGuard``) in a subprocess."""
+    return ["-p", __name__, f"--resource-limits={json.dumps(limits)}"]
+
+
+def timed_out_result(test_file: str, timeout: float) -> dict:
+    """Return the ``run_pytest`` result of a run that was killed after ``timeout`` seconds."""
+    message = f"The pytest run was killed after exceeding the time limit of {timeout}s"
+    return {
+        "returncode": -signal.SIGKILL if hasattr(signal, "SIGKILL") else -1,
+        "stdout": "",
+        "stderr": message,
+        "tests": [
+            {
+                "nodeid": test_file,
+                "outcome": "resource",
+                "duration": timeout,
+                "exception": "TimeLimitExceeded",
+                "message": message,
+                "traceback": None,
+            }
+        ],
+        "coverage": None,
+    }
+
+
+_resource_limits = None
+_resource_limits_lock = threading.Lock()
+
+
+def configure_resource_limits(
+    test_timeout: float = None,
+    run_timeout: float = None,
+    cpu_seconds: int = None,
+    memory_mb: int = None,
+) -> ResourceLimits:
+    """
+    Set the process-wide limits of the generated tests.
+
+    Unset limits fall back to the ``UNITTEST_LLM_TEST_TIMEOUT``,
+    ``UNITTEST_LLM_RUN_TIMEOUT``, ``UNITTEST_LLM_CPU_SECONDS`` and
+    ``UNITTEST_LLM_MEMORY_MB`` environment variables and then to the defaults;
+    0 disables a limit.
+    """
+    global _resource_limits
+
+    def pick(value, variable, default, kind):
+        if value is None:
+            value = kind(os.getenv(variable)) if os.getenv(variable) else default
+        return value or None
+
+    limits = ResourceLimits(
+        test_timeout=pick(test_timeout, "UNITTEST_LLM_TEST_TIMEOUT", DEFAULT_TEST_TIMEOUT, float),
+        run_timeout=pick(run_timeout, "UNITTEST_LLM_RUN_TIMEOUT", DEFAULT_RUN_TIMEOUT, float),
+        cpu_seconds=pick(cpu_seconds, "UNITTEST_LLM_CPU_SECONDS", DEFAULT_CPU_SECONDS, int),
+        memory_mb=pick(memory_mb, "UNITTEST_LLM_MEMORY_MB", DEFAULT_MEMORY_MB, int),
+    )
+    with _resource_limits_lock:
+        _resource_limits = limits
+    return limits
+
+
+def get_resource_limits() -> ResourceLimits:
+    """Return the process-wide limits, creating the defaults on first use."""
+    if _resource_limits is None:
+        return configure_resource_limits()
+    return _resource_limits
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--resource-limits",
+        action="store",
+        default=None,
+        help="JSON object with the test_timeout, cpu_seconds and memory_mb limits.",
+    )
+
+
+def pytest_configure(config):
+    if config.getoption("--resource-limits"):
+        config.pluginmanager.register(
+            LimitGuard(json.loads(config.getoption("--resource-limits"))),
+            "unittest_llm_limits",
+        )
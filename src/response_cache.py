@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+DEFAULT_CACHE_DIR = os.path.join(os.getcwd(), ".llm_cache", "responses")
+DEFAULT_MAX_ENTRIES = 2000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    Disk-backed, content-addressed cache for chat-completion responses.
+
+    Every entry is stored as a JSON file named after the SHA-256 of the request
+    (model, messages and temperature). The file modification time doubles as the
+    last-access time, so the least recently used entries are evicted first once
+    the cache grows beyond ``max_entries`` or ``max_bytes``.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory holding the cache entries (default is ``.llm_cache/responses``
+        in the current working directory).
+    max_entries : int, optional
+        Maximum number of entries kept on disk.
+    max_bytes : int, optional
+        Maximum total size of all entries on disk.
+    bypass : bool, optional
+        If True, lookups always miss and nothing is written (default is False).
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_CACHE_DIR,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        bypass: bool = False,
+    ):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, messages: list, temperature: float) -> str:
+        """Return the content address of a chat-completion request."""
+        payload = json.dumps(
+            {"model": model, "messages": messages, "temperature": temperature},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str):
+        """
+        Look up a cached value.
+
+        Returns
+        -------
+        dict or None
+            The cached value, or None on a miss or when the cache is bypassed.
+        """
+        if self.bypass:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                value = json.load(f)
+            # Touch the entry so eviction sees it as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value) -> None:
+        """Store a JSON-serialisable value and evict old entries if needed."""
+        if self.bypass:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logging.warning(f"Unable to write response cache entry {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def delete(self, key: str) -> None:
+        """Drop a single entry, e.g. a response that turned out to be unusable."""
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total_bytes = sum(size for _, size, _ in entries)
+            entries.sort()
+            while entries and (
+                len(entries) > self.max_entries or total_bytes > self.max_bytes
+            ):
+                _, size, path = entries.pop(0)
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_bytes -= size
+
+    def clear(self) -> None:
+        """Remove every entry from the cache directory."""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                os.remove(os.path.join(self.directory, name))
+
+    def stats(self) -> dict:
+        """Return the hit/miss counters of this cache instance."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bypass": self.bypass}
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def configure_response_cache(
+    directory: str = None,
+    max_entries: int = None,
+    max_bytes: int = None,
+    bypass: bool = None,
+) -> ResponseCache:
+    """
+    Create the process-wide response cache.
+
+    Unset arguments fall back to the environment variables
+    ``UNITTEST_LLM_CACHE_DIR``, ``UNITTEST_LLM_CACHE_MAX_ENTRIES``,
+    ``UNITTEST_LLM_CACHE_MAX_BYTES`` and ``UNITTEST_LLM_NO_CACHE``, and then to
+    the module defaults.
+    """
+    global _response_cache
+    if directory is None:
+        directory = os.getenv("UNITTEST_LLM_CACHE_DIR", DEFAULT_CACHE_DIR)
+    if max_entries is None:
+        max_entries = int(
+            os.getenv("UNITTEST_LLM_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)
+        )
+    if max_bytes is None:
+        max_bytes = int(os.getenv("UNITTEST_LLM_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+    if bypass is None:
+        bypass = os.getenv("UNITTEST_LLM_NO_CACHE", "") not in ("", "0", "false")
+
+    with _response_cache_lock:
+        _response_cache = ResponseCache(
+            directory=directory,
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            bypass=bypass,
+        )
+    return _response_cache
+
+
+def get_response_cache() -> ResponseCache:
+    """Return the process-wide response cache, creating it on first use."""
+    if _response_cache is None:
+        return configure_response_cache()
+    return _response_cache
@@ -0,0 +1,258 @@
+"""
+Dependency slices of a target as prompt context.
+
+The model only sees the code of the target, so it has to guess the helpers,
+constants and imports the target uses, and the class around a method. A
+slice collects these statically from the target's module: the module-level
+names the target refers to, transitively, the imports providing them and, for
+methods, a skeleton of the enclosing class (class attributes and method
+signatures, with the methods called through ``self`` in full). Nearer
+dependencies are kept first until the token budget is spent; definitions that
+do not fit anymore are shortened to their signature.
+"""
+
+import ast
+import copy
+import functools
+import os
+
+from src.symbol_index import get_symbol_index
+
+DEFAULT_CONTEXT_TOKENS = 1000
+
+_DEFINITIONS = (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def count_tokens(text: str) -> int:
+    """Approximate the tokens of ``text`` like ``src.rate_limiter.estimate_tokens``."""
+    return len(text) // 4
+
+
+@functools.lru_cache(maxsize=64)
+def _parse(path: str, state: tuple) -> tuple:
+    # ``state`` (mtime and size) only invalidates the cache entry of a changed file
+    with open(path, "r") as f:
+        source = f.read()
+    return ast.parse(source), source.splitlines()
+
+
+def _span(node: ast.AST) -> tuple:
+    first_line = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+    return first_line, node.end_lineno
+
+
+def _text(lines: list, node: ast.AST) -> str:
+    first_line, last_line = _span(node)
+    return "\n".join(lines[first_line - 1 : last_line])
+
+
+def _references(node: ast.AST) -> tuple:
+    """The names ``node`` loads and the attributes it uses on ``self``/``cls``."""
+    names, members = [], []
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name):
+            names.append(child.id)
+        elif (
+            isinstance(child, ast.Attribute)
+            and isinstance(child.value, ast.Name)
+            and child.value.id in ("self", "cls")
+        ):
+            members.append(child.attr)
+    return list(dict.fromkeys(names)), list(dict.fromkeys(members))
+
+
+def _bound_names(node: ast.AST) -> list:
+    """The module-level names a top-level statement binds."""
+    if isinstance(node, _DEFINITIONS):
+        return [node.name]
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return [(alias.asname or alias.name).split(".")[0] for alias in node.names]
+    if isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+        targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+        return [
+            child.id
+            for target in targets
+            for child in ast.walk(target)
+            if isinstance(child, ast.Name)
+        ]
+    return []
+
+
+def _stub(node: ast.AST) -> str:
+    """The signature of a function or the header of a class, without its body."""
+    stub = copy.copy(node)
+    stub.body = [ast.Expr(ast.Constant(...))]
+    return ast.unparse(stub)
+
+
+def _class_skeleton(cls: ast.ClassDef, lines: list, target: ast.AST, full: set) -> str:
+    """
+    Render ``cls`` with its attributes and member signatures.
+
+    The members in ``full`` are rendered completely, the target is elided.
+    """
+    stub = _stub(cls)
+    # Decorators and the class statement, without the elided body
+    parts = [stub[: stub.rindex("\n")]]
+    indent = " " * (cls.body[0].col_offset if cls.body else 4)
+    for member in cls.body:
+        if member is target:
+            # An expression, so a class of only the target still parses
+            parts.append(f"{indent}...  # the code under test")
+        elif isinstance(member, _DEFINITIONS) and member.name in full:
+            parts.append(_text(lines, member))
+        elif isinstance(member, _DEFINITIONS):
+            parts.append(_indented(_stub(member), indent))
+        elif isinstance(member, (ast.Assign, ast.AnnAssign)):
+            parts.append(_text(lines, member))
+    return "\n".join(parts)
+
+
+def _indented(text: str, indent: str) -> str:
+    return "\n".join(indent + line for line in text.splitlines())
+
+
+def _filtered_import(node: ast.AST, names: set) -> str:
+    """Render an import statement with only the aliases binding ``names``."""
+    aliases = [
+        alias for alias in node.names if (alias.asname or alias.name).split(".")[0] in names
+    ]
+    if isinstance(node, ast.Import):
+        return ast.unparse(ast.Import(names=aliases))
+    return ast.unparse(ast.ImportFrom(module=node.module, names=aliases, level=node.level))
+
+
+def _find_target(tree: ast.Module, symbol: dict) -> list:
+    """The chain of definitions from the top level down to the target."""
+
+    def visit(node, chain):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, _DEFINITIONS):
+                if _span(child) == (symbol["first_line"], symbol["last_line"]):
+                    return chain + [child]
+                found = visit(child, chain + [child])
+            else:
+                found = visit(child, chain)
+            if found:
+                return found
+        return None
+
+    return visit(tree, []) or []
+
+
+def dependency_slice(
+    source_file: str, name: str, token_budget: int = DEFAULT_CONTEXT_TOKENS
+) -> str:
+    """
+    Return the module context of a target that fits into ``token_budget``.
+
+    Parameters
+    ----------
+    source_file : str
+        The file defining the target.
+    name : str
+        The plain or qualified name of the target, see ``SymbolIndex.lookup``.
+    token_budget : int
+        Approximate tokens the context may take, see ``count_tokens``.
+
+    Returns
+    -------
+    str
+        The imports, module-level definitions and enclosing class skeleton the
+        target depends on, in source order; empty if there are none or the
+        target cannot be found.
+    """
+    path = os.path.abspath(source_file)
+    symbol = get_symbol_index().lookup(path, name)
+    if symbol is None or not token_budget:
+        return ""
+    stat = os.stat(path)
+    tree, lines = _parse(path, (stat.st_mtime_ns, stat.st_size))
+    chain = _find_target(tree, symbol)
+    if not chain:
+        return ""
+    target, top = chain[-1], chain[0]
+
+    bindings = {}
+    for node in tree.body:
+        for bound in _bound_names(node):
+            bindings.setdefault(bound, node)
+
+    # Breadth-first over module-level names, so nearer dependencies come first
+    names, members = _references(target)
+    enclosing = next(
+        (node for node in reversed(chain[:-1]) if isinstance(node, ast.ClassDef)), None
+    )
+    if enclosing is not None:
+        # The bases and decorators of the class and the members used through self
+        outside = enclosing.bases + enclosing.decorator_list + [
+            member
+            for member in enclosing.body
+            if isinstance(member, _DEFINITIONS) and member.name in members
+        ]
+        names += _references(ast.Module(body=outside, type_ignores=[]))[0]
+    ordered, seen, used_imports = [], {top}, {}
+    queue = list(names)
+    while queue:
+        referenced = queue.pop(0)
+        node = bindings.get(referenced)
+        if node is None:
+            continue
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            used_imports.setdefault(node, set()).add(referenced)
+            continue
+        if node in seen:
+            continue
+        seen.add(node)
+        ordered.append(node)
+        queue += _references(node)[0]
+
+    # The class skeleton and the imports come first, then the definitions by distance
+    budget = token_budget
+    chosen = {}
+    if enclosing is not None:
+        full = set()
+        skeleton = _class_skeleton(enclosing, lines, target, full)
+        # __init__ shows the attributes of the instances the target works on
+        for member in members + ["__init__"]:
+            candidate = _class_skeleton(enclosing, lines, target, full | {member})
+            if candidate != skeleton and count_tokens(candidate) <= budget:
+                full.add(member)
+                skeleton = candidate
+        if count_tokens(skeleton) <= budget:
+            chosen[enclosing] = skeleton
+            budget -= count_tokens(skeleton)
+    for node, imported in used_imports.items():
+        text = _filtered_import(node, imported)
+        if count_tokens(text) <= budget:
+            chosen[node] = text
+            budget -= count_tokens(text)
+    for node in ordered:
+        text = _text(lines, node)
+        if count_tokens(text) > budget and isinstance(node, _DEFINITIONS):
+            text = _stub(node)
+        if count_tokens(text) <= budget:
+            chosen[node] = text
+            budget -= count_tokens(text)
+
+    parts = [chosen[node] for node in tree.body if node in chosen]
+    return "\n\n".join(parts)
+
+
+def class_skeleton(source_file: str, name: str) -> str:
+    """
+    Return the skeleton of the class ``name`` of ``source_file``.
+
+    The skeleton has the class statement, the class attributes, ``__init__``
+    and the signatures of all other members; None if ``name`` is not a class.
+    """
+    path = os.path.abspath(source_file)
+    symbol = get_symbol_index().lookup(path, name)
+    if symbol is None or symbol["kind"] != "class":
+        return None
+    stat = os.stat(path)
+    tree, lines = _parse(path, (stat.st_mtime_ns, stat.st_size))
+    chain = _find_target(tree, symbol)
+    if not chain:
+        return None
+    return _class_skeleton(chain[-1], lines, None, {"__init__"})
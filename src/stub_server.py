@@ -0,0 +1,357 @@
+"""
+Local stand-in for the OpenAI chat-completions endpoint.
+
+Answers every request with a scripted or templated response after a
+configurable latency and injects server errors, 429s and timeouts at the
+given rates, so the pipeline can be benchmarked without an API key or budget.
+Point the client at it with ``OPENAI_BASE_URL=http://127.0.0.1:<port>/v1``.
+
+Usage:
+    python -m src.stub_server --port 8765 --latency 0.5 --rate_limit_rate 0.05
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PLAN_TEMPLATE = "\n".join(
+    f"- Scenario {i}: the code is called with representative input {i}\n"
+    f"    - example {i}a\n    - example {i}b"
+    for i in range(1, 13)
+)
+EXPLANATION_TEMPLATE = (
+    "- The code takes its arguments and returns a result.\n"
+    "- Every conditional branch is covered by the plan below."
+)
+TESTS_TEMPLATE = """```python
+# imports
+import pytest  # used for our unit tests
+
+# function to test
+{import_line}
+
+
+# unit tests
+def test_stub_server_answer():
+    # Templated answer of the local stand-in server
+    assert {assertion}
+```"""
+# The import line of the test module header the execute prompts prescribe
+_TARGET_IMPORT = re.compile(r"from (src\.[\w.]+) import ([^\n]*)")
+
+
+def templated_tests(prompt: str) -> str:
+    """
+    Return a passing test module importing the target named in ``prompt``.
+
+    The target has to be imported for its coverage to be measured, as in
+    real answers; without a target in the prompt the tests import nothing.
+    """
+    match = _TARGET_IMPORT.search(prompt)
+    if match is None:
+        return TESTS_TEMPLATE.format(import_line="", assertion="True")
+    module, names = match.groups()
+    # The header imports the name of the code, e.g. "def target_0" for a function
+    words = names.split()
+    name = words[-1].rstrip(":") if words else ""
+    if not name.isidentifier():
+        return TESTS_TEMPLATE.format(import_line=f"import {module}", assertion="True")
+    return TESTS_TEMPLATE.format(
+        import_line=f"from {module} import {name}", assertion=f"callable({name})"
+    )
+
+
+def templated_answer(messages: list) -> str:
+    """
+    Return a plausible answer for the pipeline step the request belongs to.
+
+    Requests for code get a passing test module of the target, correction requests get the
+    submitted code back unchanged, fused requests get all three sections and
+    explanations and plans a bulleted list long enough to skip the elaboration.
+    """
+    prompt = (messages[-1].get("content") or "") if messages else ""
+    if "## Test plan" in prompt:
+        return (
+            f"## Explanation\n{EXPLANATION_TEMPLATE}\n\n"
+            f"## Test plan\n{PLAN_TEMPLATE}\n\n## Tests\n{templated_tests(prompt)}"
+        )
+    if "correct the following Python function" in prompt:
+        blocks = re.findall(r"```python\n(.*?)```", prompt, re.S)
+        return f"```python\n{blocks[-1] if blocks else ''}```"
+    if "python" in prompt and ("Reply only with code" in prompt or "```python block" in prompt):
+        return templated_tests(prompt)
+    return PLAN_TEMPLATE
+
+
+class StubBehaviour:
+    """
+    Latency, failure rates and scripted answers of the stand-in server.
+
+    Parameters
+    ----------
+    latency : float, optional
+        Mean seconds before the first byte of a response.
+    jitter : float, optional
+        Fraction of ``latency`` by which single responses vary.
+    chunk_delay : float, optional
+        Seconds between two streamed chunks.
+    error_rate, rate_limit_rate, timeout_rate : float, optional
+        Fractions of requests answered with a 500, with a 429 carrying
+        ``Retry-After: retry_after``, or not answered for ``timeout`` seconds.
+    script : list, optional
+        ``{"match": regex, "content": str}`` rules; the first rule matching the
+        last message wins, otherwise the templated answer is used.
+    seed : int, optional
+        Seed of the random failure injection.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        chunk_delay: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        timeout_rate: float = 0.0,
+        retry_after: float = 1.0,
+        timeout: float = 30.0,
+        script: list = None,
+        seed: int = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.retry_after = retry_after
+        self.timeout = timeout
+        self.script = [(re.compile(rule["match"], re.S), rule["content"]) for rule in script or []]
+        self.random = random.Random(seed)
+        self.counts = {"requests": 0, "errors": 0, "rate_limited": 0, "timeouts": 0}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def next_id(self) -> str:
+        with self._lock:
+            return f"chatcmpl-stub-{next(self._ids)}"
+
+    def outcome(self) -> str:
+        """Draw whether a request succeeds or fails, and how."""
+        with self._lock:
+            self.counts["requests"] += 1
+            draw = self.random.random()
+            for name, counter, rate in (
+                ("rate_limited", "rate_limited", self.rate_limit_rate),
+                ("error", "errors", self.error_rate),
+                ("timeout", "timeouts", self.timeout_rate),
+            ):
+                if draw < rate:
+                    self.counts[counter] += 1
+                    return name
+                draw -= rate
+            return "ok"
+
+    def delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def answer(self, messages: list) -> str:
+        prompt = (messages[-1].get("content") or "") if messages else ""
+        for pattern, content in self.script:
+            if pattern.search(prompt):
+                return content
+        return templated_answer(messages)
+
+
+def _usage(messages: list, content: str) -> dict:
+    prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4 + 4 * len(messages)
+    completion_tokens = len(content) // 4 + 1
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    behaviour: StubBehaviour = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(f"stub server: {format % args}")
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str, kind: str, headers: dict = None):
+        self._send_json(status, {"error": {"message": message, "type": kind}}, headers)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_error(404, f"Unknown path {self.path}", "invalid_request_error")
+            return
+
+        behaviour = self.behaviour
+        outcome = behaviour.outcome()
+        if outcome == "timeout":
+            # Hold the connection until the client gives up
+            time.sleep(behaviour.timeout)
+            self.close_connection = True
+            return
+        time.sleep(behaviour.delay())
+        if outcome == "rate_limited":
+            self._send_error(
+                429,
+                "Rate limit reached (stub server)",
+                "rate_limit_exceeded",
+                {"Retry-After": f"{behaviour.retry_after:g}"},
+            )
+            return
+        if outcome == "error":
+            self._send_error(500, "Internal error (stub server)", "server_error")
+            return
+
+        messages = request.get("messages", [])
+        model = request.get("model", "stub")
+        content = behaviour.answer(messages)
+        completion_id = behaviour.next_id()
+        created = int(time.time())
+        usage = _usage(messages, content)
+        if request.get("stream"):
+            include_usage = (request.get("stream_options") or {}).get("include_usage")
+            self._stream(completion_id, created, model, content, usage if include_usage else None)
+            return
+        self._send_json(
+            200,
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                ],
+                "usage": usage,
+            },
+        )
+
+    def _stream(self, completion_id, created, model, content, usage, chunk_size=16):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(choices, usage=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+            }
+            if usage is not None:
+                payload["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode())
+            self.wfile.flush()
+
+        try:
+            event([{"index": 0, "delta": {"role": "assistant", "content": ""}}])
+            for start in range(0, len(content), chunk_size):
+                if self.behaviour.chunk_delay:
+                    time.sleep(self.behaviour.chunk_delay)
+                event([{"index": 0, "delta": {"content": content[start : start + chunk_size]}}])
+            event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if usage is not None:
+                event([], usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client cancelled the stream, e.g. at the closing code fence
+            pass
+
+
+def start_stub_server(behaviour: StubBehaviour = None, host: str = "127.0.0.1", port: int = 0):
+    """
+    Start the stand-in server on a daemon thread.
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The running server; its base URL is ``http://{host}:{server.server_port}/v1``.
+        Stop it with ``server.shutdown()``.
+    """
+    handler = type("BoundStubHandler", (StubHandler,), {"behaviour": behaviour or StubBehaviour()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Stub server listening on http://{host}:{server.server_port}/v1")
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean seconds per response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Relative variation of the latency")
+    parser.add_argument("--chunk_delay", type=float, default=0.0, help="Seconds between streamed chunks")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of 500 responses")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Fraction of 429 responses")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After of the 429s in seconds")
+    parser.add_argument("--timeout_rate", type=float, default=0.0, help="Fraction of requests never answered")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds an unanswered request is held")
+    parser.add_argument("--script", type=str, default=None, help='JSON file with [{"match": regex, "content": answer}, ...]')
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    script = None
+    if args.script:
+        with open(args.script, "r") as f:
+            script = json.load(f)
+    behaviour = StubBehaviour(
+        latency=args.latency,
+        jitter=args.jitter,
+        chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        timeout_rate=args.timeout_rate,
+        retry_after=args.retry_after,
+        timeout=args.timeout,
+        script=script,
+        seed=args.seed,
+    )
+    server = start_stub_server(behaviour, args.host, args.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        logging.info(f"Stub server counts: {behaviour.counts}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
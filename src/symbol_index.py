@@ -0,0 +1,349 @@
+"""
+Persistent index of the classes, functions and methods of a source tree.
+
+Every definition of a file is recorded once with its qualified name (e.g.
+``Class.method`` or ``outer.inner``), kind, line span (including decorators)
+and normalized AST hash (see ``src.ast_hash``). Entries are kept per file and
+re-parsed only when the file's modification time or size changes, so looking
+up a symbol is a ``stat`` and a dictionary access instead of a parse of the
+whole file. The index is stored as JSON (default
+``.llm_cache/symbol_index.json``) and shared between runs.
+"""
+
+import ast
+import json
+import logging
+import os
+import textwrap
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from src.ast_hash import definition_ast_hashes
+from src.atomic_file import atomic_write, locked
+
+DEFAULT_INDEX_FILE = os.path.join(os.getcwd(), ".llm_cache", "symbol_index.json")
+# Bump when the records change, older index files are then rebuilt
+INDEX_VERSION = 2
+# Below this many changed files an update is parsed without a process pool
+MIN_PARALLEL_FILES = 64
+
+_DEFINITIONS = (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def _kind(node: ast.AST, parent: ast.AST) -> str:
+    if isinstance(node, ast.ClassDef):
+        return "class"
+    prefix = "async " if isinstance(node, ast.AsyncFunctionDef) else ""
+    return prefix + ("method" if isinstance(parent, ast.ClassDef) else "function")
+
+
+def extract_symbols(tree: ast.Module) -> list:
+    """
+    Return the records of all definitions in ``tree``, in source order.
+
+    Every record has the ``qualname``, ``name``, ``kind`` (``class``,
+    ``function``, ``method``, ``async function`` or ``async method``),
+    ``first_line`` (the first decorator, if any), ``last_line``,
+    ``ast_hash`` and ``references`` (the names and attributes it uses) of a
+    definition. Definitions nested in functions are included.
+    """
+    symbols = []
+    hashes = definition_ast_hashes(tree)
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, _DEFINITIONS):
+                visit(child, prefix)
+                continue
+            qualname = f"{prefix}.{child.name}" if prefix else child.name
+            symbols.append(
+                {
+                    "qualname": qualname,
+                    "name": child.name,
+                    "kind": _kind(child, node),
+                    "first_line": min([child.lineno] + [d.lineno for d in child.decorator_list]),
+                    "last_line": child.end_lineno,
+                    "ast_hash": hashes[child],
+                    "references": _references(child),
+                }
+            )
+            visit(child, qualname)
+
+    visit(tree, "")
+    return symbols
+
+
+def _references(node: ast.AST) -> list:
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name):
+            names.add(child.id)
+        elif isinstance(child, ast.Attribute):
+            names.add(child.attr)
+    return sorted(names)
+
+
+def extract_imports(tree: ast.Module) -> list:
+    """Return the modules ``tree`` imports from, e.g. ``src.utils`` or ``.utils`` (relative)."""
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            module = "." * node.level + (node.module or "")
+            modules.add(module)
+            # from package import module
+            modules.update(
+                f"{module}.{alias.name}" if node.module else module + alias.name
+                for alias in node.names
+            )
+    return sorted(modules)
+
+
+def _file_state(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def build_entry(path: str, state: list = None) -> dict:
+    """
+    Parse ``path`` and return its index entry.
+
+    The entry holds the file ``state`` (modification time and size) it was
+    built from, the ``symbols`` (see ``extract_symbols``), the ``imports``
+    (see ``extract_imports``) and the parse ``error``, if any. Runs in the worker processes of ``SymbolIndex.update``.
+    """
+    if state is None:
+        state = _file_state(path)
+    with open(path, "r") as f:
+        source = f.read()
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError) as e:
+        # ValueError: source code string cannot contain null bytes
+        return _failed_entry(state, e)
+    # Imports first, the hashes of extract_symbols strip the docstrings in place
+    imports = extract_imports(tree)
+    return {"state": state, "symbols": extract_symbols(tree), "imports": imports, "error": None}
+
+
+def _failed_entry(state: list, error: Exception) -> dict:
+    return {
+        "state": state,
+        "symbols": [],
+        "imports": [],
+        "error": f"{type(error).__name__}: {error}",
+    }
+
+
+def _index_in_worker(item):
+    path, state = item
+    try:
+        return path, build_entry(path, state)
+    except (OSError, UnicodeDecodeError) as e:
+        return path, _failed_entry(state, e)
+
+
+class SymbolIndex:
+    """
+    On-disk index of the definitions of Python files, invalidated per file.
+
+    Parameters
+    ----------
+    index_file : str, optional
+        JSON file holding the index (default is ``.llm_cache/symbol_index.json``
+        in the current working directory); None keeps it in memory only.
+    """
+
+    def __init__(self, index_file: str = DEFAULT_INDEX_FILE):
+        self.index_file = index_file
+        self.files = {}
+        self.parsed = 0
+        self._lookup = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        """Read the index file, ignoring it if it is missing, corrupt or outdated."""
+        if not self.index_file:
+            return
+        try:
+            with open(self.index_file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get("version") != INDEX_VERSION:
+            return
+        with self._lock:
+            self.files = data.get("files", {})
+            self._lookup = {}
+
+    def save(self) -> None:
+        """Write the index file if any entry changed since it was loaded."""
+        if not self.index_file or not self._dirty:
+            return
+        with self._lock:
+            payload = json.dumps({"version": INDEX_VERSION, "files": self.files})
+            self._dirty = False
+        with locked(self.index_file):
+            atomic_write(self.index_file, payload)
+
+    def _store(self, path: str, entry: dict) -> dict:
+        # Called with the lock held
+        if entry["error"]:
+            logging.warning(f"Cannot index {path}: {entry['error']}")
+        self.files[path] = entry
+        self._lookup.pop(path, None)
+        self.parsed += 1
+        self._dirty = True
+        return entry
+
+    def _refresh(self, path: str) -> dict:
+        # Called with the lock held
+        state = _file_state(path)
+        entry = self.files.get(path)
+        if entry is not None and entry["state"] == state:
+            return entry
+        if state is None:
+            self.files.pop(path, None)
+            self._lookup.pop(path, None)
+            self._dirty = True
+            raise IOError(f"Unable to read file {path}")
+        return self._store(path, build_entry(path, state))
+
+    def symbols(self, path: str) -> list:
+        """Return the records of every definition in ``path``, see ``extract_symbols``."""
+        path = os.path.abspath(path)
+        with self._lock:
+            return list(self._refresh(path)["symbols"])
+
+    def lookup(self, path: str, name: str):
+        """
+        Return the record of ``name`` in ``path``, or None if it is not defined there.
+
+        ``name`` is a qualified name (``Class.method``) or a plain name; a
+        plain name that is not also a qualified name (e.g. of a module-level
+        function) resolves to its first definition in source order.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._refresh(path)
+            names = self._lookup.get(path)
+            if names is None:
+                names = {}
+                for symbol in entry["symbols"]:
+                    names.setdefault(symbol["name"], symbol)
+                names.update((symbol["qualname"], symbol) for symbol in entry["symbols"])
+                self._lookup[path] = names
+            return names.get(name)
+
+    def imports(self, path: str) -> list:
+        """Return the modules ``path`` imports from, see ``extract_imports``."""
+        path = os.path.abspath(path)
+        with self._lock:
+            return list(self._refresh(path)["imports"])
+
+    def error(self, path: str):
+        """Return why ``path`` could not be indexed, or None."""
+        path = os.path.abspath(path)
+        with self._lock:
+            return self._refresh(path)["error"]
+
+    def update(self, paths: list, workers: int = None) -> dict:
+        """
+        Bring the entries of ``paths`` up to date and drop those of deleted files.
+
+        Files that changed are parsed on a pool of ``workers`` processes
+        (default: one per CPU) and stored as their results come in; small
+        updates are parsed in this process, where starting a pool costs more
+        than it saves.
+
+        Returns
+        -------
+        dict
+            The number of ``files`` checked, ``parsed`` again and ``removed``,
+            the elapsed ``seconds`` and the parsed ``files_per_second``.
+        """
+        start = time.perf_counter()
+        paths = list(dict.fromkeys(os.path.abspath(path) for path in paths))
+        with self._lock:
+            removed = [path for path in self.files if not os.path.exists(path)]
+            for path in removed:
+                del self.files[path]
+                self._lookup.pop(path, None)
+            self._dirty = self._dirty or bool(removed)
+            stale = []
+            for path in paths:
+                state = _file_state(path)
+                entry = self.files.get(path)
+                if state is not None and (entry is None or entry["state"] != state):
+                    stale.append((path, state))
+
+        workers = workers or os.cpu_count() or 1
+        if len(stale) < MIN_PARALLEL_FILES:
+            workers = 1
+        if workers > 1:
+            # Enough batches per worker to balance files of very different sizes
+            chunksize = max(1, len(stale) // (workers * 8))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for path, entry in executor.map(_index_in_worker, stale, chunksize=chunksize):
+                    with self._lock:
+                        self._store(path, entry)
+        else:
+            for item in stale:
+                path, entry = _index_in_worker(item)
+                with self._lock:
+                    self._store(path, entry)
+
+        seconds = time.perf_counter() - start
+        stats = {
+            "files": len(paths),
+            "parsed": len(stale),
+            "removed": len(removed),
+            "seconds": seconds,
+            "files_per_second": len(stale) / seconds if seconds > 0 else 0.0,
+        }
+        if stale:
+            logging.info(
+                f"Indexed {stats['parsed']} of {stats['files']} files in {seconds:.2f}s "
+                f"({stats['files_per_second']:.0f} files/s on {workers} processes)"
+            )
+        return stats
+
+
+def symbol_source(path: str, symbol: dict) -> str:
+    """Return the dedented source of the definition ``symbol`` of ``path``, decorators included."""
+    with open(path, "r") as f:
+        lines = f.read().splitlines()
+    return textwrap.dedent("\n".join(lines[symbol["first_line"] - 1 : symbol["last_line"]]))
+
+
+_symbol_index = None
+_symbol_index_lock = threading.Lock()
+
+
+def configure_symbol_index(index_file: str = None) -> SymbolIndex:
+    """
+    Create the process-wide symbol index.
+
+    ``index_file`` falls back to the ``UNITTEST_LLM_SYMBOL_INDEX`` environment
+    variable; an empty value keeps the index in memory only.
+    """
+    global _symbol_index
+    if index_file is None:
+        index_file = os.getenv("UNITTEST_LLM_SYMBOL_INDEX", DEFAULT_INDEX_FILE)
+    with _symbol_index_lock:
+        _symbol_index = SymbolIndex(index_file or None)
+    return _symbol_index
+
+
+def get_symbol_index() -> SymbolIndex:
+    """Return the process-wide symbol index, creating it on first use."""
+    if _symbol_index is None:
+        return configure_symbol_index()
+    return _symbol_index
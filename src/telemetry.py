@@ -0,0 +1,272 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+# USD per 1M prompt/completion tokens, used for the cost estimate of a run
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-4": (30.00, 60.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+DEFAULT_REPORT_FILE = os.path.join(os.getcwd(), ".llm_cache", "run_report.json")
+
+_current_stage = contextvars.ContextVar("unittest_llm_stage", default=None)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Estimate the price of a request in USD.
+
+    Dated model snapshots (e.g. ``gpt-4o-2024-08-06``) use the price of their
+    base model; unknown models cost 0.
+    """
+    base = max(
+        (name for name in MODEL_PRICES if model == name or model.startswith(name + "-")),
+        key=len,
+        default=None,
+    )
+    if base is None:
+        return 0.0
+    prompt_price, completion_price = MODEL_PRICES[base]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+class StageRecord:
+    """Timing and usage of one execution of a pipeline stage."""
+
+    def __init__(self, name: str, target: str = None, parent=None):
+        self.name = name
+        self.target = target
+        self.parent = parent
+        self.elapsed = 0.0
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.cost = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "stage": self.name,
+            "target": self.target,
+            "parent": self.parent.name if self.parent is not None else None,
+            "elapsed": self.elapsed,
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "cost_usd": self.cost,
+        }
+
+
+class Telemetry:
+    """
+    Collects per-stage wall time, token usage, cache hits and retries of a run.
+
+    Stages are entered with ``stage``; the innermost active stage of the current
+    thread or asyncio task receives the usage recorded by ``record_completion``
+    and ``record_retry``. Stages nest, so the time of an outer stage (e.g. one
+    repair iteration) includes the time of its inner stages.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, target: str = None):
+        """Time the enclosed block as one execution of stage ``name``."""
+        parent = _current_stage.get()
+        if target is None and parent is not None:
+            target = parent.target
+        record = StageRecord(name, target, parent)
+        token = _current_stage.set(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.elapsed = time.perf_counter() - start
+            _current_stage.reset(token)
+            with self._lock:
+                self.records.append(record)
+
+    def record_completion(
+        self, model: str, response, cached: bool = False, shared: bool = False
+    ) -> None:
+        """
+        Attribute a chat-completion response to the current stage.
+
+        ``cached`` responses came from the response cache and ``shared`` ones
+        from an identical request of another caller; neither was billed here.
+        """
+        record = _current_stage.get()
+        if record is None:
+            return
+        with self._lock:
+            if cached:
+                record.cache_hits += 1
+                return
+            if shared:
+                record.coalesced += 1
+                return
+            record.requests += 1
+            usage = getattr(response, "usage", None)
+            if usage is None:
+                return
+            record.prompt_tokens += usage.prompt_tokens
+            record.completion_tokens += usage.completion_tokens
+            record.cost += estimate_cost(
+                model, usage.prompt_tokens, usage.completion_tokens
+            )
+
+    def record_retry(self) -> None:
+        """Count a retried request in the current stage."""
+        record = _current_stage.get()
+        if record is None:
+            return
+        with self._lock:
+            record.retries += 1
+
+    def summary(self) -> dict:
+        """Aggregate the records per stage name."""
+        stages = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            stage = stages.setdefault(
+                record.name,
+                {
+                    "count": 0,
+                    "elapsed": 0.0,
+                    "max_elapsed": 0.0,
+                    "requests": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "cache_hits": 0,
+                    "coalesced": 0,
+                    "retries": 0,
+                    "cost_usd": 0.0,
+                },
+            )
+            stage["count"] += 1
+            stage["elapsed"] += record.elapsed
+            stage["max_elapsed"] = max(stage["max_elapsed"], record.elapsed)
+            stage["requests"] += record.requests
+            stage["prompt_tokens"] += record.prompt_tokens
+            stage["completion_tokens"] += record.completion_tokens
+            stage["cache_hits"] += record.cache_hits
+            stage["coalesced"] += record.coalesced
+            stage["retries"] += record.retries
+            stage["cost_usd"] += record.cost
+        for stage in stages.values():
+            stage["mean_elapsed"] = stage["elapsed"] / stage["count"]
+        return stages
+
+    def report(self) -> dict:
+        """Return the machine-readable report of the run."""
+        stages = self.summary()
+        totals = {
+            name: sum(stage[name] for stage in stages.values())
+            for name in (
+                "requests",
+                "prompt_tokens",
+                "completion_tokens",
+                "cache_hits",
+                "coalesced",
+                "retries",
+                "cost_usd",
+            )
+        }
+        with self._lock:
+            records = [record.as_dict() for record in self.records]
+        return {
+            "started": self.started,
+            "elapsed": time.time() - self.started,
+            "totals": totals,
+            "stages": stages,
+            "records": records,
+        }
+
+    def write_report(self, path: str) -> str:
+        """Write the JSON report to ``path`` and return the path."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+    def prometheus_text(self) -> str:
+        """Render the per-stage counters in the Prometheus text exposition format."""
+        metrics = [
+            ("stage_runs_total", "count", "counter", "Executions of the stage"),
+            ("stage_seconds_total", "elapsed", "counter", "Wall time spent in the stage"),
+            ("stage_seconds_max", "max_elapsed", "gauge", "Longest single execution of the stage"),
+            ("requests_total", "requests", "counter", "Chat-completion requests sent"),
+            ("prompt_tokens_total", "prompt_tokens", "counter", "Prompt tokens used"),
+            ("completion_tokens_total", "completion_tokens", "counter", "Completion tokens used"),
+            ("cache_hits_total", "cache_hits", "counter", "Responses served from the cache"),
+            ("coalesced_total", "coalesced", "counter", "Responses shared with an identical in-flight request"),
+            ("retries_total", "retries", "counter", "Retried requests"),
+            ("cost_usd_total", "cost_usd", "counter", "Estimated API cost in USD"),
+        ]
+        stages = self.summary()
+        lines = []
+        for metric, field, kind, description in metrics:
+            name = f"unittest_llm_{metric}"
+            lines.append(f"# HELP {name} {description}.")
+            lines.append(f"# TYPE {name} {kind}")
+            for stage_name, stage in sorted(stages.items()):
+                lines.append(f'{name}{{stage="{stage_name}"}} {stage[field]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> str:
+        """Write ``prometheus_text`` to ``path`` (e.g. for the node exporter's textfile collector)."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus_text())
+        # The textfile collector must never see a half-written file
+        os.replace(tmp_path, path)
+        return path
+
+    def log_summary(self) -> None:
+        for name, stage in self.summary().items():
+            logging.info(
+                f"Stage {name}: {stage['count']} runs, {stage['elapsed']:.1f}s total, "
+                f"{stage['prompt_tokens']}+{stage['completion_tokens']} tokens, "
+                f"{stage['cache_hits']} cache hits, {stage['retries']} retries"
+            )
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def configure_telemetry() -> Telemetry:
+    """Start a fresh process-wide telemetry collector."""
+    global _telemetry
+    with _telemetry_lock:
+        _telemetry = Telemetry()
+    return _telemetry
+
+
+def get_telemetry() -> Telemetry:
+    """Return the process-wide telemetry collector, creating it on first use."""
+    if _telemetry is None:
+        return configure_telemetry()
+    return _telemetry
@@ -0,0 +1,447 @@
+"""
+Merging of generated test modules.
+
+A regenerated or extended suite is merged into the existing test file of the
+target instead of replacing it: tests that passed are kept, failing ones are
+dropped, and new tests are only added if they are not already there. Two tests
+are duplicates if their normalized ASTs are equal regardless of their names;
+tests that only differ in their ``pytest.mark.parametrize`` cases get the
+union of the cases. Unchanged tests keep their source text, including comments.
+Fixtures and helpers of an existing name are either skipped, keeping the
+existing ones, or renamed together with their uses.
+"""
+
+import ast
+import copy
+import logging
+import os
+
+from src.atomic_file import atomic_write, locked
+
+
+def _is_test(node: ast.AST) -> bool:
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return node.name.startswith("test")
+    return isinstance(node, ast.ClassDef) and node.name.startswith("Test")
+
+
+def _is_parametrize(decorator: ast.AST) -> bool:
+    return isinstance(decorator, ast.Call) and ast.unparse(decorator.func).endswith(
+        "mark.parametrize"
+    )
+
+
+def _dump(node: ast.AST) -> str:
+    return ast.dump(node, include_attributes=False)
+
+
+def _decorators(node: ast.AST) -> list:
+    return [_dump(decorator) for decorator in node.decorator_list]
+
+
+def _body_key(node: ast.AST) -> str:
+    # Everything but the name and the parametrize cases
+    stripped = copy.deepcopy(node)
+    stripped.name = ""
+    stripped.decorator_list = [d for d in stripped.decorator_list if not _is_parametrize(d)]
+    return _dump(stripped)
+
+
+def _cases(node: ast.AST):
+    """The parametrize decorator of a test and its list of cases, if it has exactly one literal list."""
+    decorators = [d for d in node.decorator_list if _is_parametrize(d)]
+    if len(decorators) != 1:
+        return None, None
+    decorator = decorators[0]
+    if len(decorator.args) < 2 or not isinstance(decorator.args[1], (ast.List, ast.Tuple)):
+        return None, None
+    return decorator, decorator.args[1]
+
+
+def _dedupe_cases(node: ast.AST) -> bool:
+    decorator, cases = _cases(node)
+    if cases is None:
+        return False
+    unique = {}
+    for case in cases.elts:
+        unique.setdefault(_dump(case), case)
+    changed = len(unique) != len(cases.elts)
+    cases.elts = list(unique.values())
+    return changed
+
+
+class _Entry:
+    """A top-level statement (or class member) of the merged module."""
+
+    def __init__(self, node: ast.AST, text: str = None):
+        self.node = node
+        # Source text of unchanged nodes; modified or new nodes are unparsed
+        self.text = text
+
+    def render(self) -> str:
+        return self.text if self.text is not None else ast.unparse(self.node)
+
+
+def _segments(source: str, body: list) -> list:
+    """Source text of every statement of ``body``, with the comments right above it."""
+    lines = source.splitlines()
+    texts = []
+    previous_end = 0
+    for node in body:
+        start = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+        while start - 1 > previous_end and lines[start - 2].lstrip().startswith("#"):
+            start -= 1
+        texts.append("\n".join(lines[start - 1 : node.end_lineno]))
+        previous_end = node.end_lineno
+    return texts
+
+
+class _TestMerger:
+    def __init__(self):
+        self.stats = {
+            "kept": 0,
+            "added": 0,
+            "merged_cases": 0,
+            "duplicates": 0,
+            "dropped": 0,
+            "renamed": 0,
+        }
+
+    def add_tests(self, entries: list, node: ast.AST, text: str = None) -> None:
+        """Add the test ``node`` to ``entries`` unless it duplicates one of them."""
+        if isinstance(node, ast.ClassDef):
+            self._add_class(entries, node, text)
+            return
+        if _dedupe_cases(node):
+            text = None
+        key = _body_key(node)
+        for entry in entries:
+            if not _is_test(entry.node) or isinstance(entry.node, ast.ClassDef):
+                continue
+            if _body_key(entry.node) != key:
+                continue
+            if _decorators(entry.node) == _decorators(node):
+                self.stats["duplicates"] += 1
+                return
+            _, existing_cases = _cases(entry.node)
+            _, new_cases = _cases(node)
+            if existing_cases is not None and new_cases is not None:
+                known = {_dump(case) for case in existing_cases.elts}
+                added = [case for case in new_cases.elts if _dump(case) not in known]
+                existing_cases.elts.extend(added)
+                if added:
+                    entry.text = None
+                    self.stats["merged_cases"] += len(added)
+                else:
+                    self.stats["duplicates"] += 1
+                return
+        names = {entry.node.name for entry in entries if hasattr(entry.node, "name")}
+        if node.name in names:
+            # A different test of the same name would silently replace the other one
+            suffix = 2
+            while f"{node.name}_{suffix}" in names:
+                suffix += 1
+            node.name = f"{node.name}_{suffix}"
+            text = None
+        entries.append(_Entry(node, text))
+        self.stats["added"] += 1
+
+    def _add_class(self, entries: list, node: ast.ClassDef, text: str) -> None:
+        existing = next(
+            (
+                entry
+                for entry in entries
+                if isinstance(entry.node, ast.ClassDef) and entry.node.name == node.name
+            ),
+            None,
+        )
+        if existing is None:
+            entries.append(_Entry(node, text))
+            self.stats["added"] += 1
+            return
+        members = [_Entry(member) for member in existing.node.body]
+        before = dict(self.stats)
+        for member in node.body:
+            if _is_test(member):
+                self.add_tests(members, member)
+            elif _dump(member) not in {_dump(entry.node) for entry in members}:
+                if getattr(member, "name", None) not in {
+                    getattr(entry.node, "name", None) for entry in members
+                }:
+                    members.append(_Entry(member))
+        if self.stats != before:
+            existing.node.body = [entry.node for entry in members]
+            existing.text = None
+
+
+def _drop(node: ast.AST, drop: set) -> bool:
+    """Remove the failing tests in ``drop`` from ``node``; True if nothing of it is left."""
+    if isinstance(node, ast.ClassDef):
+        node.body = [
+            member
+            for member in node.body
+            if not (_is_test(member) and f"{node.name}.{member.name}" in drop)
+        ]
+        return not any(_is_test(member) for member in node.body)
+    return node.name in drop
+
+
+class _Renamer(ast.NodeTransformer):
+    """Rename the definitions, parameters and names in ``names`` (old to new name)."""
+
+    def __init__(self, names: dict):
+        self.names = names
+
+    def _rename_definition(self, node):
+        node.name = self.names.get(node.name, node.name)
+        return self.generic_visit(node)
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_ClassDef = _rename_definition
+
+    def visit_Name(self, node):
+        node.id = self.names.get(node.id, node.id)
+        return node
+
+    def visit_arg(self, node):
+        # Tests request fixtures by parameter name
+        node.arg = self.names.get(node.arg, node.arg)
+        return self.generic_visit(node)
+
+
+def _rename_conflicts(new_tree: ast.Module, entries: list, defined: set) -> dict:
+    """
+    Rename the fixtures and helpers of ``new_tree`` whose name is taken by a different ``entries`` node.
+
+    Returns
+    -------
+    dict
+        The new name of every renamed definition.
+    """
+    existing = {
+        entry.node.name: _dump(entry.node) for entry in entries if hasattr(entry.node, "name")
+    }
+    taken = defined | {getattr(node, "name", None) for node in new_tree.body} - {None}
+    names = {}
+    for node in new_tree.body:
+        name = getattr(node, "name", None)
+        if _is_test(node) or name not in existing or existing[name] == _dump(node):
+            continue
+        suffix = 2
+        while f"{name}_{suffix}" in taken:
+            suffix += 1
+        names[name] = f"{name}_{suffix}"
+        taken.add(names[name])
+    if names:
+        _Renamer(names).visit(new_tree)
+    return names
+
+
+def merge_test_modules(existing: str, new: str, drop=(), rename: bool = False) -> tuple:
+    """
+    Merge the test module ``new`` into ``existing``.
+
+    Parameters
+    ----------
+    existing : str
+        The current test module.
+    new : str
+        The new tests, a complete module or just additional test functions.
+    drop : iterable of str
+        Tests of ``existing`` to leave out, e.g. the failing ones, as
+        ``test_name`` or ``TestClass.test_name``.
+    rename : bool
+        Rename the fixtures and helpers of ``new`` whose name is taken by a
+        different one of ``existing``, and their uses in ``new``, instead of
+        keeping only the existing one.
+
+    Returns
+    -------
+    tuple
+        The merged module and counts of the ``kept``, ``added`` and
+        ``dropped`` tests, the ``merged_cases`` (parametrize cases added to
+        existing tests), the skipped ``duplicates`` and the ``renamed``
+        fixtures and helpers. If either module does
+        not parse, ``new`` is returned unchanged.
+    """
+    drop = set(drop)
+    merger = _TestMerger()
+    try:
+        existing_tree = ast.parse(existing)
+        new_tree = ast.parse(new)
+    except SyntaxError as e:
+        logging.warning(f"Cannot merge test modules, keeping the new one: {e}")
+        return new, merger.stats
+
+    entries = []
+    for node, text in zip(existing_tree.body, _segments(existing, existing_tree.body)):
+        if _is_test(node):
+            before = _dump(node)
+            if _drop(node, drop):
+                merger.stats["dropped"] += 1
+                continue
+            if _dump(node) != before:
+                # Some methods of the class were dropped
+                text = None
+            merger.stats["kept"] += 1
+        entries.append(_Entry(node, text))
+
+    imports = (ast.Import, ast.ImportFrom)
+    known = {_dump(entry.node) for entry in entries}
+    defined = {getattr(entry.node, "name", None) for entry in entries} - {None}
+    texts = _segments(new, new_tree.body)
+    if rename:
+        before = [_dump(node) for node in new_tree.body]
+        renamed = _rename_conflicts(new_tree, entries, defined)
+        # Renamed definitions and their uses are unparsed
+        texts = [
+            text if _dump(node) == dump else None
+            for node, text, dump in zip(new_tree.body, texts, before)
+        ]
+        for name, new_name in renamed.items():
+            logging.info(f"Renamed the fixture or helper '{name}' of the merged tests to '{new_name}'")
+        merger.stats["renamed"] = len(renamed)
+    for node, text in zip(new_tree.body, texts):
+        if _is_test(node):
+            merger.add_tests(entries, node, text)
+        elif _dump(node) in known:
+            continue
+        elif getattr(node, "name", None) in defined:
+            # Keep the existing fixture or helper the kept tests rely on
+            logging.warning(
+                f"Skipped the fixture or helper '{node.name}' of the new tests, "
+                "an existing one of the same name is kept"
+            )
+            continue
+        elif isinstance(node, imports):
+            # Imports go before the tests, whose decorators may already use them
+            last_import = max(
+                (i for i, entry in enumerate(entries) if isinstance(entry.node, imports)),
+                default=-1,
+            )
+            entries.insert(last_import + 1, _Entry(node, text))
+        else:
+            entries.append(_Entry(node, text))
+
+    merged = ""
+    previous = None
+    for entry in entries:
+        if merged:
+            consecutive_imports = isinstance(entry.node, imports) and isinstance(previous, imports)
+            merged += "\n" if consecutive_imports else "\n\n\n"
+        merged += entry.render()
+        previous = entry.node
+    merged += "\n"
+    return merged, merger.stats
+
+
+def failing_test_names(failures):
+    """
+    Return the names of failing tests as understood by ``merge_test_modules``.
+
+    Returns None if the failures are not structured records (pytest's output
+    could not be parsed), in which case no test can be trusted to pass.
+    """
+    if not isinstance(failures, list):
+        return None
+    names = set()
+    for failure in failures:
+        parts = failure["nodeid"].split("::")[1:]
+        if not parts:
+            # The module itself failed to import, nothing of it passed
+            return None
+        names.add(".".join(part.split("[")[0] for part in parts))
+    return names
+
+
+def read_test_file(test_file: str):
+    """Return the content of ``test_file``, or None if it does not exist."""
+    try:
+        with open(test_file, "r") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def merge_test_file(test_file: str, previous_code: str, drop) -> dict:
+    """
+    Merge the tests that passed before a regeneration into the regenerated ``test_file``.
+
+    ``drop`` are the failing tests of ``previous_code`` (see
+    ``failing_test_names``); if it is None, the regenerated file is kept as is.
+
+    Returns
+    -------
+    dict
+        The counts of ``merge_test_modules``, or None if nothing was merged.
+    """
+    if previous_code is None or drop is None or not os.path.exists(test_file):
+        return None
+    with locked(test_file):
+        with open(test_file, "r") as f:
+            new_code = f.read()
+        merged, stats = merge_test_modules(previous_code, new_code, drop)
+        atomic_write(test_file, merged)
+    logging.info(
+        f"Merged regenerated tests into {test_file}: {stats['kept']} kept, "
+        f"{stats['dropped']} failing dropped, {stats['added']} added, "
+        f"{stats['merged_cases']} parametrize cases added, {stats['duplicates']} duplicates skipped"
+    )
+    return stats
+
+
+def merge_test_files(test_file: str, sources: list, remove_sources: bool = True) -> dict:
+    """
+    Merge the test files ``sources`` into ``test_file``.
+
+    Identical imports, fixtures and helpers are kept once, so the merged
+    tests share them; different fixtures and helpers of the same name are
+    renamed (see ``merge_test_modules``). Tests already in ``test_file`` are
+    kept. The sources are removed unless ``remove_sources`` is False.
+
+    Returns
+    -------
+    dict
+        The summed counts of ``merge_test_modules``.
+    """
+    totals = {
+        "kept": 0,
+        "added": 0,
+        "merged_cases": 0,
+        "duplicates": 0,
+        "dropped": 0,
+        "renamed": 0,
+    }
+    with locked(test_file):
+        merged = read_test_file(test_file) or ""
+        for source in sources:
+            code = read_test_file(source)
+            if code is None or os.path.abspath(source) == os.path.abspath(test_file):
+                continue
+            merged, stats = merge_test_modules(merged, code, rename=True)
+            for name, count in stats.items():
+                totals[name] += count
+        atomic_write(test_file, merged)
+    if remove_sources:
+        remove_test_files(test_file, sources)
+    logging.info(
+        f"Merged {len(sources)} test files into {test_file}: {totals['added']} tests added, "
+        f"{totals['merged_cases']} parametrize cases added, {totals['duplicates']} duplicates skipped, "
+        f"{totals['renamed']} fixtures and helpers renamed"
+    )
+    return totals
+
+
+def restore_test_file(test_file: str, previous_code: str) -> None:
+    """Restore ``test_file`` to ``previous_code``, removing it if it did not exist (None)."""
+    with locked(test_file):
+        if previous_code is not None:
+            atomic_write(test_file, previous_code)
+        elif os.path.exists(test_file):
+            os.remove(test_file)
+
+
+def remove_test_files(test_file: str, sources: list) -> None:
+    """Remove the test files ``sources`` merged into ``test_file``, see ``merge_test_files``."""
+    for source in sources:
+        if os.path.abspath(source) != os.path.abspath(test_file) and os.path.exists(source):
+            os.remove(source)
@@ -3,10 +3,52 @@ import re
 import ast
 import os
 import sys
-from openai import OpenAI
+import tempfile
+import textwrap
+import threading
+from openai.types.chat import ChatCompletion
 import pytest
 import subprocess
 
+from src.ast_hash import get_ast_memo, memo_key, normalized_ast_hash, source_hash
+from src.atomic_file import atomic_write, locked
+from src.client import get_client
+from src.coverage_guide import coverage_args, format_uncovered
+from src.pytest_results import (
+    describe_results,
+    failed_tests,
+    format_failures,
+    load_results,
+    collector_command,
+    summarize,
+)
+from src.pytest_worker import (
+    PytestRunTimeout,
+    PytestWorkerError,
+    run_pytest_in_worker,
+    subprocess_env,
+    warm_pytest_enabled,
+)
+from src.rate_limiter import RateLimiter, estimate_tokens, get_rate_limiter
+from src.resource_limits import get_resource_limits, limit_args, timed_out_result
+from src.response_cache import ResponseCache, get_response_cache
+from src.symbol_index import get_symbol_index
+from src.telemetry import get_telemetry
+from src.test_merge import merge_test_modules
+
+# Process-wide counters of pipeline events, see get_pipeline_stats
+_pipeline_stats = {
+    "parse_failures": 0,
+    "execute_retries": 0,
+    "coalesced_requests": 0,
+    "memo_hits": 0,
+}
+_pipeline_stats_lock = threading.Lock()
+
+# "three_step" explains, plans and executes in separate requests, "fused" in one
+PIPELINES = ("three_step", "fused")
+FUSED_TESTS_HEADING = "## Tests"
+
 color_prefix_by_role = {
     "system": "\033[0m",  # gray
     "user": "\033[0m",  # gray
@@ -14,47 +56,358 @@ color_prefix_by_role = {
 }
 
 
-def unittest_flow(
-    function_to_test: str,
-    function_filename: str,  # Ensure this is passed correctly
-    unit_test_package: str = "pytest",
-    approx_min_cases_to_cover: int = 7,
-    print_text: bool = False,
-    explain_model: str = "gpt-3.5-turbo",
-    plan_model: str = "gpt-3.5-turbo",
-    execute_model: str = "gpt-3.5-turbo",
-    temperature: float = 0.3,
-    reruns_if_fail: int = 1,
+def count_pipeline_event(name: str, amount: int = 1) -> None:
+    """Increment one of the process-wide pipeline counters."""
+    with _pipeline_stats_lock:
+        _pipeline_stats[name] = _pipeline_stats.get(name, 0) + amount
+
+
+def get_pipeline_stats() -> dict:
+    """
+    Return the process-wide pipeline counters.
+
+    ``parse_failures`` counts execute answers whose code did not parse,
+    ``execute_retries`` the execute-only repair requests sent for them,
+    ``coalesced_requests`` the requests that shared an identical in-flight call
+    and ``memo_hits`` the explain/plan steps re-used via the AST memo.
+    """
+    with _pipeline_stats_lock:
+        return dict(_pipeline_stats)
+
+
+def find_code_block_end(text: str, after: str = None) -> int:
+    """
+    Locate the closing fence of the first ```python block in ``text``.
+
+    If ``after`` is given, only a block following that marker counts.
+
+    Returns
+    -------
+    int
+        The index just past the closing fence, or -1 if the block is not complete yet.
+    """
+    offset = 0
+    if after is not None:
+        offset = text.find(after)
+        if offset == -1:
+            return -1
+    start = text.find("```python", offset)
+    if start == -1:
+        return -1
+    body_start = text.find("\n", start)
+    if body_start == -1:
+        return -1
+    end = text.find("```", body_start)
+    if end == -1:
+        return -1
+    return end + 3
+
+
+def _stream_completion(
+    client,
+    model: str,
+    messages: list,
+    temperature: float,
+    on_delta=None,
+    stop_at_code_end: bool = False,
+    code_block_after: str = None,
+) -> ChatCompletion:
+    chunks = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    content = ""
+    completion_id = None
+    created = None
+    usage = None
+    # End of the code block if the stream was cancelled at its closing fence
+    code_end = None
+    finish_reason = "stop"
+    try:
+        for chunk in chunks:
+            completion_id = completion_id or chunk.id
+            created = created or chunk.created
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage.model_dump()
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if on_delta is not None:
+                on_delta(choice.delta)
+            if choice.delta.content:
+                content += choice.delta.content
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            if stop_at_code_end:
+                end = find_code_block_end(content, after=code_block_after)
+                if end != -1:
+                    # Everything after the closing fence is prose we don't need
+                    logging.debug("Closing code fence received, cancelling the stream.")
+                    code_end = end
+                    break
+    finally:
+        chunks.close()
+
+    if usage is None:
+        # The usage chunk comes last, a cancelled stream never receives it
+        usage = estimated_usage(messages, content)
+    if code_end is not None:
+        content = content[:code_end]
+    return assemble_completion(
+        completion_id, created, model, content, finish_reason, usage
+    )
+
+
+def estimated_usage(messages: list, completion: str) -> dict:
+    """
+    Estimate the usage of a request whose response carried none, like ``estimate_tokens``.
+
+    Streams cancelled at the closing code fence end before the final usage
+    chunk; the estimate keeps their tokens and cost in the run report.
+    """
+    prompt_tokens = estimate_tokens(messages, completion_tokens=0)
+    completion_tokens = len(completion) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def assemble_completion(
+    completion_id, created, model, content, finish_reason="stop", usage=None
+) -> ChatCompletion:
+    """Build a ChatCompletion from the pieces collected while streaming."""
+    return ChatCompletion.model_validate(
+        {
+            "id": completion_id or "",
+            "object": "chat.completion",
+            "created": created or 0,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": finish_reason,
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+            "usage": usage,
+        }
+    )
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single execution.
+
+    The first caller of a key runs the function; callers arriving while it is
+    still running wait for it and receive the same result (or exception).
+    Once the call finished the key is forgotten, later callers run it again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn):
+        """
+        Run ``fn()`` unless an identical call is already in flight.
+
+        Returns
+        -------
+        tuple
+            The result and whether it was shared from another caller's call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _InFlightCall()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+_single_flight = SingleFlight()
+
+
+def chat_completion(
+    client,
+    model: str,
+    messages: list,
+    temperature: float,
+    cache: ResponseCache = None,
     stream: bool = False,
-) -> str:
-    client = OpenAI()
+    on_delta=None,
+    stop_at_code_end: bool = False,
+    rate_limiter: RateLimiter = None,
+    code_block_after: str = None,
+    single_flight: SingleFlight = None,
+) -> ChatCompletion:
+    """
+    Create a chat completion, serving repeated requests from the response cache.
 
-    # Helper functions
-    def print_messages(messages, color_prefix_by_role=color_prefix_by_role):
-        for message in messages:
-            role = message["role"]
-            color_prefix = color_prefix_by_role[role]
-            content = message["content"]
-            print(f"{color_prefix}\n[{role}]\n{content}")
+    Requests that miss the cache go through the rate limiter, which keeps them
+    within the requests/tokens per minute budgets and retries 429s. Identical
+    requests issued concurrently (e.g. by batch workers) share one API call;
+    only the caller that made it sees the streamed deltas.
 
-    def print_message_assistant(content, color_prefix_by_role=color_prefix_by_role):
-        role = "assistant"
-        color_prefix = color_prefix_by_role[role]
-        print(f"{color_prefix}\n[{role}]\n{content}")
+    Parameters
+    ----------
+    client : OpenAI
+        The client used when the request is not cached.
+    model : str
+        The name of the model to query.
+    messages : list
+        The conversation sent to the model.
+    temperature : float
+        The sampling temperature of the request.
+    cache : ResponseCache, optional
+        The cache to consult (default is the process-wide response cache).
+    stream : bool, optional
+        Stream the response token by token instead of waiting for the full answer.
+    on_delta : callable, optional
+        Called with every streamed delta, e.g. to print the answer as it arrives.
+    stop_at_code_end : bool, optional
+        When streaming, cancel the request as soon as the closing fence of the
+        first ```python block arrives and drop whatever would follow it.
+    rate_limiter : RateLimiter, optional
+        The limiter to go through (default is the process-wide rate limiter).
+    code_block_after : str, optional
+        With ``stop_at_code_end``, only stop at a code block following this marker.
+    single_flight : SingleFlight, optional
+        Where identical in-flight requests are coalesced (default is process-wide).
 
-    def print_message_delta(delta, color_prefix_by_role=color_prefix_by_role):
-        if "role" in delta:
-            role = delta["role"]
-            color_prefix = color_prefix_by_role[role]
-            print(f"{color_prefix}\n[{role}]\n", end="")
-        elif "content" in delta:
-            content = delta["content"]
-            print(content, end="")
-        else:
-            pass
+    Returns
+    -------
+    ChatCompletion
+        The (possibly cached) response of the model.
+    """
+    if cache is None:
+        cache = get_response_cache()
+    key = cache.key(model, messages, temperature)
+    cached = cache.get(key)
+    if cached is not None:
+        logging.debug(f"Response cache hit for {model} request {key[:12]}")
+        response = ChatCompletion.model_validate(cached)
+        get_telemetry().record_completion(model, response, cached=True)
+        return response
 
-    # Step 1: Generate an explanation of the function
-    # Updated Prompt for Step 1: Generate a detailed explanation of the function
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter()
+    if single_flight is None:
+        single_flight = _single_flight
+
+    def request():
+        if stream:
+            return _stream_completion(
+                client,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                on_delta=on_delta,
+                stop_at_code_end=stop_at_code_end,
+                code_block_after=code_block_after,
+            )
+        return client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=False,
+        )
+
+    def fetch():
+        response = rate_limiter.call(request, estimate_tokens(messages))
+        cache.put(key, response.model_dump(mode="json"))
+        return response
+
+    response, shared = single_flight.do(key, fetch)
+    if shared:
+        logging.debug(f"Shared in-flight {model} request {key[:12]}")
+        count_pipeline_event("coalesced_requests")
+    get_telemetry().record_completion(model, response, shared=shared)
+    return response
+
+
+def memoized_step(
+    memo: ResponseCache,
+    step: str,
+    symbol_hash: str,
+    model: str,
+    temperature: float,
+    complete,
+    **params,
+) -> tuple:
+    """
+    Return the answer of an explain/plan step, re-using it for equivalent code.
+
+    Answers are memoized under the normalized AST hash of the symbol, so a
+    reformat or docstring edit of the target re-uses the previous answer.
+
+    Parameters
+    ----------
+    symbol_hash : str or None
+        See ``normalized_ast_hash``; None disables the memo.
+    complete : callable
+        Produces the answer (the content of a chat completion) on a miss.
+    **params
+        Further inputs of the step that the answer depends on.
+
+    Returns
+    -------
+    tuple
+        The answer and whether it came from the memo.
+    """
+    if symbol_hash is None:
+        return complete(), False
+    key = memo_key(step, symbol_hash, model, temperature, **params)
+    entry = memo.get(key)
+    if entry is not None:
+        logging.debug(f"AST memo hit for the {step} step")
+        count_pipeline_event("memo_hits")
+        return entry["content"], True
+    content = complete()
+    memo.put(key, {"content": content})
+    return content, False
+
+
+def build_context_section(context: str) -> str:
+    """Return the prompt section showing the module context of the code to test, if any."""
+    if not context:
+        return ""
+    return f"""
+The code uses these definitions of its module (shown for reference, they are not the code to test):
+
+```python
+{context}
+```"""
+
+
+def build_explain_messages(function_to_test: str, context: str = None) -> list:
+    """Return the system and user messages of the explain step."""
     explain_system_message = {
         "role": "system",
         "content": """
@@ -78,7 +431,7 @@ def unittest_flow(
 
         ```python
         {function_to_test}
-        ```
+        ```{build_context_section(context)}
 
         Include a setup guide for pytest and pytest-cov:
         - Installation of pytest and pytest-cov.
@@ -87,44 +440,485 @@ def unittest_flow(
         """,
     }
 
+    return [explain_system_message, explain_user_message]
+
+
+def build_focus_section(method: str, context: str = None) -> str:
+    """Return the prompt section restricting the plan to one method of the explained class, if any."""
+    if not method:
+        return ""
+    return f"""Plan the tests of only this method of the class explained above:
+
+```python
+{method}
+```{build_context_section(context)}
+
+"""
+
+
+def build_plan_message(unit_test_package: str, method: str = None, context: str = None) -> dict:
+    """Return the user message of the plan step."""
+    plan_user_message = {
+        "role": "user",
+        "content": f"""{build_focus_section(method, context)}A comprehensive unit test suite is critical for ensuring code quality and functionality across various scenarios. Here’s how to make the most of `{unit_test_package}` for this purpose:
+- Ensure that the function's behavior is thoroughly tested across a broad range of possible inputs.
+- Utilize the features of `{unit_test_package}` to write and maintain tests effectively and efficiently.
+- Maintain clarity in your tests with clean code and descriptive names that reflect the test’s purpose.
+- Write deterministic tests that consistently pass or fail under the same conditions, ensuring reliability.
+- Properly manage dependencies by importing all required packages used in the tests.
+
+Also include:
+- Instructions on configuring `{unit_test_package}` to recognize test cases for code coverage, particularly ensuring the `src` directory is included when running `pytest --cov=src`.
+- Examples on how to execute tests to generate a coverage report, explaining any relevant flags or options.""",
+    }
+    return plan_user_message
+
+
+def count_plan_bullets(plan: str) -> int:
+    """Count the top-level bullets (test case categories) of a plan."""
+    return max(plan.count("\n-"), plan.count("\n*"))
+
+
+def build_elaboration_message(num_bullets: int, approx_min_cases_to_cover: int) -> dict:
+    """Return the user message asking for additional edge cases."""
+    elaboration_user_message = {
+        "role": "user",
+        "content": f"""In addition to those scenarios above, list a maximum of {num_bullets-approx_min_cases_to_cover} rare or unexpected edge cases (and as before, under each edge case, include a few examples as sub-bullets).""",
+    }
+    return elaboration_user_message
+
+
+def build_test_module_header(
+    function_to_test: str, function_filename: str, unit_test_package: str, import_name: str = None
+) -> tuple:
+    """
+    Return the imports and the package comment the generated test module starts with.
+
+    ``import_name`` is the name to import from the module, e.g. the class of a
+    method, instead of the code to test.
+    """
+    package_comment = ""
+    if unit_test_package == "pytest":
+        package_comment = "# below, each test case is represented by a tuple passed to the @pytest.mark.parametrize decorator"
+
+    imports_and_function = f"""# imports
+    import {unit_test_package}  # used for our unit tests
+
+    # function to test
+    from src.{function_filename.split('/')[-1].replace('.py', '')} import {import_name or function_to_test.split('(')[0].strip()}
+    """
+    return imports_and_function, package_comment
+
+
+def build_execute_messages(
+    function_to_test: str, function_filename: str, unit_test_package: str, import_name: str = None
+) -> tuple:
+    """Return the system and user messages of the execute step."""
+    execute_system_message = {
+        "role": "system",
+        "content": (
+            "As a proficient Python developer experienced with pytest, your goal is to achieve 100% code coverage "
+            "through thoughtful and practical unit tests. Write clear, concise, and efficient tests that cover all "
+            "functional aspects of the code without delving into overly complex or unrealistic edge cases. Ensure that "
+            "your test scripts are straightforward and maintain readability and consistency. Your tests should be formatted "
+            "as a single coherent block to facilitate easy recognition by the pytest framework when executing `pytest --cov=src`. "
+            "This focus on practical and comprehensive testing is crucial for accurately evaluating the functionality and "
+            "robustness of the code under typical conditions."
+        ),
+    }
+
+    # Prepare dynamic parts of the user message
+    imports_and_function, package_comment = build_test_module_header(
+        function_to_test, function_filename, unit_test_package, import_name
+    )
+
+    # Assemble the user message
+    execute_user_message = {
+        "role": "user",
+        "content": f"""Using Python and the `{unit_test_package}` package, write a suite of unit tests for the function, following the cases above. Include helpful comments to explain each line. Reply only with code, formatted as follows:
+
+    ```python
+    {imports_and_function}
+    # unit tests
+    {package_comment}
+    {{insert unit test code here}}
+    ```
+    The imports and functions to test part has to be exactly like that! However, make sure to import all dependencies that you might add in the cases!""",
+    }
+    return execute_system_message, execute_user_message
+
+
+def build_fused_messages(
+    function_to_test: str,
+    function_filename: str,
+    unit_test_package: str,
+    approx_min_cases_to_cover: int,
+    context: str = None,
+    import_name: str = None,
+) -> list:
+    """
+    Return the messages of the fused pipeline.
+
+    A single answer carries the explanation, the test plan and the test code as
+    three markdown sections. The code comes last, so the stream can still be
+    cancelled at its closing fence.
+    """
+    execute_system_message, _ = build_execute_messages(
+        function_to_test, function_filename, unit_test_package, import_name
+    )
+    imports_and_function, package_comment = build_test_module_header(
+        function_to_test, function_filename, unit_test_package, import_name
+    )
+    fused_user_message = {
+        "role": "user",
+        "content": f"""Write unit tests for the following Python code with `{unit_test_package}`. Work through three steps in a single answer, using exactly these section headings:
+
+## Explanation
+A concise markdown bulleted list of what each element of the code does, naming every conditional branch and loop.
+
+## Test plan
+At least {approx_min_cases_to_cover} diverse scenarios the tests must cover, including rare or unexpected edge cases, each with a few examples as sub-bullets.
+
+## Tests
+The suite of unit tests following the plan, with helpful comments, as a single code block formatted as follows:
+
+    ```python
+    {imports_and_function}
+    # unit tests
+    {package_comment}
+    {{insert unit test code here}}
+    ```
+    The imports and functions to test part has to be exactly like that! However, make sure to import all dependencies that you might add in the cases!
+
+This is the code to test:
+
+```python
+{function_to_test}
+```{build_context_section(context)}""",
+    }
+    return [execute_system_message, fused_user_message]
+
+
+def parse_fused_response(content: str) -> dict:
+    """
+    Split the answer of the fused pipeline into its sections.
+
+    Returns
+    -------
+    dict
+        The ``explanation`` and ``plan`` sections (empty if missing) and the full ``tests`` section.
+    """
+    sections = {"explanation": "", "plan": "", "tests": ""}
+    headings = {"explanation": "explanation", "test plan": "plan", "tests": "tests"}
+    current = None
+    for line in content.splitlines(keepends=True):
+        match = re.match(r"#+\s*(explanation|test plan|tests)\s*$", line.strip(), re.I)
+        if match:
+            current = headings[match.group(1).lower()]
+            continue
+        if current is not None:
+            sections[current] += line
+    return {name: text.strip() for name, text in sections.items()}
+
+
+def extract_test_code(execution: str) -> str:
+    """Extract the test module from the execute step's answer."""
+    code = execution.split("```python")[1].split("```")[0].strip()
+
+    # Check and insert missing imports if necessary
+    if "sys" in code and "import sys" not in code:
+        code = "import sys\n" + code
+    return code
+
+
+def parse_test_code(execution: str) -> tuple:
+    """
+    Extract the test module from the execute step's answer and check that it parses.
+
+    Returns
+    -------
+    tuple
+        The extracted code (None if the answer has no python block) and the
+        parser error message (None if the code parses).
+    """
+    try:
+        code = extract_test_code(execution)
+    except IndexError:
+        return None, "The answer does not contain a ```python code block."
+    try:
+        ast.parse(code)
+    except SyntaxError as e:
+        line = e.text.strip() if e.text else ""
+        return code, f"SyntaxError: {e.msg} (line {e.lineno}): {line}"
+    return code, None
+
+
+def build_syntax_repair_message(error: str) -> dict:
+    """Return the user message asking to fix code that does not parse."""
+    return {
+        "role": "user",
+        "content": f"""The code above cannot be parsed by Python:
+
+{error}
+
+Fix this error and reply only with the complete, corrected test module in a single ```python block.""",
+    }
+
+
+def definition_name(source: str):
+    """Return the name of the class or function defined by ``source``, or None."""
+    try:
+        return ast.parse(textwrap.dedent(source)).body[0].name
+    except (SyntaxError, IndexError, AttributeError):
+        return None
+
+
+def target_test_file(function_filename: str, function_to_test: str, class_skeleton: str = None) -> str:
+    """
+    Return the name of the test file of a target, ``test_<module>_<symbol>.py``.
+
+    The name only depends on the module and the name of the class or function,
+    so every target has its own file and regenerating a target replaces it.
+    Methods tested on their own (see ``class_skeleton`` of ``unittest_flow``)
+    are named ``test_<module>_<class>_<method>.py``.
+    """
+    module = os.path.splitext(os.path.basename(function_filename))[0]
+    symbol = definition_name(function_to_test) or normalized_ast_hash(function_to_test) or "unknown"
+    if class_skeleton:
+        symbol = f"{definition_name(class_skeleton)}_{symbol}"
+    return "test_" + re.sub(r"\W", "_", f"{module}_{symbol}") + ".py"
+
+
+def generated_test_path(file_name: str) -> str:
+    """Return the path of the generated test file ``file_name``."""
+    return os.path.join(os.getcwd(), "tests/unit", file_name)
+
+
+def write_test_file(code: str, file_name: str = "test_functions.py") -> str:
+    """Write the generated unit tests and return the path of the test file."""
+    output_file = generated_test_path(file_name)
+
+    # pytest may be running another target's tests next to it right now
+    with locked(output_file):
+        atomic_write(output_file, code)
+
+    logging.info(f"Unit tests written to {output_file}")
+
+    return output_file
+
+
+def execute_test_generation(
+    client,
+    execute_model: str,
+    execute_messages: list,
+    temperature: float,
+    reruns_if_fail: int = 1,
+    cache: ResponseCache = None,
+    stream: bool = False,
+    on_delta=None,
+    on_answer=None,
+    fused: bool = False,
+) -> str:
+    """
+    Run the execute step and repair unparsable answers with execute-only retries.
+
+    Parameters
+    ----------
+    execute_messages : list
+        The conversation ending with the request for the test code.
+    reruns_if_fail : int, optional
+        How often the model is asked to fix code that does not parse.
+    on_answer : callable, optional
+        Called with every complete answer, e.g. to print it.
+    fused : bool, optional
+        The answer is a fused explanation/plan/tests response; the code is
+        taken from its tests section.
+
+    Returns
+    -------
+    str
+        The generated test module (possibly still unparsable once the reruns are exhausted).
+    """
+    if cache is None:
+        cache = get_response_cache()
+    attempt_messages = execute_messages
+    for attempt in range(reruns_if_fail + 1):
+        execute_response = chat_completion(
+            client,
+            model=execute_model,
+            messages=attempt_messages,
+            temperature=temperature,
+            cache=cache,
+            stream=stream,
+            on_delta=on_delta,
+            stop_at_code_end=True,
+            code_block_after=FUSED_TESTS_HEADING if fused and attempt == 0 else None,
+        )
+        execution = execute_response.choices[0].message.content
+        if on_answer is not None:
+            on_answer(execution)
+
+        if fused and attempt == 0:
+            code, error = parse_test_code(parse_fused_response(execution)["tests"] or execution)
+        else:
+            code, error = parse_test_code(execution)
+        if error is None:
+            break
+        print(f"Syntax error in generated code: {error}")
+        count_pipeline_event("parse_failures")
+        if attempt == reruns_if_fail:
+            # Give the next run a fresh start instead of replaying this answer
+            cache.delete(cache.key(execute_model, execute_messages, temperature))
+            break
+        # Only the execute step was bad: keep explanation and plan, feed back the error
+        print("Rerunning the execute step...")
+        count_pipeline_event("execute_retries")
+        get_telemetry().record_retry()
+        attempt_messages = attempt_messages + [
+            {"role": "assistant", "content": execution},
+            build_syntax_repair_message(error),
+        ]
+
+    if code is None:
+        raise ValueError("The execute step did not return a python code block.")
+    return code
+
+
+def unittest_flow(
+    function_to_test: str,
+    function_filename: str,  # Ensure this is passed correctly
+    unit_test_package: str = "pytest",
+    approx_min_cases_to_cover: int = 7,
+    print_text: bool = False,
+    explain_model: str = "gpt-3.5-turbo",
+    plan_model: str = "gpt-3.5-turbo",
+    execute_model: str = "gpt-3.5-turbo",
+    temperature: float = 0.3,
+    reruns_if_fail: int = 1,
+    stream: bool = False,
+    cache: ResponseCache = None,
+    client=None,
+    pipeline: str = "three_step",
+    memo: ResponseCache = None,
+    context: str = None,
+    class_skeleton: str = None,
+) -> str:
+    # With a class skeleton, function_to_test is one method of that class: the
+    # explanation of the skeleton is shared by all its methods and only the
+    # plan and the tests are specific to the method
+    if pipeline not in PIPELINES:
+        raise ValueError(f"Unknown pipeline '{pipeline}', expected one of {PIPELINES}")
+    if client is None:
+        client = get_client()
+    if cache is None:
+        cache = get_response_cache()
+    telemetry = get_telemetry()
+
+    # Helper functions
+    def print_messages(messages, color_prefix_by_role=color_prefix_by_role):
+        for message in messages:
+            role = message["role"]
+            color_prefix = color_prefix_by_role[role]
+            content = message["content"]
+            print(f"{color_prefix}\n[{role}]\n{content}")
+
+    def print_message_assistant(content, color_prefix_by_role=color_prefix_by_role):
+        role = "assistant"
+        color_prefix = color_prefix_by_role[role]
+        print(f"{color_prefix}\n[{role}]\n{content}")
+
+    def print_message_delta(delta, color_prefix_by_role=color_prefix_by_role):
+        if delta.role:
+            role = delta.role
+            color_prefix = color_prefix_by_role[role]
+            print(f"{color_prefix}\n[{role}]\n", end="")
+        if delta.content:
+            print(delta.content, end="")
+
+    on_delta = print_message_delta if print_text else None
+
+    if pipeline == "fused":
+        # Explain, plan and execute in one round-trip
+        fused_messages = build_fused_messages(
+            function_to_test,
+            function_filename,
+            unit_test_package,
+            approx_min_cases_to_cover,
+            context=context,
+            import_name=definition_name(class_skeleton) if class_skeleton else None,
+        )
+        if print_text:
+            print_messages(fused_messages)
+        logging.info("Running fused unit test generation.")
+        with telemetry.stage("fused"):
+            code = execute_test_generation(
+                client,
+                execute_model,
+                fused_messages,
+                temperature,
+                reruns_if_fail=reruns_if_fail,
+                cache=cache,
+                stream=stream,
+                on_delta=on_delta,
+                on_answer=print_message_assistant if print_text and not stream else None,
+                fused=True,
+            )
+        return write_test_file(
+            code, target_test_file(function_filename, function_to_test, class_skeleton)
+        )
+
+    # Explanations and plans only depend on what the code does, not on its formatting
+    if memo is None:
+        memo = get_ast_memo()
+    symbol_hash = normalized_ast_hash(function_to_test)
+    # The answers also depend on the module context shown with the code
+    context_params = {"context": source_hash(context)} if context else {}
+    explain_hash, explain_params = symbol_hash, context_params
+    if class_skeleton:
+        # One explanation of the skeleton is shared by all methods of the class
+        explain_hash, explain_params = source_hash(class_skeleton), {}
+        context_params = {**context_params, "skeleton": explain_hash}
+
+    # Step 1: Generate an explanation of the function
+    explain_system_message, explain_user_message = build_explain_messages(
+        class_skeleton or function_to_test, None if class_skeleton else context
+    )
     explain_messages = [explain_system_message, explain_user_message]
     if print_text:
         print_messages(explain_messages)
 
-    explanation_response = client.chat.completions.create(
-        model=explain_model,
-        messages=explain_messages,
-        temperature=temperature,
-        stream=False,
-    )
-    explanation = ""
-    if stream:
-        for chunk in explanation_response:
-            delta = chunk.choices[0].delta
-            if print_text:
-                print_message_delta(delta)
-            if "content" in delta:
-                explanation += delta["content"]
-    else:
-        explanation = explanation_response.choices[0].message.content
-        if print_text:
-            print_message_assistant(explanation)
+    def complete(model, messages):
+        response = chat_completion(
+            client,
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            cache=cache,
+            stream=stream,
+            on_delta=on_delta,
+        )
+        return response.choices[0].message.content
+
+    with telemetry.stage("explain"):
+        explanation, memoized = memoized_step(
+            memo,
+            "explain",
+            explain_hash,
+            explain_model,
+            temperature,
+            lambda: complete(explain_model, explain_messages),
+            **explain_params,
+        )
+    if print_text and (memoized or not stream):
+        print_message_assistant(explanation)
     explain_assistant_message = {"role": "assistant", "content": explanation}
 
     # Step 2: Generate a plan to write a unit test
-    plan_user_message = {
-        "role": "user",
-        "content": f"""A comprehensive unit test suite is critical for ensuring code quality and functionality across various scenarios. Here’s how to make the most of `{unit_test_package}` for this purpose:
-- Ensure that the function's behavior is thoroughly tested across a broad range of possible inputs.
-- Utilize the features of `{unit_test_package}` to write and maintain tests effectively and efficiently.
-- Maintain clarity in your tests with clean code and descriptive names that reflect the test’s purpose.
-- Write deterministic tests that consistently pass or fail under the same conditions, ensuring reliability.
-- Properly manage dependencies by importing all required packages used in the tests.
-
-Also include:
-- Instructions on configuring `{unit_test_package}` to recognize test cases for code coverage, particularly ensuring the `src` directory is included when running `pytest --cov=src`.
-- Examples on how to execute tests to generate a coverage report, explaining any relevant flags or options.""",
-    }
+    plan_user_message = build_plan_message(
+        unit_test_package,
+        method=function_to_test if class_skeleton else None,
+        context=context if class_skeleton else None,
+    )
     plan_messages = [
         explain_system_message,
         explain_user_message,
@@ -133,30 +927,28 @@ Also include:
     ]
     if print_text:
         print_messages([plan_user_message])
-    plan_response = client.chat.completions.create(
-        model=plan_model, messages=plan_messages, temperature=temperature, stream=False
-    )
-    plan = ""
-    if stream:
-        for chunk in plan_response:
-            delta = chunk.choices[0].delta
-            if print_text:
-                print_message_delta(delta)
-            if "content" in delta:
-                plan += delta["content"]
-    else:
-        plan = plan_response.choices[0].message.content
-        if print_text:
-            print_message_assistant(plan)
+    with telemetry.stage("plan"):
+        plan, memoized = memoized_step(
+            memo,
+            "plan",
+            symbol_hash,
+            plan_model,
+            temperature,
+            lambda: complete(plan_model, plan_messages),
+            explain_model=explain_model,
+            unit_test_package=unit_test_package,
+            **context_params,
+        )
+    if print_text and (memoized or not stream):
+        print_message_assistant(plan)
     plan_assistant_message = {"role": "assistant", "content": plan}
 
-    num_bullets = max(plan.count("\n-"), plan.count("\n*"))
+    num_bullets = count_plan_bullets(plan)
     elaboration_needed = num_bullets < approx_min_cases_to_cover
     if elaboration_needed:
-        elaboration_user_message = {
-            "role": "user",
-            "content": f"""In addition to those scenarios above, list a maximum of {num_bullets-approx_min_cases_to_cover} rare or unexpected edge cases (and as before, under each edge case, include a few examples as sub-bullets).""",
-        }
+        elaboration_user_message = build_elaboration_message(
+            num_bullets, approx_min_cases_to_cover
+        )
         elaboration_messages = [
             explain_system_message,
             explain_user_message,
@@ -167,65 +959,30 @@ Also include:
         ]
         if print_text:
             print_messages([elaboration_user_message])
-        elaboration_response = client.chat.completions.create(
-            model=plan_model,
-            messages=elaboration_messages,
-            temperature=temperature,
-            stream=False,
-        )
-        elaboration = ""
-        if stream:
-            for chunk in elaboration_response:
-                delta = chunk.choices[0].delta
-                if print_text:
-                    print_message_delta(delta)
-                if "content" in delta:
-                    elaboration += delta["content"]
-        else:
-            elaboration = elaboration_response.choices[0].message.content
-            if print_text:
-                print_message_assistant(elaboration)
+        with telemetry.stage("elaborate"):
+            elaboration, memoized = memoized_step(
+                memo,
+                "elaborate",
+                symbol_hash,
+                plan_model,
+                temperature,
+                lambda: complete(plan_model, elaboration_messages),
+                explain_model=explain_model,
+                unit_test_package=unit_test_package,
+                approx_min_cases_to_cover=approx_min_cases_to_cover,
+                **context_params,
+            )
+        if print_text and (memoized or not stream):
+            print_message_assistant(elaboration)
         elaboration_assistant_message = {"role": "assistant", "content": elaboration}
 
     # Step 3: Generate the unit test
-    package_comment = ""
-    if unit_test_package == "pytest":
-        package_comment = "# below, each test case is represented by a tuple passed to the @pytest.mark.parametrize decorator"
-
-    execute_system_message = {
-        "role": "system",
-        "content": (
-            "As a proficient Python developer experienced with pytest, your goal is to achieve 100% code coverage "
-            "through thoughtful and practical unit tests. Write clear, concise, and efficient tests that cover all "
-            "functional aspects of the code without delving into overly complex or unrealistic edge cases. Ensure that "
-            "your test scripts are straightforward and maintain readability and consistency. Your tests should be formatted "
-            "as a single coherent block to facilitate easy recognition by the pytest framework when executing `pytest --cov=src`. "
-            "This focus on practical and comprehensive testing is crucial for accurately evaluating the functionality and "
-            "robustness of the code under typical conditions."
-        ),
-    }
-
-    # Prepare dynamic parts of the user message
-    imports_and_function = f"""# imports
-    import {unit_test_package}  # used for our unit tests
-
-    # function to test
-    from src.{function_filename.split('/')[-1].replace('.py', '')} import {function_to_test.split('(')[0].strip()}
-    """
-
-    # Assemble the user message
-    execute_user_message = {
-        "role": "user",
-        "content": f"""Using Python and the `{unit_test_package}` package, write a suite of unit tests for the function, following the cases above. Include helpful comments to explain each line. Reply only with code, formatted as follows:
-
-    ```python
-    {imports_and_function}
-    # unit tests
-    {package_comment}
-    {{insert unit test code here}}
-    ```
-    The imports and functions to test part has to be exactly like that! However, make sure to import all dependencies that you might add in the cases!""",
-    }
+    execute_system_message, execute_user_message = build_execute_messages(
+        function_to_test,
+        function_filename,
+        unit_test_package,
+        import_name=definition_name(class_skeleton) if class_skeleton else None,
+    )
     execute_messages = [
         execute_system_message,
         explain_user_message,
@@ -240,83 +997,203 @@ Also include:
         print_messages([execute_system_message, execute_user_message])
 
     logging.info("Running unit test generation.")
-    execute_response = client.chat.completions.create(
-        model=execute_model,
-        messages=execute_messages,
-        temperature=temperature,
-        stream=False,
-    )
-    execution = ""
-    if stream:
-        for chunk in execute_response:
-            delta = chunk.choices[0].delta
-            if print_text:
-                print_message_delta(delta)
-            if "content" in delta:
-                execution += delta["content"]
-    else:
-        execution = execute_response.choices[0].message.content
-        if print_text:
-            print_message_assistant(execution)
-
-    code = execution.split("```python")[1].split("```")[0].strip()
-
-    # Check and insert missing imports if necessary
-    if "sys" in code and "import sys" not in code:
-        code = "import sys\n" + code
-
-    try:
-        ast.parse(code)
-    except SyntaxError as e:
-        print(f"Syntax error in generated code: {e}")
-        if reruns_if_fail > 0:
-            print("Rerunning...")
-            return unittest_flow(
-                function_to_test=function_to_test,
-                function_filename=function_filename,
-                unit_test_package=unit_test_package,
-                approx_min_cases_to_cover=approx_min_cases_to_cover,
-                print_text=print_text,
-                explain_model=explain_model,
-                plan_model=plan_model,
-                execute_model=execute_model,
-                temperature=temperature,
-                reruns_if_fail=reruns_if_fail
-                - 1,  # decrement rerun counter when calling again
-            )
+    with telemetry.stage("execute"):
+        code = execute_test_generation(
+            client,
+            execute_model,
+            execute_messages,
+            temperature,
+            reruns_if_fail=reruns_if_fail,
+            cache=cache,
+            stream=stream,
+            on_delta=on_delta,
+            on_answer=print_message_assistant if print_text and not stream else None,
+        )
 
     # Write the unit test to a file
-    output_dir = os.path.join(os.getcwd(), "tests/unit")
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, "test_functions.py")
-
-    with open(output_file, "w") as f:
-        f.write(code)
-
-    logging.info(f"Unit tests written to {output_file}")
-
-    return output_file
+    return write_test_file(
+        code, target_test_file(function_filename, function_to_test, class_skeleton)
+    )
 
 
 import subprocess
 import sys
 
 
-def run_pytest(test_file):
+def run_pytest(test_file, node_ids=None, coverage=None):
+    """
+    Run the tests of ``test_file``.
+
+    Parameters
+    ----------
+    test_file : str
+        The test file to run.
+    node_ids : list of str, optional
+        Run only these tests of the file (pytest node IDs relative to the
+        working directory) instead of all of them.
+    coverage : dict, optional
+        Measure the line and branch coverage of this target (see
+        ``src.coverage_guide.coverage_target``).
+
+    Returns
+    -------
+    dict
+        ``returncode``, ``stdout`` and ``stderr`` of pytest plus ``tests``, one
+        record per test (see ``src.pytest_results``; None if pytest could not
+        report them), ``summary``, the number of tests per outcome, and
+        ``coverage``, the coverage of the target (None if not measured).
+        Tests and runs exceeding the limits of ``src.resource_limits`` are
+        reported with the outcome "resource".
+    """
+    args = list(node_ids) if node_ids else [test_file]
+    limits = get_resource_limits()
+    if warm_pytest_enabled():
+        # A warm worker skips interpreter startup and plugin discovery
+        try:
+            with get_telemetry().stage("pytest"):
+                result = run_pytest_in_worker(
+                    args,
+                    coverage=coverage,
+                    limits=limits.session_limits(),
+                    timeout=limits.run_timeout,
+                )
+            sys.stdout.write(result["stdout"])
+            result["summary"] = summarize(result["tests"])
+            return result
+        except PytestRunTimeout as e:
+            # A subprocess would hang just the same
+            logging.warning(str(e))
+            result = timed_out_result(test_file, limits.run_timeout)
+            result["summary"] = summarize(result["tests"])
+            return result
+        except PytestWorkerError as e:
+            logging.warning(f"{e}, falling back to a pytest subprocess")
+    args = limit_args(limits.session_limits()) + args
+    fd, results_file = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    coverage_file = None
+    if coverage is not None:
+        fd, coverage_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        args = coverage_args(coverage, coverage_file) + args
     try:
         # Use subprocess.run to execute pytest and capture stdout and stderr
-        result = subprocess.run(["pytest", test_file], capture_output=True, text=True)
+        with get_telemetry().stage("pytest"):
+            result = subprocess.run(
+                collector_command(args, results_file),
+                capture_output=True,
+                text=True,
+                env=subprocess_env(),
+                timeout=limits.run_timeout,
+            )
+        tests = load_results(results_file)
+        target_coverage = load_results(coverage_file) if coverage_file else None
         # Return the structured result containing the return code, stdout, and stderr
         sys.stdout.write(result.stdout)
         return {
             "returncode": result.returncode,
             "stdout": result.stdout,
             "stderr": result.stderr,
+            "tests": tests,
+            "summary": summarize(tests or []),
+            "coverage": target_coverage,
         }
-    except subprocess.CalledProcessError as e:
-        # Handle potential errors during the subprocess execution
-        sys.stderr.write(f"An error occurred while running pytest: {e}\n")
-        return {"returncode": e.returncode, "stdout": "", "stderr": str(e)}
+    except subprocess.TimeoutExpired:
+        logging.warning(f"pytest run exceeded the time limit of {limits.run_timeout}s")
+        load_results(results_file)
+        if coverage_file:
+            load_results(coverage_file)
+        result = timed_out_result(test_file, limits.run_timeout)
+        result["summary"] = summarize(result["tests"])
+        return result
+
+
+def build_correction_messages(
+    function_to_test, function_filename, test_results, failed_test_cases
+):
+    """Return the system and user messages of the correction step."""
+    correction_system_message = {
+        "role": "system",
+        "content": f"""
+        Correction of Python Function Based on Unit Tests
+
+        Description:
+        A Python unittest file named {function_filename} contains several unit tests for the function {function_to_test}. Your task is to either modify or create {function_to_test} to pass all these tests. The modified or new function should preserve or enhance all functionalities of the original function, excluding any identified bugs.
+
+        Input:
+        - File Name: {function_filename} - Contains unit tests for {function_to_test}.
+        - Test Details: Each test case is briefly described with inputs and the expected outputs.
+
+        Task:
+        1. Analyze the unit tests to fully understand the intended functionalities and required behaviors of {function_to_test}.
+        2. Modify or create the Python code for {function_to_test} ensuring it meets all test conditions in {function_filename}.
+        3. Maintain or expand upon the original function's capabilities, correcting or excluding only the faulty behaviors.
+
+        Output:
+        - Updated Python code for {function_to_test} that successfully passes all the tests in the provided unittest file.
+
+        Additional Instructions:
+        - Ensure the code is clean, well-commented, and follows standard Python coding conventions.
+        - Document any assumptions made during the code correction process.
+        - Address any ambiguous or incorrect test cases in your submission, detailing how you approached and resolved these issues.
+        - Consider edge cases and additional scenarios that may not be covered by the tests but are relevant to the function’s use cases.
+        - Do your absolute best!
+        """,
+    }
+
+    correction_user_message = {
+        "role": "user",
+        "content": f"""Please correct the following Python function to make it pass the given unit tests. The following are the test results and error messages:
+
+Test results:
+{describe_results(test_results)}
+
+Failed test cases:
+{format_failures(failed_test_cases)}
+
+Ensure the corrected function maintains its intended functionality and fixes any bugs.
+
+```python
+{function_to_test}
+```""",
+    }
+
+    return [correction_system_message, correction_user_message]
+
+
+def extract_corrected_function(corrected_function_content):
+    """
+    Extract the corrected code from the model's answer.
+
+    Returns None if the answer contains no python block.
+    """
+    try:
+        return corrected_function_content.split("```python")[1].split("```")[0].strip()
+    except IndexError:
+        logging.error("Failed to extract corrected function from response.")
+        return None
+
+
+def write_corrected_definition(corrected_code, function_filename, qualname):
+    """
+    Replace only the definition ``qualname`` of ``function_filename`` with the corrected code.
+
+    The rest of the module is kept, including the other targets that are
+    tested concurrently; the definition is looked up again under the file's
+    lock, so their corrections are kept as well.
+    """
+    with locked(function_filename):
+        symbol = get_symbol_index().lookup(function_filename, qualname)
+        if symbol is None:
+            raise ValueError(f"'{qualname}' not found in '{function_filename}'")
+        with open(function_filename, "r") as f:
+            lines = f.read().splitlines(keepends=True)
+        definition = lines[symbol["first_line"] - 1]
+        indent = definition[: len(definition) - len(definition.lstrip())]
+        corrected = textwrap.indent(textwrap.dedent(corrected_code).strip("\n") + "\n", indent)
+        lines[symbol["first_line"] - 1 : symbol["last_line"]] = [corrected]
+        atomic_write(function_filename, "".join(lines))
+    return function_filename
 
 
 def correct_function(
@@ -326,6 +1203,9 @@ def correct_function(
     failed_test_cases,
     correct_model="gpt-3.5-turbo",
     temperature=0.6,
+    cache=None,
+    client=None,
+    qualname=None,
 ):
     """
     Corrects a Python function based on unit test failures provided as inputs.
@@ -336,14 +1216,22 @@ def correct_function(
         The name of the function to be corrected.
     function_filename : str
         The filename where the unit tests for the function are located.
-    test_results : str
-        String detailing the results of running the unit tests.
-    failed_test_cases : str
-        Detailed descriptions of which test cases failed and possibly why.
+    test_results : dict
+        The result of ``run_pytest`` for the unit tests.
+    failed_test_cases : list or str
+        The failure records returned by ``extract_failed_test_cases``.
     correct_model : str, optional
         The name of the AI model used to generate corrections (default is "gpt-3.5-turbo").
     temperature : float, optional
         The creativity temperature for generating the correction (default is 0.4).
+    cache : ResponseCache, optional
+        The response cache to consult (default is the process-wide response cache).
+    client : OpenAI, optional
+        The client used for the request (default is the shared, pooled client).
+    qualname : str, optional
+        The plain or qualified name of the target in ``function_filename``
+        (default is the name defined by ``function_to_test``); the correction
+        replaces only its definition, see ``write_corrected_definition``.
 
     Returns
     -------
@@ -362,82 +1250,149 @@ def correct_function(
             'Failed at input 3: expected 9, got 3', 'gpt-3.5-turbo', 0.4
         )
     """
-    client = OpenAI()
+    if client is None:
+        client = get_client()
+    if cache is None:
+        cache = get_response_cache()
     logging.info("Starting function correction...")
 
-    correction_system_message = {
-        "role": "system",
-        "content": f"""
-        Correction of Python Function Based on Unit Tests
+    correction_messages = build_correction_messages(
+        function_to_test, function_filename, test_results, failed_test_cases
+    )
+    with get_telemetry().stage("correct"):
+        correction_response = chat_completion(
+            client,
+            model=correct_model,
+            messages=correction_messages,
+            temperature=temperature,
+            cache=cache,
+        )
+    corrected_function_content = correction_response.choices[0].message.content
 
-        Description:
-        A Python unittest file named {function_filename} contains several unit tests for the function {function_to_test}. Your task is to either modify or create {function_to_test} to pass all these tests. The modified or new function should preserve or enhance all functionalities of the original function, excluding any identified bugs.
+    corrected_function = extract_corrected_function(corrected_function_content)
+    if corrected_function is None:
+        cache.delete(cache.key(correct_model, correction_messages, temperature))
+        corrected_function = (
+            function_to_test  # Fallback to the original function in case of error
+        )
 
-        Input:
-        - File Name: {function_filename} - Contains unit tests for {function_to_test}.
-        - Test Details: Each test case is briefly described with inputs and the expected outputs.
+    output_file = write_corrected_definition(
+        corrected_function, function_filename, qualname or definition_name(function_to_test)
+    )
 
-        Task:
-        1. Analyze the unit tests to fully understand the intended functionalities and required behaviors of {function_to_test}.
-        2. Modify or create the Python code for {function_to_test} ensuring it meets all test conditions in {function_filename}.
-        3. Maintain or expand upon the original function's capabilities, correcting or excluding only the faulty behaviors.
+    return corrected_function, output_file
 
-        Output:
-        - Updated Python code for {function_to_test} that successfully passes all the tests in the provided unittest file.
 
-        Additional Instructions:
-        - Ensure the code is clean, well-commented, and follows standard Python coding conventions.
-        - Document any assumptions made during the code correction process.
-        - Address any ambiguous or incorrect test cases in your submission, detailing how you approached and resolved these issues.
-        - Consider edge cases and additional scenarios that may not be covered by the tests but are relevant to the function’s use cases.
-        - Do your absolute best!
-        """,
+def build_coverage_messages(function_to_test, test_code, coverage):
+    """Return the system and user messages asking for tests of the uncovered code only."""
+    coverage_system_message = {
+        "role": "system",
+        "content": (
+            "As a proficient Python developer experienced with pytest, your goal is to close the remaining gaps in the "
+            "code coverage of an existing test suite. Write only the additional tests needed to execute the listed "
+            "lines and take the listed branches; do not repeat or rewrite the existing tests."
+        ),
     }
-
-    correction_user_message = {
+    coverage_user_message = {
         "role": "user",
-        "content": f"""Please correct the following Python function to make it pass the given unit tests. The following are the test results and error messages:
-
-Test results:
-{test_results}
+        "content": f"""The following code is tested by the test module below, which reaches {coverage['percent']:.1f}% line and branch coverage.
 
-Failed test cases:
-{failed_test_cases}
+```python
+{function_to_test}
+```
 
-Ensure the corrected function maintains its intended functionality and fixes any bugs.
+Existing tests:
 
 ```python
-{function_to_test}
-```""",
+{test_code}
+```
+
+These parts of the code are not covered yet:
+{format_uncovered(coverage)}
+
+Write new test functions that cover exactly these lines and branches. Reply only with the new tests (and any imports they need beyond the existing ones) in a single ```python block; they are added to the existing test module.""",
     }
+    return [coverage_system_message, coverage_user_message]
 
-    correction_messages = [correction_system_message, correction_user_message]
-    correction_response = client.chat.completions.create(
-        model=correct_model,
-        messages=correction_messages,
-        temperature=temperature,
-        stream=False,
-    )
-    corrected_function_content = correction_response.choices[0].message.content
 
-    try:
-        corrected_function = (
-            corrected_function_content.split("```python")[1].split("```")[0].strip()
-        )
-    except IndexError:
-        logging.error("Failed to extract corrected function from response.")
-        corrected_function = (
-            function_to_test  # Fallback to the original function in case of error
-        )
+def append_coverage_tests(test_file, answer):
+    """
+    Merge the tests of a coverage follow-up answer into ``test_file``.
 
-    output_dir = os.path.join(os.getcwd(), "src")
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, function_filename)
+    Returns
+    -------
+    bool
+        False, leaving the file untouched, if the answer has no code that
+        parses or only repeats existing tests.
+    """
+    code, error = parse_test_code(answer)
+    if code is None or error is not None:
+        logging.warning(f"Discarding coverage follow-up tests: {error}")
+        return False
+    with locked(test_file):
+        with open(test_file, "r") as f:
+            test_code = f.read()
+        extended, stats = merge_test_modules(test_code, code)
+        if not stats["added"] and not stats["merged_cases"]:
+            logging.warning("The coverage follow-up answer only repeats existing tests.")
+            return False
+        atomic_write(test_file, extended)
+    return True
 
-    with open(output_file, "w") as f:
-        f.write(corrected_function)
 
-    return corrected_function, output_file
+def extend_tests_for_coverage(
+    function_to_test,
+    test_file,
+    coverage,
+    execute_model="gpt-3.5-turbo",
+    temperature=0.4,
+    cache=None,
+    client=None,
+):
+    """
+    Ask for tests of the uncovered lines and branches of a target and append them.
+
+    Parameters
+    ----------
+    function_to_test : str
+        The source code of the tested class or function.
+    test_file : str
+        The test module, which passes but misses parts of the target.
+    coverage : dict
+        The coverage of the target reported by ``run_pytest``.
+    execute_model : str, optional
+        The model writing the tests (default is "gpt-3.5-turbo").
+    temperature : float, optional
+        The sampling temperature (default is 0.4).
+    cache : ResponseCache, optional
+        The response cache to consult (default is the process-wide response cache).
+    client : OpenAI, optional
+        The client used for the request (default is the shared, pooled client).
+
+    Returns
+    -------
+    bool
+        Whether tests were added to ``test_file``.
+    """
+    if client is None:
+        client = get_client()
+    if cache is None:
+        cache = get_response_cache()
+    with open(test_file, "r") as f:
+        test_code = f.read()
+    coverage_messages = build_coverage_messages(function_to_test, test_code, coverage)
+    with get_telemetry().stage("coverage"):
+        coverage_response = chat_completion(
+            client,
+            model=execute_model,
+            messages=coverage_messages,
+            temperature=temperature,
+            cache=cache,
+        )
+    if not append_coverage_tests(test_file, coverage_response.choices[0].message.content):
+        cache.delete(cache.key(execute_model, coverage_messages, temperature))
+        return False
+    return True
 
 
 import re
@@ -449,6 +1404,19 @@ import logging
 
 
 def extract_failed_test_cases(pytest_result):
+    """
+    Return the failed tests of a ``run_pytest`` result.
+
+    Returns
+    -------
+    list or str
+        The failure records reported by the result collector, or, if pytest
+        reported none (e.g. it could not start), the short test summary
+        scraped from its output.
+    """
+    failures = failed_tests(pytest_result.get("tests") or [])
+    if failures:
+        return failures
     try:
         test_output = pytest_result[
             "stdout"
@@ -1,7 +1,14 @@
 import ast
-from openai import OpenAI
 import pytest
 
+from .client import get_client
+from .response_cache import ResponseCache, get_response_cache
+from .unittest_flow import (
+    build_syntax_repair_message,
+    chat_completion,
+    count_pipeline_event,
+)
+
 color_prefix_by_role = {
     "system": "\033[0m",  # gray
     "user": "\033[0m",  # gray
@@ -18,7 +25,9 @@ def unit_tests_from_function(
     execute_model: str = "gpt-3.5-turbo",
     temperature: float = 0.4,
     reruns_if_fail: int = 1,
-    stream: bool = False
+    stream: bool = False,
+    cache: ResponseCache = None,
+    client=None
 ) -> str:
     """
     Generate unit tests for a given Python function.
@@ -33,6 +42,8 @@ def unit_tests_from_function(
     - execute_model (str, optional): The GPT model for generating code (default is "gpt-3.5-turbo").
     - temperature (float, optional): The temperature for text generation (default is 0.4).
     - reruns_if_fail (int, optional): Number of reruns if code parsing fails (default is 1).
+    - cache (ResponseCache, optional): Response cache to consult (default is the process-wide cache).
+    - client (OpenAI, optional): Client used for all requests (default is the shared, pooled client).
 
     Returns:
     str: The generated unit tests as a string.
@@ -65,7 +76,11 @@ def unit_tests_from_function(
             print_text=True
         )
     """
-    client = OpenAI()
+    if client is None:
+        client = get_client()
+    if cache is None:
+        cache = get_response_cache()
+    on_delta = print_message_delta if print_text else None
     # Step 1: Generate an explanation of the function
 
     # create a markdown-formatted message that asks GPT to explain the function, formatted as a bullet list
@@ -85,20 +100,15 @@ def unit_tests_from_function(
     if print_text:
         print_messages(explain_messages)
 
-    explanation_response = client.chat.completions.create(model=explain_model,
-                                                          messages=explain_messages,
-                                                          temperature=temperature,
-                                                          stream=False)
-    explanation = ""
-    if stream:
-        for chunk in explanation_response:
-            delta = chunk.choices[0].delta
-            if print_text:
-                print_message_delta(delta)
-            if "content" in delta:
-                explanation += delta["content"]
-    else:
-        explanation = explanation_response.choices[0].message.content
+    explanation_response = chat_completion(client,
+    model=explain_model,
+    messages=explain_messages,
+    temperature=temperature,
+    cache=cache,
+    stream=stream,
+    on_delta=on_delta)
+    explanation = explanation_response.choices[0].message.content
+    if not stream:
         print_message_assistant(explanation)
     explain_assistant_message = {"role": "assistant", "content": explanation}
 
@@ -124,20 +134,15 @@ To help unit test the function above, list diverse scenarios that the function s
     ]
     if print_text:
         print_messages([plan_user_message])
-    plan_response = client.chat.completions.create(model=plan_model,
+    plan_response = chat_completion(client,
+    model=plan_model,
     messages=plan_messages,
     temperature=temperature,
-    stream=False)
-    plan = ""
-    if stream:
-        for chunk in plan_response:
-            delta = chunk.choices[0].delta
-            if print_text:
-                print_message_delta(delta)
-            if "content" in delta:
-                plan += delta["content"]
-    else:
-        plan = plan_response.choices[0].message.content
+    cache=cache,
+    stream=stream,
+    on_delta=on_delta)
+    plan = plan_response.choices[0].message.content
+    if not stream:
         print_message_assistant(plan)
     plan_assistant_message = {"role": "assistant", "content": plan}
 
@@ -160,20 +165,15 @@ To help unit test the function above, list diverse scenarios that the function s
         ]
         if print_text:
             print_messages([elaboration_user_message])
-        elaboration_response = client.chat.completions.create(model=plan_model,
+        elaboration_response = chat_completion(client,
+        model=plan_model,
         messages=elaboration_messages,
         temperature=temperature,
-        stream=False)
-        elaboration = ""
-        if stream:
-            for chunk in elaboration_response:
-                delta = chunk.choices[0].delta
-                if print_text:
-                    print_message_delta(delta)
-                if "content" in delta:
-                    elaboration += delta["content"]
-        else:
-            elaboration = elaboration_response.choices[0].message.content
+        cache=cache,
+        stream=stream,
+        on_delta=on_delta)
+        elaboration = elaboration_response.choices[0].message.content
+        if not stream:
             print_message_assistant(elaboration)
         elaboration_assistant_message = {"role": "assistant", "content": elaboration}
 
@@ -217,41 +217,37 @@ import {unit_test_package}  # used for our unit tests
     if print_text:
         print_messages([execute_system_message, execute_user_message])
 
-    execute_response = client.chat.completions.create(model=execute_model,
-    messages=execute_messages,
-    temperature=temperature,
-    stream=False)
-    execution = ""
-    if stream:
-        for chunk in execute_response:
-            delta = chunk.choices[0].delta
-            if print_text:
-                print_message_delta(delta)
-            if "content" in delta:
-                execution += delta["content"]
-    else:
+    attempt_messages = execute_messages
+    for attempt in range(reruns_if_fail + 1):
+        execute_response = chat_completion(client,
+        model=execute_model,
+        messages=attempt_messages,
+        temperature=temperature,
+        cache=cache,
+        stream=stream,
+        on_delta=on_delta,
+        stop_at_code_end=True)
         execution = execute_response.choices[0].message.content
-        print_message_assistant(execution)
-    # check the output for errors
-    code = execution.split("```python")[1].split("```")[0].strip()
-    try:
-        ast.parse(code)
-    except SyntaxError as e:
-        print(f"Syntax error in generated code: {e}")
-        if reruns_if_fail > 0:
-            print("Rerunning...")
-            return unit_tests_from_function(
-                function_to_test=function_to_test,
-                unit_test_package=unit_test_package,
-                approx_min_cases_to_cover=approx_min_cases_to_cover,
-                print_text=print_text,
-                explain_model=explain_model,
-                plan_model=plan_model,
-                execute_model=execute_model,
-                temperature=temperature,
-                reruns_if_fail=reruns_if_fail
-                - 1,  # decrement rerun counter when calling again
-            )
+        if not stream:
+            print_message_assistant(execution)
+        # check the output for errors
+        code = execution.split("```python")[1].split("```")[0].strip()
+        try:
+            ast.parse(code)
+            break
+        except SyntaxError as e:
+            print(f"Syntax error in generated code: {e}")
+            count_pipeline_event("parse_failures")
+            if attempt == reruns_if_fail:
+                cache.delete(cache.key(execute_model, execute_messages, temperature))
+                break
+            # re-ask only the execute step, with the parser error as feedback
+            print("Rerunning the execute step...")
+            count_pipeline_event("execute_retries")
+            attempt_messages = attempt_messages + [
+                {"role": "assistant", "content": execution},
+                build_syntax_repair_message(f"SyntaxError: {e}"),
+            ]
 
     # return the unit test as a string
     return code
@@ -299,17 +295,14 @@ def print_message_delta(delta, color_prefix_by_role=color_prefix_by_role):
     Print a chunk of messages streamed back from GPT.
 
     Parameters:
-    - delta: The message delta to print.
+    - delta (ChoiceDelta): The message delta to print.
     - color_prefix_by_role (dict, optional): Color prefixes for different roles (default is provided color scheme).
 
     Prints message chunks with color-coded prefixes.
     """
-    if "role" in delta:
-        role = delta["role"]
+    if delta.role:
+        role = delta.role
         color_prefix = color_prefix_by_role[role]
         print(f"{color_prefix}\n[{role}]\n", end="")
-    elif "content" in delta:
-        content = delta["content"]
-        print(content, end="")
-    else:
-        pass
+    if delta.content:
+        print(delta.content, end="")
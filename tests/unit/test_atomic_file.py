@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from src import atomic_file
+from src.atomic_file import atomic_write, locked
+
+INCREMENTS = 50
+
+
+def increment(path, times=INCREMENTS):
+    for _ in range(times):
+        with locked(path):
+            with open(path, "r") as f:
+                value = int(f.read())
+            atomic_write(path, str(value + 1))
+
+
+def test_locked_updates_from_threads_are_not_lost(tmp_path):
+    path = str(tmp_path / "counter.txt")
+    atomic_write(path, "0")
+    threads = [threading.Thread(target=increment, args=(path,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(path, "r") as f:
+        assert int(f.read()) == 8 * INCREMENTS
+
+
+@pytest.mark.skipif(
+    atomic_file.fcntl is None or "fork" not in multiprocessing.get_all_start_methods(),
+    reason="needs flock and fork",
+)
+def test_locked_updates_from_processes_are_not_lost(tmp_path):
+    path = str(tmp_path / "counter.txt")
+    atomic_write(path, "0")
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=increment, args=(path,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+    with open(path, "r") as f:
+        assert int(f.read()) == 4 * INCREMENTS
+
+
+def test_readers_never_see_a_partial_write(tmp_path):
+    path = str(tmp_path / "tests.py")
+    size = 256 * 1024
+    atomic_write(path, "a" * size)
+    stop = threading.Event()
+    seen = []
+
+    def read():
+        while not stop.is_set():
+            with open(path, "r") as f:
+                text = f.read()
+            seen.append((len(text), set(text)))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for i in range(50):
+        atomic_write(path, ("b" if i % 2 else "a") * size)
+    stop.set()
+    reader.join()
+    assert seen
+    assert all(length == size and len(chars) == 1 for length, chars in seen)
+
+
+def test_failed_write_keeps_the_file_and_leaves_no_temporary_file(tmp_path):
+    path = str(tmp_path / "tests.py")
+    atomic_write(path, "original")
+    with pytest.raises(TypeError):
+        atomic_write(path, b"not text")
+    with open(path, "r") as f:
+        assert f.read() == "original"
+    assert os.listdir(tmp_path) == ["tests.py"]
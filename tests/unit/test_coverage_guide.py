@@ -0,0 +1,113 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from src.coverage_guide import (
+    coverage_args,
+    coverage_target,
+    describe_coverage,
+    restrict_to_target,
+)
+from src.symbol_index import configure_symbol_index
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TARGET = '''\
+def other():
+    return 0
+
+
+def sign(x):
+    if x < 0:
+        return -1
+    return 1
+'''
+
+SIGN = TARGET[TARGET.index("def sign") :]
+
+
+@pytest.fixture(autouse=True)
+def symbol_index():
+    configure_symbol_index("")
+    yield
+    configure_symbol_index("")
+
+
+@pytest.fixture
+def target_module(tmp_path):
+    path = tmp_path / "signs.py"
+    path.write_text(TARGET)
+    return path
+
+
+def run_with_coverage(tmp_path, target, test_code):
+    test_file = tmp_path / "test_signs.py"
+    test_file.write_text(test_code)
+    coverage_file = tmp_path / "coverage.json"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, str(tmp_path)]))
+    process = subprocess.run(
+        [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider", str(test_file)]
+        + coverage_args(target, str(coverage_file)),
+        cwd=tmp_path,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    with open(coverage_file, "r") as f:
+        return process, json.load(f)
+
+
+def test_coverage_target_finds_the_definition(target_module):
+    target = coverage_target(str(target_module), SIGN)
+    assert target == {"file": str(target_module), "first_line": 5, "last_line": 8}
+
+
+def test_coverage_target_without_definition_is_the_whole_file(target_module):
+    target = coverage_target(str(target_module), "x = 1")
+    assert target["first_line"] is None and target["last_line"] is None
+
+
+def test_restrict_to_target_counts_only_the_span():
+    file_report = {
+        "executed_lines": [1, 2, 5, 6],
+        "missing_lines": [7, 8],
+        "executed_branches": [[6, 7]],
+        "missing_branches": [[6, 8], [1, 2]],
+    }
+    coverage = restrict_to_target(file_report, {"file": "f.py", "first_line": 5, "last_line": 8})
+    assert coverage["statements"] == 4
+    assert coverage["branches"] == 2
+    assert coverage["missing_lines"] == [7, 8]
+    assert coverage["missing_branches"] == [[6, 8]]
+    assert coverage["percent"] == pytest.approx(50.0)
+
+
+def test_restrict_to_target_without_measured_lines_is_unknown():
+    coverage = restrict_to_target({}, {"file": "f.py", "first_line": 5, "last_line": 8})
+    assert coverage["statements"] == 0 and coverage["branches"] == 0
+    assert coverage["percent"] is None
+    assert describe_coverage(coverage) == "coverage unknown"
+
+
+def test_collector_measures_the_target(tmp_path, target_module):
+    target = coverage_target(str(target_module), SIGN)
+    process, coverage = run_with_coverage(
+        tmp_path, target, "from signs import sign\n\n\ndef test_positive():\n    assert sign(1) == 1\n"
+    )
+    assert process.returncode == 0, process.stdout + process.stderr
+    assert coverage["missing_lines"] == [7]
+    assert coverage["missing_branches"] == [[6, 7]]
+
+
+def test_collector_when_the_target_is_never_imported(tmp_path, target_module):
+    # coverage.py writes no report without data, which must not crash the session
+    target = coverage_target(str(target_module), SIGN)
+    process, coverage = run_with_coverage(
+        tmp_path, target, "def test_unrelated():\n    assert True\n"
+    )
+    assert process.returncode == 0, process.stdout + process.stderr
+    assert "INTERNALERROR" not in process.stdout
+    assert coverage["statements"] == 0
@@ -0,0 +1,189 @@
+import subprocess
+
+import pytest
+
+from src.incremental import (
+    load_run_state,
+    module_name,
+    record_passed_targets,
+    select_changed_targets,
+)
+from src.symbol_index import configure_symbol_index, get_symbol_index
+
+HELPERS = '''\
+def scale(x):
+    return x * 2
+
+
+def unrelated():
+    return 0
+'''
+
+SHAPES = '''\
+from helpers import scale
+
+
+class Square:
+    def area(self, side):
+        return scale(side) * side
+
+
+def perimeter(side):
+    return 4 * side
+'''
+
+
+@pytest.fixture(autouse=True)
+def symbol_index():
+    configure_symbol_index("")
+    yield
+    configure_symbol_index("")
+
+
+@pytest.fixture
+def project(tmp_path):
+    (tmp_path / "helpers.py").write_text(HELPERS)
+    (tmp_path / "shapes.py").write_text(SHAPES)
+    return tmp_path
+
+
+def targets_of(project):
+    return [
+        (str(project / "helpers.py"), "scale"),
+        (str(project / "helpers.py"), "unrelated"),
+        (str(project / "shapes.py"), "Square"),
+        (str(project / "shapes.py"), "Square.area"),
+        (str(project / "shapes.py"), "perimeter"),
+    ]
+
+
+def record_all(targets, state_file):
+    index = get_symbol_index()
+    passed = {}
+    for path, name in targets:
+        symbol = index.lookup(path, name)
+        passed[(path, symbol["qualname"])] = symbol["ast_hash"]
+    record_passed_targets(passed, state_file)
+
+
+def test_everything_is_selected_without_a_state(project, tmp_path):
+    targets = targets_of(project)
+    selected, counts = select_changed_targets(targets, state_file=str(tmp_path / "none.json"))
+    assert selected == targets
+    assert counts == {"changed": 5, "dependents": 0}
+
+
+def test_nothing_is_selected_after_a_passing_run(project, tmp_path):
+    targets = targets_of(project)
+    state_file = str(tmp_path / "state.json")
+    record_all(targets, state_file)
+    assert len(load_run_state(state_file)) == 5
+    assert select_changed_targets(targets, state_file=state_file) == ([], {"changed": 0, "dependents": 0})
+
+
+def test_formatting_and_docstrings_select_nothing(project, tmp_path):
+    targets = targets_of(project)
+    state_file = str(tmp_path / "state.json")
+    record_all(targets, state_file)
+    (project / "helpers.py").write_text(
+        HELPERS.replace("def scale(x):\n", 'def scale(x):\n    """Double x."""\n    # twice\n')
+    )
+    selected, _ = select_changed_targets(targets, state_file=state_file)
+    assert selected == []
+
+
+def test_changed_target_and_its_dependents_across_modules(project, tmp_path):
+    targets = targets_of(project)
+    state_file = str(tmp_path / "state.json")
+    record_all(targets, state_file)
+    (project / "helpers.py").write_text(HELPERS.replace("x * 2", "x * 3"))
+    selected, counts = select_changed_targets(targets, state_file=state_file)
+    # Square and Square.area use scale from the changed module
+    assert selected == [targets[0], targets[2], targets[3]]
+    assert counts == {"changed": 1, "dependents": 2}
+
+
+def test_missing_target_is_selected(project, tmp_path):
+    targets = targets_of(project)
+    state_file = str(tmp_path / "state.json")
+    record_all(targets, state_file)
+    missing = (str(project / "shapes.py"), "Circle")
+    selected, counts = select_changed_targets(targets + [missing], state_file=state_file)
+    assert selected == [missing]
+    assert counts["changed"] == 1
+
+
+def test_module_names_are_dotted_paths_below_the_root(tmp_path):
+    assert module_name(str(tmp_path / "pkg" / "utils.py"), str(tmp_path)) == "pkg.utils"
+    assert module_name(str(tmp_path / "pkg" / "__init__.py"), str(tmp_path)) == "pkg"
+    assert module_name(str(tmp_path / "utils.py"), str(tmp_path / "pkg")) is None
+
+
+@pytest.mark.parametrize(
+    "import_line, imported",
+    [
+        ("from pkg.utils import scale", "pkg"),
+        ("from .utils import scale", "pkg"),
+        ("from . import utils", "pkg"),
+        ("from other.utils import scale", "other"),
+        ("from ..other.utils import scale", "other"),
+    ],
+)
+def test_dependents_import_the_changed_module_by_its_dotted_name(tmp_path, import_line, imported):
+    for package in ("pkg", "other"):
+        (tmp_path / package).mkdir()
+        (tmp_path / package / "__init__.py").write_text("")
+        (tmp_path / package / "utils.py").write_text(HELPERS)
+    (tmp_path / "pkg" / "shapes.py").write_text(SHAPES.replace("from helpers import scale", import_line))
+    targets = [
+        (str(tmp_path / "pkg" / "utils.py"), "scale"),
+        (str(tmp_path / "other" / "utils.py"), "scale"),
+        (str(tmp_path / "pkg" / "shapes.py"), "Square.area"),
+    ]
+    state_file = str(tmp_path / "state.json")
+    record_all(targets, state_file)
+    # Both modules are called utils, only the imported one makes Square.area a dependent
+    (tmp_path / "other" / "utils.py").write_text(HELPERS.replace("x * 2", "x * 3"))
+    selected, _ = select_changed_targets(targets, state_file=state_file)
+    assert selected == [targets[1]] + ([targets[2]] if imported == "other" else [])
+
+
+def test_packages_are_resolved_beyond_the_root(tmp_path):
+    package = tmp_path / "app"
+    package.mkdir()
+    (package / "__init__.py").write_text("")
+    (package / "helpers.py").write_text(HELPERS)
+    (package / "shapes.py").write_text(SHAPES.replace("from helpers", "from app.helpers"))
+    targets = [(str(package / "helpers.py"), "scale"), (str(package / "shapes.py"), "Square.area")]
+    state_file = str(tmp_path / "state.json")
+    record_all(targets, state_file)
+    (package / "helpers.py").write_text(HELPERS.replace("x * 2", "x * 3"))
+    assert select_changed_targets(targets, state_file=state_file)[0] == targets
+
+
+def git(project, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=project,
+        check=True,
+        capture_output=True,
+    )
+
+
+def test_changed_since_a_git_revision(project):
+    git(project, "init", "-q")
+    git(project, "add", ".")
+    git(project, "commit", "-q", "-m", "initial")
+    targets = targets_of(project)
+    assert select_changed_targets(targets, revision="HEAD")[0] == []
+
+    (project / "shapes.py").write_text(SHAPES.replace("4 * side", "side + side + side + side"))
+    selected, counts = select_changed_targets(targets, revision="HEAD")
+    assert selected == [targets[4]]
+    assert counts == {"changed": 1, "dependents": 0}
+
+
+def test_unknown_revision_is_an_error(project):
+    git(project, "init", "-q")
+    with pytest.raises(ValueError):
+        select_changed_targets(targets_of(project), revision="no-such-revision")
@@ -0,0 +1,110 @@
+import httpx
+import pytest
+from openai import RateLimitError
+
+from src import rate_limiter
+from src.rate_limiter import RateLimiter, TokenBucket, retry_after_seconds
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    return clock
+
+
+def rate_limit_error(**headers):
+    request = httpx.Request("POST", "https://api.example.com/v1/chat/completions")
+    response = httpx.Response(429, headers=headers, request=request)
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+def test_bucket_refills_continuously(clock):
+    bucket = TokenBucket(60)
+    bucket.consume(60)
+    assert bucket.wait_time(1, clock.now) == pytest.approx(1.0)
+    assert bucket.wait_time(1, clock.now + 0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(1, clock.now + 1) == 0.0
+    # Never more than one minute of budget
+    assert bucket.wait_time(60, clock.now + 3600) == 0.0
+    assert bucket.level == 60
+
+
+def test_usage_above_the_estimate_is_paid_back_by_the_refill(clock):
+    bucket = TokenBucket(60)
+    bucket.consume(30)
+    bucket.adjust(-60)
+    assert bucket.level == -30
+    assert bucket.wait_time(1, clock.now) == pytest.approx(31.0)
+
+
+def test_acquire_waits_for_the_request_budget(clock):
+    limiter = RateLimiter(requests_per_minute=60)
+    for _ in range(60):
+        limiter.acquire(1)
+    assert clock.sleeps == []
+    limiter.acquire(1)
+    assert sum(clock.sleeps) == pytest.approx(1.0)
+
+
+def test_acquire_waits_for_the_token_budget(clock):
+    limiter = RateLimiter(tokens_per_minute=600)
+    limiter.acquire(500)
+    limiter.acquire(200)
+    # 100 tokens were missing, at 10 tokens per second
+    assert sum(clock.sleeps) == pytest.approx(10.0)
+
+
+def test_retry_after_headers():
+    assert retry_after_seconds(rate_limit_error(**{"retry-after": "7"})) == 7.0
+    assert retry_after_seconds(rate_limit_error(**{"retry-after-ms": "250"})) == 0.25
+    assert retry_after_seconds(rate_limit_error(**{"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) is None
+    assert retry_after_seconds(rate_limit_error()) is None
+
+
+def test_backoff_is_jittered_and_never_undercuts_retry_after():
+    limiter = RateLimiter(base_delay=1.0, max_delay=8.0)
+    for attempt in range(6):
+        delay = limiter.backoff_delay(attempt)
+        expected = min(8.0, 2**attempt)
+        assert expected / 2 <= delay <= expected
+    assert limiter.backoff_delay(0, retry_after=30.0) == 30.0
+
+
+def test_call_waits_as_long_as_retry_after(clock):
+    limiter = RateLimiter(base_delay=0.01)
+    attempts = []
+
+    def request():
+        attempts.append(clock.now)
+        if len(attempts) == 1:
+            raise rate_limit_error(**{"retry-after": "7"})
+        return "response"
+
+    assert limiter.call(request, 10) == "response"
+    assert attempts[1] - attempts[0] >= 7.0
+    assert limiter.stats() == {"rate_limited": 1, "retries": 1}
+
+
+def test_call_gives_up_after_max_retries(clock):
+    limiter = RateLimiter(max_retries=2, base_delay=0.01)
+
+    def request():
+        raise rate_limit_error()
+
+    with pytest.raises(RateLimitError):
+        limiter.call(request, 10)
+    assert limiter.stats()["retries"] == 2
@@ -0,0 +1,61 @@
+import os
+
+from src.response_cache import ResponseCache
+
+MESSAGES = [{"role": "user", "content": "Write tests for add()"}]
+
+
+def age_entries(cache, keys):
+    # File times are too coarse to order entries written in a row, set them apart
+    for age, key in enumerate(reversed(keys), start=1):
+        seconds = 1_000_000 - age * 60
+        os.utime(cache._path(key), (seconds, seconds))
+
+
+def test_key_covers_model_messages_and_temperature():
+    key = ResponseCache.key("gpt-3.5-turbo", MESSAGES, 0.3)
+    assert key == ResponseCache.key("gpt-3.5-turbo", [dict(reversed(MESSAGES[0].items()))], 0.3)
+    assert key != ResponseCache.key("gpt-4o", MESSAGES, 0.3)
+    assert key != ResponseCache.key("gpt-3.5-turbo", MESSAGES, 0.4)
+    assert key != ResponseCache.key(
+        "gpt-3.5-turbo", [{"role": "user", "content": "Write tests for sub()"}], 0.3
+    )
+
+
+def test_round_trip_and_counters(tmp_path):
+    cache = ResponseCache(directory=str(tmp_path))
+    key = ResponseCache.key("gpt-3.5-turbo", MESSAGES, 0.3)
+    assert cache.get(key) is None
+    cache.put(key, {"content": "def test_add(): ..."})
+    assert cache.get(key) == {"content": "def test_add(): ..."}
+    assert cache.stats() == {"hits": 1, "misses": 1, "bypass": False}
+
+
+def test_least_recently_read_entry_is_evicted(tmp_path):
+    cache = ResponseCache(directory=str(tmp_path), max_entries=3)
+    keys = [ResponseCache.key("gpt-3.5-turbo", MESSAGES, temperature) for temperature in (0.1, 0.2, 0.3)]
+    for key in keys:
+        cache.put(key, {"content": key})
+    age_entries(cache, keys)
+    # Reading the oldest entry makes the second one the least recently used
+    assert cache.get(keys[0]) is not None
+    newest = ResponseCache.key("gpt-3.5-turbo", MESSAGES, 0.4)
+    cache.put(newest, {"content": newest})
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{key}.json" for key in (keys[0], keys[2], newest))
+
+
+def test_size_limit_evicts_the_oldest_entries(tmp_path):
+    cache = ResponseCache(directory=str(tmp_path), max_bytes=2500)
+    keys = [ResponseCache.key("gpt-3.5-turbo", MESSAGES, temperature) for temperature in (0.1, 0.2)]
+    for key in keys:
+        cache.put(key, {"content": "x" * 1000})
+    age_entries(cache, keys)
+    cache.put("new", {"content": "x" * 1000})
+    assert sorted(os.listdir(tmp_path)) == sorted([f"{keys[1]}.json", "new.json"])
+
+
+def test_bypassed_cache_neither_reads_nor_writes(tmp_path):
+    cache = ResponseCache(directory=str(tmp_path / "cache"), bypass=True)
+    cache.put("key", {"content": "answer"})
+    assert cache.get("key") is None
+    assert not os.path.exists(tmp_path / "cache")
@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src.async_flow import AsyncSingleFlight
+from src.unittest_flow import SingleFlight
+
+FOLLOWERS = 4
+
+
+def run_concurrently(single_flight, key, fn):
+    """Start a leader blocked in ``fn`` and followers calling while it runs."""
+    outcomes = []
+    lock = threading.Lock()
+
+    def caller():
+        try:
+            outcome = single_flight.do(key, fn)
+        except Exception as e:
+            outcome = e
+        with lock:
+            outcomes.append(outcome)
+
+    leader = threading.Thread(target=caller)
+    leader.start()
+    fn.started.wait(5)
+    followers = [threading.Thread(target=caller) for _ in range(FOLLOWERS)]
+    for thread in followers:
+        thread.start()
+    # Give the followers time to block on the leader's call
+    time.sleep(0.2)
+    fn.release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    return outcomes
+
+
+class BlockingCall:
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_concurrent_identical_calls_run_once():
+    fn = BlockingCall(result="answer")
+    outcomes = run_concurrently(SingleFlight(), "key", fn)
+    assert fn.calls == 1
+    assert sorted(outcomes, key=lambda outcome: outcome[1]) == [("answer", False)] + [
+        ("answer", True)
+    ] * FOLLOWERS
+
+
+def test_the_exception_reaches_every_waiter():
+    error = ValueError("boom")
+    fn = BlockingCall(error=error)
+    outcomes = run_concurrently(SingleFlight(), "key", fn)
+    assert fn.calls == 1
+    assert outcomes == [error] * (FOLLOWERS + 1)
+
+
+def test_finished_calls_and_other_keys_are_not_shared():
+    single_flight = SingleFlight()
+    assert single_flight.do("a", lambda: 1) == (1, False)
+    assert single_flight.do("a", lambda: 2) == (2, False)
+    assert single_flight.do("b", lambda: 3) == (3, False)
+
+
+class AsyncBlockingCall:
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+async def run_tasks_concurrently(single_flight, key, fn):
+    leader = asyncio.ensure_future(single_flight.do(key, fn))
+    await asyncio.sleep(0)
+    followers = [asyncio.ensure_future(single_flight.do(key, fn)) for _ in range(FOLLOWERS)]
+    await asyncio.sleep(0)
+    fn.release.set()
+    return await asyncio.gather(leader, *followers, return_exceptions=True)
+
+
+def test_async_concurrent_identical_calls_run_once():
+    async def scenario():
+        fn = AsyncBlockingCall(result="answer")
+        outcomes = await run_tasks_concurrently(AsyncSingleFlight(), "key", fn)
+        return fn, outcomes
+
+    fn, outcomes = asyncio.run(scenario())
+    assert fn.calls == 1
+    assert outcomes == [("answer", False)] + [("answer", True)] * FOLLOWERS
+
+
+def test_async_exception_reaches_every_waiter():
+    error = ValueError("boom")
+
+    async def scenario():
+        fn = AsyncBlockingCall(error=error)
+        outcomes = await run_tasks_concurrently(AsyncSingleFlight(), "key", fn)
+        return fn, outcomes
+
+    fn, outcomes = asyncio.run(scenario())
+    assert fn.calls == 1
+    assert outcomes == [error] * (FOLLOWERS + 1)
+
+
+def test_async_cancelled_waiter_does_not_cancel_the_shared_call():
+    async def scenario():
+        single_flight = AsyncSingleFlight()
+        fn = AsyncBlockingCall(result="answer")
+        leader = asyncio.ensure_future(single_flight.do("key", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(single_flight.do("key", fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        fn.release.set()
+        result = await follower
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return fn, result
+
+    fn, result = asyncio.run(scenario())
+    assert fn.calls == 1
+    assert result == ("answer", True)
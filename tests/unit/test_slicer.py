@@ -0,0 +1,135 @@
+import ast
+
+import pytest
+
+from src.ast_hash import normalized_ast_hash
+from src.slicer import class_skeleton, count_tokens, dependency_slice
+from src.symbol_index import configure_symbol_index
+
+MODULE = '''\
+import math
+import os
+from collections import OrderedDict, defaultdict
+
+SCALE = 2
+UNUSED = 3
+
+
+def helper(x):
+    return math.floor(x) * SCALE
+
+
+def unrelated():
+    return os.getcwd()
+
+
+class Shape:
+    kind = "shape"
+
+    def __init__(self, width):
+        self.width = width
+
+    def double(self):
+        return self.width * 2
+
+    def area(self):
+        return helper(self.double())
+
+    def name(self):
+        return self.kind
+
+
+def total(widths):
+    return sum(Shape(width).area() for width in widths)
+'''
+
+BOX = '''\
+LIMIT = 10
+
+
+def clamp(value):
+    return min(value, LIMIT)
+
+
+class Box:
+    def size(self):
+        return clamp(3)
+'''
+
+
+@pytest.fixture(autouse=True)
+def symbol_index():
+    configure_symbol_index("")
+    yield
+    configure_symbol_index("")
+
+
+@pytest.fixture
+def module(tmp_path):
+    path = tmp_path / "shapes.py"
+    path.write_text(MODULE)
+    return str(path)
+
+
+def test_function_slice_has_its_transitive_dependencies(module):
+    context = dependency_slice(module, "total")
+    # total uses Shape, whose area uses helper, which uses SCALE and math
+    assert "import math" in context
+    assert "SCALE = 2" in context
+    assert "def helper(x)" in context
+    assert "class Shape" in context
+    assert "UNUSED" not in context
+    assert "def unrelated" not in context
+    assert "import os" not in context
+
+
+def test_imports_are_filtered_to_the_used_names(tmp_path):
+    path = tmp_path / "counts.py"
+    path.write_text(
+        "from collections import OrderedDict, defaultdict\n\n\n"
+        "def counts():\n    return defaultdict(int)\n"
+    )
+    context = dependency_slice(str(path), "counts")
+    assert context == "from collections import defaultdict"
+
+
+def test_method_slice_has_the_class_skeleton(module):
+    context = dependency_slice(module, "Shape.area")
+    assert "kind = 'shape'" in context or 'kind = "shape"' in context
+    # Members used through self and __init__ in full, other members as stubs
+    assert "return self.width * 2" in context
+    assert "self.width = width" in context
+    assert "def name(self):\n        ..." in context
+    assert "the code under test" in context
+    assert "return helper(self.double())" not in context
+    assert "def helper(x)" in context
+
+
+def test_slice_of_the_only_member_of_a_class_parses(tmp_path):
+    path = tmp_path / "box.py"
+    path.write_text(BOX)
+    context = dependency_slice(str(path), "Box.size")
+    assert "def clamp(value)" in context and "LIMIT = 10" in context
+    ast.parse(context)
+    assert normalized_ast_hash(context) is not None
+
+
+def test_definitions_beyond_the_budget_are_stubs(module):
+    context = dependency_slice(module, "total", token_budget=40)
+    assert count_tokens(context) <= 40
+    # Shape is the nearest dependency but only its stub fits
+    assert "class Shape:\n    ..." in context
+    assert "return self.width * 2" not in context
+
+
+def test_no_budget_or_unknown_target_is_empty(module):
+    assert dependency_slice(module, "total", token_budget=0) == ""
+    assert dependency_slice(module, "missing") == ""
+
+
+def test_class_skeleton(module):
+    skeleton = class_skeleton(module, "Shape")
+    assert "self.width = width" in skeleton
+    assert "def area(self):\n        ..." in skeleton
+    ast.parse(skeleton)
+    assert class_skeleton(module, "total") is None
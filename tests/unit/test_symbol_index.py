@@ -0,0 +1,95 @@
+import os
+
+from src.ast_hash import normalized_ast_hash
+from src.symbol_index import SymbolIndex, symbol_source
+
+MODULE = '''\
+import functools
+
+
+@functools.lru_cache
+def cached(x):
+    return x
+
+
+class Store:
+    def get(self, key):
+        def inner():
+            return key
+        return inner()
+
+    async def fetch(self):
+        return None
+
+
+def get():
+    return "module level"
+'''
+
+
+def write_module(tmp_path, source=MODULE):
+    path = tmp_path / "store.py"
+    path.write_text(source)
+    return str(path)
+
+
+def test_symbols_have_qualified_names_kinds_and_spans(tmp_path):
+    path = write_module(tmp_path)
+    symbols = {symbol["qualname"]: symbol for symbol in SymbolIndex(None).symbols(path)}
+    assert list(symbols) == ["cached", "Store", "Store.get", "Store.get.inner", "Store.fetch", "get"]
+    assert symbols["cached"]["first_line"] == 4 and symbols["cached"]["last_line"] == 6
+    assert symbols["Store.get"]["kind"] == "method"
+    assert symbols["Store.fetch"]["kind"] == "async method"
+    assert symbols["Store.get.inner"]["kind"] == "function"
+    assert symbols["Store"]["kind"] == "class"
+
+
+def test_lookup_by_qualified_or_first_plain_name(tmp_path):
+    path = write_module(tmp_path)
+    index = SymbolIndex(None)
+    assert index.lookup(path, "Store.get")["qualname"] == "Store.get"
+    # A plain name resolves to its first definition, unless it is a qualified name itself
+    assert index.lookup(path, "inner")["qualname"] == "Store.get.inner"
+    assert index.lookup(path, "get")["qualname"] == "get"
+    assert index.lookup(path, "missing") is None
+
+
+def test_hashes_match_normalized_ast_hash(tmp_path):
+    path = write_module(tmp_path)
+    index = SymbolIndex(None)
+    for name in ("cached", "Store", "Store.get", "get"):
+        symbol = index.lookup(path, name)
+        assert symbol["ast_hash"] == normalized_ast_hash(symbol_source(path, symbol))
+
+
+def test_changed_files_are_parsed_again(tmp_path):
+    path = write_module(tmp_path)
+    index = SymbolIndex(None)
+    index.lookup(path, "get")
+    index.lookup(path, "get")
+    assert index.parsed == 1
+    write_module(tmp_path, MODULE + "\n\ndef added():\n    pass\n")
+    os.utime(path, ns=(1, 1))
+    assert index.lookup(path, "added") is not None
+    assert index.parsed == 2
+
+
+def test_index_is_persisted_and_reused(tmp_path):
+    path = write_module(tmp_path)
+    index_file = str(tmp_path / "index.json")
+    index = SymbolIndex(index_file)
+    stats = index.update([path])
+    assert stats["parsed"] == 1
+    index.save()
+
+    reloaded = SymbolIndex(index_file)
+    assert reloaded.update([path])["parsed"] == 0
+    assert reloaded.lookup(path, "Store.fetch")["kind"] == "async method"
+    assert reloaded.parsed == 0
+
+
+def test_syntax_errors_are_recorded(tmp_path):
+    path = write_module(tmp_path, "def broken(:\n")
+    index = SymbolIndex(None)
+    assert index.symbols(path) == []
+    assert index.error(path).startswith("SyntaxError")
@@ -0,0 +1,130 @@
+import ast
+
+from src.test_merge import (
+    failing_test_names,
+    merge_test_files,
+    merge_test_modules,
+    restore_test_file,
+)
+
+EXISTING = '''\
+import pytest
+from shapes import area
+
+
+@pytest.fixture
+def unit():
+    return 1
+
+
+# Checks the unit square
+def test_unit(unit):
+    assert area(unit) == 1
+
+
+def test_broken():
+    assert area(2) == 5
+'''
+
+
+def defined_names(module):
+    return [node.name for node in ast.parse(module).body if hasattr(node, "name")]
+
+
+def test_kept_tests_keep_their_text_and_failing_ones_are_dropped():
+    merged, stats = merge_test_modules(EXISTING, "def test_two():\n    assert area(2) == 4\n", drop={"test_broken"})
+    assert "# Checks the unit square\ndef test_unit(unit):" in merged
+    assert "test_broken" not in merged
+    assert merged.index("def test_unit") < merged.index("def test_two")
+    assert stats["kept"] == 1 and stats["dropped"] == 1 and stats["added"] == 1
+
+
+def test_duplicates_are_detected_regardless_of_the_name():
+    merged, stats = merge_test_modules(EXISTING, "def test_again(unit):\n    assert area(unit) == 1\n")
+    assert "test_again" not in merged
+    assert stats["duplicates"] == 1 and stats["added"] == 0
+
+
+def test_tests_of_the_same_name_are_renamed():
+    merged, stats = merge_test_modules(EXISTING, "def test_unit():\n    assert area(3) == 9\n")
+    assert defined_names(merged) == ["unit", "test_unit", "test_broken", "test_unit_2"]
+    assert stats["added"] == 1
+
+
+def test_parametrize_cases_are_united():
+    existing = (
+        "import pytest\n\n\n@pytest.mark.parametrize('x, y', [(1, 1), (2, 4)])\n"
+        "def test_square(x, y):\n    assert x * x == y\n"
+    )
+    new = (
+        "import pytest\n\n\n@pytest.mark.parametrize('x, y', [(2, 4), (3, 9)])\n"
+        "def test_squares(x, y):\n    assert x * x == y\n"
+    )
+    merged, stats = merge_test_modules(existing, new)
+    assert stats["merged_cases"] == 1
+    assert "(1, 1), (2, 4), (3, 9)" in merged
+    assert "test_squares" not in merged
+
+
+def test_new_imports_go_before_the_tests():
+    merged, _ = merge_test_modules(EXISTING, "import math\n\n\ndef test_pi():\n    assert math.pi > 3\n")
+    assert merged.index("import math") < merged.index("@pytest.fixture")
+
+
+def test_fixture_of_an_existing_name_is_skipped_unless_renamed():
+    new = (
+        "import pytest\n\n\n@pytest.fixture\ndef unit():\n    return 2\n\n\n"
+        "def test_double(unit):\n    assert area(unit) == 4\n"
+    )
+    merged, stats = merge_test_modules(EXISTING, new)
+    assert merged.count("def unit") == 1 and stats["renamed"] == 0
+
+    merged, stats = merge_test_modules(EXISTING, new, rename=True)
+    assert stats["renamed"] == 1
+    assert "def unit_2():\n    return 2" in merged
+    assert "def test_double(unit_2):\n    assert area(unit_2) == 4" in merged
+    # The existing tests keep their fixture
+    assert "def test_unit(unit):" in merged
+
+
+def test_identical_fixtures_are_shared_and_not_renamed():
+    new = "import pytest\n\n\n@pytest.fixture\ndef unit():\n    return 1\n\n\ndef test_three(unit):\n    assert area(3 * unit) == 9\n"
+    merged, stats = merge_test_modules(EXISTING, new, rename=True)
+    assert merged.count("def unit") == 1 and stats["renamed"] == 0
+
+
+def test_unparsable_module_is_returned_unchanged():
+    merged, stats = merge_test_modules("def test_(:\n", "def test_ok():\n    pass\n")
+    assert merged == "def test_ok():\n    pass\n"
+    assert stats["added"] == 0
+
+
+def test_failing_test_names():
+    failures = [
+        {"nodeid": "tests/test_a.py::test_one[1-2]"},
+        {"nodeid": "tests/test_a.py::TestGroup::test_two"},
+    ]
+    assert failing_test_names(failures) == {"test_one", "TestGroup.test_two"}
+    assert failing_test_names("output") is None
+    assert failing_test_names([{"nodeid": "tests/test_a.py"}]) is None
+
+
+def test_merge_test_files_and_restore(tmp_path):
+    test_file = tmp_path / "test_shape.py"
+    first = tmp_path / "test_shape_area.py"
+    second = tmp_path / "test_shape_name.py"
+    first.write_text("import pytest\n\n\n@pytest.fixture\ndef shape():\n    return 1\n\n\ndef test_area(shape):\n    assert shape == 1\n")
+    second.write_text("import pytest\n\n\n@pytest.fixture\ndef shape():\n    return 2\n\n\ndef test_name(shape):\n    assert shape == 2\n")
+
+    stats = merge_test_files(str(test_file), [str(first), str(second)], remove_sources=False)
+    merged = test_file.read_text()
+    assert stats["added"] == 2 and stats["renamed"] == 1
+    assert merged.count("import pytest") == 1
+    assert "def test_name(shape_2):" in merged
+    assert first.exists() and second.exists()
+
+    restore_test_file(str(test_file), None)
+    assert not test_file.exists()
+
+    merge_test_files(str(test_file), [str(first), str(second)])
+    assert test_file.exists() and not first.exists() and not second.exists()